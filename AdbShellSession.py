@@ -0,0 +1,71 @@
+import threading
+
+
+class AdbShellSession(object):
+    """
+    A long lived sh on device, fed with newline delimited commands over a single adb connection.
+    Opening an adb shell service costs a round trip and a new shell process for every command: here it is
+    paid once. Each command is followed by a marker line, read back to know when the command ended.
+    """
+
+    def __init__(self, device, timeout: float = 30.0):
+        self.device = device
+        self.timeout = timeout
+        self.commands_sent = 0
+        self._conn = None
+        self._buffer = b""
+        self._lock = threading.Lock()
+
+    def isOpen(self) -> bool:
+        return self._conn is not None
+
+    def open(self):
+        conn = self.device.create_connection(timeout=self.timeout)
+        # exec gives a raw stream (no pty): no echo of commands and no \r\n translation
+        conn.send("exec:sh")
+        self._conn = conn
+        self._buffer = b""
+
+    def close(self):
+        with self._lock:
+            self._close()
+
+    def _close(self):
+        if self._conn is not None:
+            try:
+                self._conn.close()
+            except Exception:
+                pass
+        self._conn = None
+        self._buffer = b""
+
+    def run(self, command: str) -> str:
+        """
+        Runs command and returns its output once it ended. On any error the session is closed (next command
+        opens a new one) and the error is raised.
+        """
+        with self._lock:
+            try:
+                if self._conn is None:
+                    self.open()
+                self.commands_sent += 1
+                # printed by printf, so the marker text itself never appears in the command line
+                marker = ("__archero_bot_%d__" % self.commands_sent).encode()
+                line = "%s 2>&1; printf '__archero_bot_%%s__\\n' %d\n" % (command, self.commands_sent)
+                self._conn.socket.sendall(line.encode('utf-8'))
+                return self._readUntil(marker).decode('utf-8', errors='replace')
+            except Exception:
+                self._close()
+                raise
+
+    def _readUntil(self, marker: bytes) -> bytes:
+        while True:
+            index = self._buffer.find(marker + b"\n")
+            if index >= 0:
+                output = self._buffer[:index]
+                self._buffer = self._buffer[index + len(marker) + 1:]
+                return output
+            data = self._conn.socket.recv(4096)
+            if not data:
+                raise Exception("adb shell session closed by device")
+            self._buffer += data
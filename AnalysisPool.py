@@ -0,0 +1,152 @@
+import io
+import os
+import queue
+import multiprocessing
+from multiprocessing import shared_memory
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from PIL import Image
+
+from Frame import Frame
+from UsbConnector import UsbConnector
+from GameScreenConnector import GameScreenConnector
+
+"""
+Screens decoding and GameScreenConnector.analyze in worker processes, so analyses of several devices run on
+all cores instead of one at a time under the GIL.
+Captures (png, raw screencap or rgba pixels) are written in shared memory slots reused from frame to frame:
+only slot name, checks and results go through the process pipes.
+"""
+
+# worker process globals: one GameScreenConnector for each screen size, shared memory segments attached
+_worker_connectors = {}
+_worker_segments = {}
+
+# raw screencap header is 12 bytes, 16 on Android 9+
+_raw_header_size = 16
+
+
+class AnalysisPool(object):
+
+    def __init__(self, processes: int = None, slots: int = None):
+        self.processes = os.cpu_count() if processes is None else processes
+        # captures in flight at the same time, submit waits for a free slot
+        self.slots = self.processes * 2 if slots is None else slots
+        self.frames_analyzed = 0
+        self._executor: ProcessPoolExecutor = None
+        self._free_slots = queue.Queue()
+        self._segments = []
+        self._released = [] # names of segments replaced by bigger ones, workers detach them
+
+    def start(self):
+        if self.isRunning():
+            return
+        # spawn: workers must not inherit device connections and threads of this process
+        self._executor = ProcessPoolExecutor(self.processes, mp_context=multiprocessing.get_context("spawn"))
+        self._free_slots = queue.Queue()
+        for _ in range(self.slots):
+            # slots memory is created at first use, when captures size is known
+            self._free_slots.put(None)
+
+    def stop(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+        for segment in self._segments:
+            segment.close()
+            segment.unlink()
+        self._segments = []
+        self._released = []
+
+    def isRunning(self) -> bool:
+        return self._executor is not None
+
+    def submit(self, encoding: str, data, width: int, height: int, checks: list, old_exp_bar=None):
+        """
+        Starts the analysis of a capture. encoding is "png", "raw" (screencap output) or "rgba" (width x height
+        pixels). Returns a Future of a dictionary with state, checks, lines and doors_variant.
+        """
+        payload = np.frombuffer(data, dtype=np.uint8).reshape(-1)
+        slot = self._free_slots.get()
+        if slot is None or slot.size < payload.size:
+            if slot is not None:
+                self._releaseSegment(slot)
+            # sized for a whole raw capture, so a slot is created once for each screen size
+            slot = self._newSegment(max(payload.size, width * height * 4 + _raw_header_size))
+        np.frombuffer(slot.buf, dtype=np.uint8, count=payload.size)[:] = payload
+        request = (slot.name, payload.size, encoding, width, height, checks, old_exp_bar, tuple(self._released))
+        future = self._executor.submit(_analyzeInWorker, request)
+        future.add_done_callback(lambda f: self._slotDone(slot))
+        return future
+
+    def analyze(self, encoding: str, data, width: int, height: int, checks: list, old_exp_bar=None) -> dict:
+        """
+        As submit, waiting for the result
+        """
+        return self.submit(encoding, data, width, height, checks, old_exp_bar).result()
+
+    def _newSegment(self, size: int) -> shared_memory.SharedMemory:
+        segment = shared_memory.SharedMemory(create=True, size=size)
+        self._segments.append(segment)
+        return segment
+
+    def _releaseSegment(self, segment: shared_memory.SharedMemory):
+        """
+        Frees a slot segment: memory is given back once the workers attached to it detach (told by next requests)
+        """
+        self._segments.remove(segment)
+        self._released.append(segment.name)
+        segment.close()
+        segment.unlink()
+
+    def _slotDone(self, slot: shared_memory.SharedMemory):
+        self.frames_analyzed += 1
+        self._free_slots.put(slot)
+
+
+def _decodeCapture(encoding: str, payload: bytes, width: int, height: int) -> Frame:
+    if encoding == "png":
+        with Image.open(io.BytesIO(payload)) as im:
+            return Frame.fromImage(im)
+    if encoding == "raw":
+        raw = UsbConnector._parse_raw_screencap(payload)
+        if raw is None:
+            raise Exception("Unable to parse raw screencap")
+        return Frame(raw[2])
+    return Frame.fromBuffer(payload, width, height)
+
+
+def _getWorkerConnector(width: int, height: int):
+    connector = _worker_connectors.get((width, height))
+    if connector is None:
+        connector = GameScreenConnector()
+        connector.debug = False
+        # frames of many devices come to the same worker: nothing to reuse from one frame to the next
+        connector.frame_diff_gating = False
+        connector.changeScreenSize(width, height)
+        _worker_connectors[(width, height)] = connector
+    return connector
+
+
+def _analyzeInWorker(request: tuple) -> dict:
+    name, size, encoding, width, height, checks, old_exp_bar, released = request
+    for released_name in released:
+        released_segment = _worker_segments.pop(released_name, None)
+        if released_segment is not None:
+            released_segment.close()
+    segment = _worker_segments.get(name)
+    if segment is None:
+        segment = shared_memory.SharedMemory(name=name)
+        _worker_segments[name] = segment
+    # one copy out of the slot: the slot can be reused as soon as this returns
+    frame = _decodeCapture(encoding, bytes(segment.buf[:size]), width, height)
+    connector = _getWorkerConnector(frame.width, frame.height)
+    analysis = connector.analyze(frame, checks, old_exp_bar)
+    connector.resetCaches()
+    return {
+        "state": analysis.state,
+        "checks": analysis.checks,
+        "lines": {line: np.array(pixels) for line, pixels in analysis.lines.items()},
+        "doors_variant": analysis.doors_variant,
+    }
@@ -2,9 +2,13 @@ import json
 import time
 from datetime import datetime
 from PyQt5.QtCore import QObject, pyqtSignal
-from UsbConnector import UsbConnector
+from UsbConnector import UsbConnector, CaptureMode
 from GameScreenConnector import GameScreenConnector
+from PollScheduler import PollScheduler
+from InputDispatcher import InputDispatcher
 from StatisticsManager import StatisticsManager
+from SessionRecorder import SessionRecorder
+from TimingStats import TimingStats, timed
 from Utils import loadJsonData, saveJsonData_oneIndent, saveJsonData_twoIndent, readAllSizesFolders, buildDataFolder, getCoordFilePath
 from GameChapters import ChapterInfo, ChapterLevelType, DungeonLevelType, BuildChapters, BuildLevelsTypes, MaxLevelFromType
 import enum
@@ -55,8 +59,25 @@ class CaveEngine(QObject):
     max_loops_game = 1000 # set loops for start_one_game (default 100, farming cycles)
     max_wait = 5 # set loops for final_boss (default 5, increase sleep screens if need more time)
     sleep_btw_screens = 8 # set wait between loops for final_boss (default 8, in seconds)
+    state_poll_interval = 0.5 # seconds between screen checks in wait_for_state
+    play_poll_min_interval = 0.5 # letPlay checks screen this often after changes and near expected room clear time
+    play_poll_max_interval = 4.0 # letPlay checks screen at least this often while nothing changes
+    # states showing the game is loaded after a crash or a restart
+    loaded_game_states = ["menu_home", "menu_talents", "menu_events", "menu_equip", "menu_shop", "in_game",
+                          "monster_farm_home", "menu_expedition", "game_announcement", "legendary_challenge",
+                          "popup_new_season", "popup_home_patrol", "popup_vip_rewards", "popup_need_this",
+                          "popup_need_this_1", "popup_need_this_2", "popup_welcome_back", "time_prize",
+                          "crash_continue_yes", "game_not_responding"]
 
     UseGeneratedData = False # Set True to use TouchManager generated data
+    capture_mode = CaptureMode.Png # set CaptureMode.Raw to read uncompressed screens (faster, falls back to png)
+    screen_stream_fps = 0 # set > 0 to capture screens continuously in background at this rate (frames per second)
+    roi_capture = False # set True to transfer only screen rows needed by checks (works with CaptureMode.Raw)
+    async_input = True # send taps and swipes from a background thread, so screen checks can run during a swipe
+    device_macros = True # run movement macros on device as one script (no delay between moves), False to send moves one by one
+    macro_check_interval = 0.1 # seconds between stop and state checks while a macro runs
+    record_timings = True # time captures, checks, inputs, waits and levels of each game (see TimingStats)
+    record_session = False # keep a rolling recording of screens, states and inputs in recordings folder (see SessionRecorder)
     
     data_pack = 'datas'
     coords_path = 'coords'
@@ -75,6 +96,8 @@ class CaveEngine(QObject):
 
     allowed_chapters = [1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 12, 13, 14, 15, 16, 17, 18, 19, 20]
 
+    _tier_list_abilities = None
+
     ''' dictionary of strings (chapter number), each one is a ChapterInfo '''
     chapters_info = BuildChapters()
 
@@ -91,8 +114,10 @@ class CaveEngine(QObject):
     -------------------------------
     '''
 
-    def __init__(self, connectImmediately: bool = False):
+    def __init__(self, connectImmediately: bool = False, serial: str = None, device_connector=None,
+                 device_tracker=None):
         super(QObject, self).__init__()
+        self.serial = serial # device serial this engine plays on, None for the first device found
         self.debug = False # set True to show print debug messages in console
         self.deadcheck = False # controled by GUI dropdown, works <50% of time to revive; costs gems unless BPAdv Sub
         self.smartHealChoice = False # controled by GUI dropdown, works >90% of the time
@@ -103,16 +128,33 @@ class CaveEngine(QObject):
         self.restartStatus = False # Extra movement neede upon level crash
         self.currentDungeon = 6 
         self.check_seconds = 6
+        self.poll_scheduler = PollScheduler(self.play_poll_min_interval, self.play_poll_max_interval)
+        self.door_open_time = None # frame time when letPlay found doors open, see reportDoorToExit
+        self.door_exit_times = [] # seconds from doors open to room exit
+        self._last_play_analysis = None
+        self._previous_poll_time = None
         self.energy_count = 1
         self.load_tier_list()
-        self.statisctics_manager = StatisticsManager()
+        # one statistics file (and recordings folder) for each device, when bound to one
+        self.device_name = None if serial is None else "".join(c if c.isalnum() else "_" for c in serial)
+        self.statisctics_manager = StatisticsManager() if serial is None else StatisticsManager(
+            "statistics_%s.csv" % self.device_name)
         self.start_date = datetime.now()
         self.stat_lvl_start = 0
         self.screen_connector = GameScreenConnector()
         self.screen_connector.debug = False # set true to see screen_connector degbug messages in console
+        self.screen_connector.roi_capture = self.roi_capture
         self.width, self.heigth = 1080, 1920 
-        self.device_connector = UsbConnector()
+        # any object with UsbConnector interface can be given, e.g. a ReplayConnector. device_tracker is shared
+        # by the UsbConnector created here (see UsbConnector)
+        self.device_connector = UsbConnector(serial, device_tracker) if device_connector is None else device_connector
+        self.device_connector.setCaptureMode(self.capture_mode)
         self.device_connector.setFunctionToCallOnConnectionStateChanged(self.onConnectionStateChanged)
+        self.input_dispatcher = InputDispatcher(self.device_connector)
+        self.timings = TimingStats()
+        self.timings.enabled = self.record_timings
+        self.screen_connector.timings = self.timings
+        self.device_connector.timings = self.timings
         self.buttons = {}
         self.movements = {}
         self.disableLogs = False # do not change
@@ -128,14 +170,37 @@ class CaveEngine(QObject):
         self.current_settings = {}
         self.current_settings_path = 'current_settings.json'
         self.load_current_settings()
+        self.session_recorder = None
+        if self.record_session:
+            self.startSessionRecording()
         if connectImmediately:
             self.initDeviceConnector()
 
     def load_tier_list(self):
-        if self.debug: print("Loading Abilities Tier List")
-        file = os.path.join("datas", "abilities", "tier_list.json")
-        with open(file) as file_in:
-            self.tier_list_abilities = json.load(file_in)
+        # read only, loaded once for all engines
+        if CaveEngine._tier_list_abilities is None:
+            if self.debug: print("Loading Abilities Tier List")
+            file = os.path.join("datas", "abilities", "tier_list.json")
+            with open(file) as file_in:
+                CaveEngine._tier_list_abilities = json.load(file_in)
+        self.tier_list_abilities = CaveEngine._tier_list_abilities
+
+    def startSessionRecording(self) -> SessionRecorder:
+        if self.session_recorder is None:
+            folder = "recordings" if self.device_name is None else os.path.join("recordings", self.device_name)
+            self.session_recorder = SessionRecorder(folder)
+        self.session_recorder.start()
+        self.screen_connector.session_recorder = self.session_recorder
+        return self.session_recorder
+
+    def stopSessionRecording(self):
+        if self.session_recorder is not None:
+            self.session_recorder.stop()
+        self.screen_connector.session_recorder = None
+
+    def saveSessionSnapshot(self, reason: str):
+        if self.session_recorder is not None and self.session_recorder.isRunning():
+            self.session_recorder.saveSnapshot(reason)
 
     def initDataFolders(self):
         if self.debug: print("Initalizing Data Folders")
@@ -236,8 +301,14 @@ class CaveEngine(QObject):
             self.initDataFolders()
             self.screen_connector.changeDeviceConnector(self.device_connector)
             self.updateScreenSizeByPhone()
+            if self.screen_stream_fps > 0:
+                if self.debug: print("Starting screen stream at %.1f fps" % self.screen_stream_fps)
+                self.device_connector.startScreenStream(self.screen_stream_fps)
+            if self.async_input:
+                self.input_dispatcher.start()
         else:
             if self.debug: print("No Device Detected")
+            self.input_dispatcher.stop()
 
     def updateScreenSizeByPhone(self):
         if self.device_connector is not None:
@@ -261,6 +332,7 @@ class CaveEngine(QObject):
         if self.debug: print("Pause Requested")
         self.stopRequested = True
         self.screen_connector.stopRequested = True
+        self.input_dispatcher.clear()
         self.changeEndStatus(self.endStatus + 10) # Pause-Requested
         self.runStatiscticsSave()
 
@@ -268,6 +340,7 @@ class CaveEngine(QObject):
         if self.debug: print("Stop Requested")
         self.stopRequested = True
         self.screen_connector.stopRequested = True
+        self.input_dispatcher.clear()
 
     def setStartRequested(self):
         if self.debug: print("Start Requested")
@@ -298,30 +371,138 @@ class CaveEngine(QObject):
         start = self.buttons[start]
         stop = self.buttons[stop]
         if self.debug: print("Swiping between %s and %s in %f" % (start, stop, s))
-        self.device_connector.adb_swipe(
-            [start[0] * self.width, start[1] * self.heigth, stop[2] * self.width, stop[3] * self.heigth], s)
+        self._sendInput("swipe", (
+            [start[0] * self.width, start[1] * self.heigth, stop[2] * self.width, stop[3] * self.heigth], s), True)
+
+    def _sendInput(self, kind: str, args: tuple, wait: bool):
+        """
+        Sends the input through the input dispatcher when it is running, directly otherwise.
+        Returns the InputCommand (None if sent directly). With wait, returns once the input ended.
+        """
+        if not self.input_dispatcher.isRunning():
+            if kind == "swipe":
+                self.device_connector.adb_swipe(*args)
+            else:
+                self.device_connector.adb_tap(*args)
+            return None
+        command = self.input_dispatcher.swipe(*args) if kind == "swipe" else self.input_dispatcher.tap(*args)
+        while wait and not command.wait(1):
+            if self.stopRequested:
+                self.input_dispatcher.clear()
+                exit()
+        return command
 
-    def swipe(self, name, s):
+    def swipe(self, name, s, wait: bool = True):
+        """
+        Swipes movement name in s seconds. Without wait it returns as soon as the swipe is queued:
+        use the returned InputCommand (None if input dispatcher is not running) to know when it ends.
+        """
         if self.stopRequested:
             exit()
         coord = self.movements[name]
         if self.debug: print("Swiping %s in %f" % (self.print_names_movements[name], s))
         self.log("Swipe %s in %.2f" % (self.print_names_movements[name], s))
+        if self.session_recorder is not None: self.session_recorder.recordInput("swipe", [name, s])
         # convert back from normalized values
-        self.device_connector.adb_swipe(
+        return self._sendInput("swipe", (
             [coord[0][0] * self.width, coord[0][1] * self.heigth, coord[1][0] * self.width, coord[1][1] * self.heigth],
-            s)
+            s), wait)
+
+    def compileMacro(self, macro: list) -> list:
+        """
+        Converts macro steps to the shell commands of a device script
+        """
+        commands = []
+        for name, s in macro:
+            if name == "wait":
+                commands.append("sleep %.3f" % s)
+                continue
+            coord = self.movements[name]
+            # same conversion of normalized values and duration as swipe
+            commands.append("input swipe %d %d %d %d %d" % (
+                int(coord[0][0] * self.width), int(coord[0][1] * self.heigth), int(coord[1][0] * self.width),
+                int(coord[1][1] * self.heigth), int(s * 1000)))
+        return commands
+
+    @timed
+    def play_macro(self, macro: list, check=None):
+        """
+        Plays a macro: a list of [direction, seconds] steps (directions as in print_names_movements) and
+        ["wait", seconds] pauses. With device_macros the whole macro runs on device as a single script,
+        otherwise moves are sent one by one.
+        check (optional) is called every macro_check_interval seconds while the macro runs: as soon as it
+        returns something else than None the macro is aborted and that is returned. An aborted device macro
+        starts no further move, its running move ends first (see DeviceMacro.abort).
+        Returns None once the macro completed.
+        """
+        if self.stopRequested:
+            exit()
+        if self.debug: print("Playing macro: %s" % ", ".join(
+            "%s %.2f" % (self.print_names_movements.get(name, name), s) for name, s in macro))
+        running = self._startDeviceMacro(macro)
+        if running is not None:
+            if self.session_recorder is not None: self.session_recorder.recordInput("macro", macro)
+            return self._followMacro(running, check, running.abort)
+        for name, s in macro:
+            if name == "wait":
+                deadline = time.time() + s
+                while time.time() < deadline:
+                    self.wait(max(0.0, min(self.macro_check_interval, deadline - time.time())))
+                    result = None if check is None else check()
+                    if result is not None:
+                        return result
+                continue
+            command = self.swipe(name, s, wait=False)
+            if command is not None:
+                result = self._followMacro(command, check, self.input_dispatcher.clear)
+            else:
+                result = None if check is None else check()
+            if result is not None:
+                return result
+        return None
+
+    def _startDeviceMacro(self, macro: list):
+        """
+        Returns the DeviceMacro started on device, None if device macros are disabled or could not start
+        """
+        if not self.device_macros or not self.device_connector.connected:
+            return None
+        # queued inputs go first
+        self.input_dispatcher.waitIdle()
+        try:
+            return self.device_connector.startMacro(self.compileMacro(macro))
+        except Exception as e:
+            print("Unable to start macro on device: %s. Sending moves one by one" % str(e))
+            return None
+
+    def _followMacro(self, running, check, abort):
+        """
+        Waits for running (DeviceMacro or InputCommand) to end, calling check meanwhile.
+        abort is called on stop request or once check returned something.
+        """
+        while not running.wait(self.macro_check_interval):
+            if self.stopRequested:
+                abort()
+                exit()
+            result = None if check is None else check()
+            if result is not None:
+                abort()
+                return result
+        return None
 
-    def tap(self, name):
+    def tap(self, name, wait: bool = True):
         if self.stopRequested:
             exit()
         self.log("Tap %s" % name)
         # convert back from normalized values
         x, y = int(self.buttons[name][0] * self.width), int(self.buttons[name][1] * self.heigth)
         if self.debug: print("Tapping on %s at [%d, %d]" % (name, x, y))
-        self.device_connector.adb_tap((x, y))
+        if self.session_recorder is not None: self.session_recorder.recordInput("tap", [name, x, y])
+        return self._sendInput("tap", ((x, y),), wait)
 
+    @timed
     def wait(self, s):
+        if self.session_recorder is not None: self.session_recorder.recordWait(s)
         decimal = s
         if int(s) > 0:
             decimal = s - int(s)
@@ -333,6 +514,28 @@ class CaveEngine(QObject):
             exit()
         time.sleep(decimal)
 
+    def wait_for_state(self, states: list, timeout: float, poll_interval: float = None):
+        """
+        Waits until one of given states (any static coords name) is on screen, checking it every poll_interval
+        seconds (state_poll_interval if None), up to timeout seconds.
+        Returns the state found, None on timeout.
+        """
+        poll_interval = self.state_poll_interval if poll_interval is None else poll_interval
+        deadline = time.time() + timeout
+        while True:
+            if self.stopRequested:
+                exit()
+            analysis = self.screen_connector.analyze(checks=states)
+            for state in states:
+                if analysis.get(state):
+                    if self.debug: print("Waited state %s" % state)
+                    return state
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                if self.debug: print("Timeout waiting for %s" % ", ".join(states))
+                return None
+            self.wait(min(poll_interval, remaining))
+
     def changeCurrentLevel(self, new_lvl):
         self.currentLevel = new_lvl
         self.levelChanged.emit(self.currentLevel)
@@ -404,198 +607,120 @@ class CaveEngine(QObject):
         if self.debug: print("exit_dungeon_old 'Improved'")
         self.disableLogs = True
         #self.centerPlayer()
-        self.swipe('n', 3)
-        self.swipe('ne', .5)
-        self.swipe('nw', 3)
-        self.swipe('ne', 3)
-        self.swipe('nw', 3)
-        self.swipe('ne', 3)
-        self.swipe('w', .7)
+        self.play_macro([['n', 3], ['ne', .5], ['nw', 3], ['ne', 3], ['nw', 3], ['ne', 3], ['w', .7]])
 
     def exit_movement_dungeon_7(self):
         if self.debug: print("exit_dungeon_7")
         self.disableLogs = True    
-        self.swipe('w', .7)
-        self.swipe('ne', 1.9)
+        self.play_macro([['w', .7], ['ne', 1.9]])
         self.disableLogs = False
 
     def exit_movement_dungeon6(self):
         if self.debug: print("exit_dungeon_6")
         self.disableLogs = True
-        self.swipe('w', 2)
-        self.swipe('ne', 3)
+        self.play_macro([['w', 2], ['ne', 3]])
         self.disableLogs = False
 
     def exit_movement_dungeon10(self): 
         if self.debug: print("exit_dungeon_10")
         self.disableLogs = True
-        self.swipe('e', 1.5)
-        self.swipe('nw', 3)
+        self.play_macro([['e', 1.5], ['nw', 3]])
         self.disableLogs = False
 
     def exit_movement_dungeon16(self): 
         if self.debug: print("exit_dungeon_16")
         self.disableLogs = True
-        self.swipe('e', 1.2)
-        self.swipe('nw', 3)
+        self.play_macro([['e', 1.2], ['nw', 3]])
         self.disableLogs = False
 
     def exit_movement_dungeon18(self): 
         if self.debug: print("exit_dungeon_18")
         self.disableLogs = True
         if self.currentLevel == 11 or self.currentLevel == 12 or self.currentLevel == 13:
-            self.swipe('w', 1)
-            self.swipe('ne', 3)
+            self.play_macro([['w', 1], ['ne', 3]])
         else:
-            self.swipe('e', 1)
-            self.swipe('nw', 3)
+            self.play_macro([['e', 1], ['nw', 3]])
         self.disableLogs = False
 
     def exit_movement_dungeon20(self): 
         if self.debug: print("exit_dungeon_20")
         self.disableLogs = True
-        self.swipe('e', 1.5)
-        self.swipe('nw', 3)
+        self.play_macro([['e', 1.5], ['nw', 3]])
         self.disableLogs = False
    
     def goTroughDungeon20(self):
         if self.debug: print("Going through dungeon (designed for #20)")
         self.log("Crossing Dungeon 20")
         self.disableLogs = True
-        self.swipe('n', 2)
-        self.swipe('nw', 2.2)
+        macro = [['n', 2], ['nw', 2.2]]
         if self.currentLevel == 16:
-            self.swipe('s', .5)
-            self.swipe('e', .5)
-            self.swipe('n', .5)
+            macro += [['s', .5], ['e', .5], ['n', .5]]
         else:
-            self.swipe('s', .3)
-            self.swipe('e', .5)
-            self.swipe('n', .3)
-        self.swipe('ne', 1.8)
-        self.swipe('s', .3)
-        self.swipe('w', .5)
-        self.swipe('n', .3)
-        self.swipe('nw', 1.5)
-        self.swipe('ne', 1)
+            macro += [['s', .3], ['e', .5], ['n', .3]]
+        macro += [['ne', 1.8], ['s', .3], ['w', .5], ['n', .3], ['nw', 1.5], ['ne', 1]]
+        self.play_macro(macro)
         self.disableLogs = False
 
     def goTroughDungeon18(self):
         if self.debug: print("Going through dungeon (designed for #18)")
         self.log("Crossing Dungeon 18")
         self.disableLogs = True
-        self.swipe('n', 2)
-        self.swipe('nw', 2)
-        self.swipe('ne', 3)
-        self.swipe('nw', 2)
-        self.swipe('e', .7)
+        macro = [['n', 2], ['nw', 2], ['ne', 3], ['nw', 2], ['e', .7]]
         if self.currentLevel == 6:
-            self.swipe('w', .4)
+            macro += [['w', .4]]
         elif self.currentLevel == 11 or self.currentLevel == 12 or self.currentLevel == 13:
-            self.swipe('n', 2)
-            self.swipe('nw', .5)
+            macro += [['n', 2], ['nw', .5]]
+        self.play_macro(macro)
         self.disableLogs = False
 
     def goTroughDungeon10(self):
         if self.debug: print("Going through dungeon (designed for #10)")
         self.log("Crossing Dungeon 10")
         self.disableLogs = True
-        self.swipe('n', .5)
-        self.swipe('nw', 2.5)
-        self.swipe('ne', 2.5)
-        self.swipe('nw', 1.8)
-        self.swipe('ne', 1)
-        self.swipe('w', .7)
-        self.swipe('s', .6)
-        self.swipe('e', .35)
-        self.swipe('ne', .4)
-        self.swipe('n', 2.5)
-        self.swipe('s', .3)
-        self.swipe('w', .35)
-        self.swipe('nw', .4)
-        self.swipe('n', 1)
+        macro = [['n', .5], ['nw', 2.5], ['ne', 2.5], ['nw', 1.8], ['ne', 1], ['w', .7], ['s', .6], ['e', .35],
+                 ['ne', .4], ['n', 2.5], ['s', .3], ['w', .35], ['nw', .4], ['n', 1]]
         if self.currentLevel == 18:
-            self.swipe('w', .3)
-            self.swipe('s', .35)
-            self.swipe('ne', .4)
-            self.swipe('n', .4)
+            macro += [['w', .3], ['s', .35], ['ne', .4], ['n', .4]]
+        self.play_macro(macro)
         self.disableLogs = False
 
     def goTroughDungeon16(self):
         if self.debug: print("Going through dungeon (designed for #16)")
         self.log("Crossing Dungeon 16")
         self.disableLogs = True
-        self.swipe('n', .5)
-        self.swipe('nw', 2.5)
-        self.swipe('ne', 2.5)
-        self.swipe('nw', 1.8)
-        self.swipe('ne', 1)
-        self.swipe('w', .7)
+        macro = [['n', .5], ['nw', 2.5], ['ne', 2.5], ['nw', 1.8], ['ne', 1], ['w', .7]]
         if self.currentLevel == 11 or self.currentLevel == 18:
-            self.swipe('sw', .6)
-            self.swipe('nw', .8)
-        self.swipe('se', .65)
-        self.swipe('e', .7)
-        self.swipe('nw', .55)
-        self.swipe('ne', .7)
-        self.swipe('w', .3)
-        self.swipe('s', .6)
-        self.swipe('sw', .3)
-        self.swipe('nw', .7)
+            macro += [['sw', .6], ['nw', .8]]
+        macro += [['se', .65], ['e', .7], ['nw', .55], ['ne', .7], ['w', .3], ['s', .6], ['sw', .3], ['nw', .7]]
         if self.currentLevel == 6:
-            self.swipe('s', .4)
-            self.swipe('e', .5)
-            self.swipe('nw', .6)
+            macro += [['s', .4], ['e', .5], ['nw', .6]]
         elif self.currentLevel == 11 or self.currentLevel == 18:
-            self.swipe('e', .3)
-            self.swipe('n', .3)
-            self.swipe('nw', .4)
-        self.swipe('ne', .55)
-        self.swipe('w', .3)
-        self.swipe('n', 1.5)
+            macro += [['e', .3], ['n', .3], ['nw', .4]]
+        macro += [['ne', .55], ['w', .3], ['n', 1.5]]
+        self.play_macro(macro)
         self.disableLogs = False
 
     def goTroughDungeon6(self):
         if self.debug: print("Going through dungeon (designed for #6)")
         self.log("Crossing Dungeon 6")
         self.disableLogs = True
-        self.swipe('n', 1.5)
-        self.swipe('w', .3)
-        self.swipe('n', .6)
-        self.swipe('e', .6)
-        self.swipe('n', .6)
-        self.swipe('w', .6)
-        self.swipe('n', 1.5)
-        self.swipe('e', .3)
-        self.swipe('n', 2)
+        self.play_macro([['n', 1.5], ['w', .3], ['n', .6], ['e', .6], ['n', .6], ['w', .6], ['n', 1.5], ['e', .3],
+                         ['n', 2]])
         self.disableLogs = False
 
     def goTroughDungeon3(self):
         if self.debug: print("Going through dungeon (designed for #3)")
         self.log("Crossing Dungeon 3")
         self.disableLogs = True
-        self.swipe('n', 1.5)
-        self.swipe('w', .25)
-        self.swipe('n', .5)
-        self.swipe('e', .25)
-        self.swipe('n', 2)
-        self.swipe('w', 1)
-        self.swipe('n', .5)
-        self.swipe('e', 1)
-        self.swipe('n', 1.5)
+        self.play_macro([['n', 1.5], ['w', .25], ['n', .5], ['e', .25], ['n', 2], ['w', 1], ['n', .5], ['e', 1],
+                         ['n', 1.5]])
         self.disableLogs = False
 
     def goTroughDungeon_old(self):
         if self.debug: print("Going through dungeon old 'Improved'")
         self.log("Crossing Dungeon (Improved)")
         self.disableLogs = True
-        self.swipe('n', 3)
-        self.swipe('ne', .5)
-        self.swipe('nw', 3)
-        self.swipe('ne', 3)
-        self.swipe('nw', 3)
-        self.swipe('ne', 3)
-        self.swipe('w', .7)
+        self.play_macro([['n', 3], ['ne', .5], ['nw', 3], ['ne', 3], ['nw', 3], ['ne', 3], ['w', .7]])
         self.disableLogs = False
 
     def goTroughDungeon(self):
@@ -628,6 +753,135 @@ class CaveEngine(QObject):
         elif dir == "center":
             pass
 
+    def _getPatrolSteps(self, i: int, _time: int) -> (str, list):
+        """
+        Returns log name and steps of the patrol to do in the room at countdown i.
+        Steps are macro steps (see play_macro) and ["dead_check", 0].
+        """
+        if self.currentDungeon == 7 or self.currentDungeon == 14:
+            # added movement to increase kill enemy efficency for 10 level chapters
+            moves = [['sw', 1.5], ['se', 1], ['e', 0.6], ['n', 0.5], ['ne', 1.2], ['w', 0.4], ['ne', 1], ['w', 0.7]]
+            if (self.deadcheck or self.battle_pass_advanced) and self.currentLevel > 3:
+                steps = [["dead_check", 0]]
+                for move in moves:
+                    steps += [move, ["dead_check", 0]]
+            else:
+                steps = [["wait", 1], ['sw', 1.5], ["wait", 1], ['se', 1], ["wait", 1], ['e', 0.6], ['n', 0.5],
+                         ["wait", 1], ['ne', 1.2], ["wait", 1], ['w', 0.4], ['ne', 1], ["wait", 1], ['w', 0.7],
+                         ["wait", 1]]
+            return "Avoiding Boss", steps
+        if self.currentDungeon in [3, 6, 10, 16, 18, 20]:
+            # added movement to increase kill enemy efficency for 20 level chapters
+            moves = [['w', 0.35], ['e', 0.7], ['w', 0.7], ['e', 0.7], ['w', 0.37]]
+            steps = []
+            if (self.deadcheck or self.battle_pass_advanced) and self.currentLevel > 4:
+                steps.append(["dead_check", 0])
+                for move in moves:
+                    steps += [move, ["dead_check", 0]]
+            else:
+                for move in moves:
+                    steps += [["wait", 2], move]
+            return "Doing Patrol", steps
+        # added random escape methods for 30, 50 level chapters
+        if i > _time * .8:
+            return "Escape route #1", [['s', 0.6], ['w', 0.4], ['nw', 2], ['ne', 3], ['s', 0.6], ['e', 0.4],
+                                       ['ne', 2], ['nw', 3]]
+        if i > _time * .6:
+            return "Escape route #2", [['s', .5], ['sw', 2], ['n', 1], ['nw', 2], ['ne', 2], ['s', .5], ['se', 2],
+                                       ['n', 1], ['ne', 2], ['nw', 2]]
+        if i > _time * .4:
+            return "Escape route #3", [['s', .3], ['ne', 1], ['nw', 2], ['s', .3], ['nw', 1], ['ne', 2]]
+        if i > _time * .2:
+            return "Escape route #4", [['sw', 2], ['n', 1], ['ne', 2], ['se', 2], ['w', 1], ['nw', 2], ['ne', 2]]
+        return "Escape route #4", [['se', 2], ['n', 1], ['nw', 2], ['sw', 2], ['n', 2], ['ne', 2], ['nw', 2]]
+
+    def _letPlayPoll(self, check_exp_bar: bool, experience_bar_line):
+        """
+        Checks state, exp bar and doors on a new screen, and tells the poll scheduler if anything changed
+        since last poll (state or exp bar moved, e.g. a monster was killed).
+        """
+        checks = ["state", "exp_changed", "doors"] if check_exp_bar else ["state", "exp_bar", "doors"]
+        analysis = self.screen_connector.analyze(checks=checks, old_exp_bar=experience_bar_line)
+        last = self._last_play_analysis
+        changed = last is None or last.state != analysis.state or \
+                  self.screen_connector.checkExpBarLinesChanged(last.lines["exp_bar"], analysis.lines["exp_bar"])
+        self.poll_scheduler.polled(changed)
+        self._previous_poll_time = None if last is None else last.timestamp
+        self._last_play_analysis = analysis
+        return analysis
+
+    def _letPlayRoomEnded(self, analysis, check_exp_bar: bool) -> bool:
+        """
+        Returns True if exp bar moved or doors are open. Door open time is kept to report time until exit.
+        """
+        if analysis.state != "in_game":
+            return False
+        if check_exp_bar and analysis["exp_changed"]:
+            if self.debug: print("Level ended. Experience gained!")
+            self.log("Gained Experience")
+        elif analysis["doors"]:
+            if self.debug: print("Door is OPEN #%d <---------######" % analysis.doors_variant)
+            self.log("Door %d is Open" % analysis.doors_variant)
+        else:
+            return False
+        self.door_open_time = analysis.timestamp
+        clear_time = analysis.timestamp - self.poll_scheduler.room_start
+        self.poll_scheduler.roomCleared(clear_time)
+        if self._previous_poll_time is not None:
+            print("Room cleared after %.1fs, noticed within %.1fs from previous check (%d checks)" % (
+                clear_time, analysis.timestamp - self._previous_poll_time, self.poll_scheduler.polls))
+        return True
+
+    def _patrolCheck(self, check_exp_bar: bool, experience_bar_line):
+        """
+        Checks the screen if the poll scheduler says so. Returns the analysis if the room ended or not in game
+        anymore, None otherwise.
+        """
+        if not self.poll_scheduler.isDue():
+            return None
+        analysis = self._letPlayPoll(check_exp_bar, experience_bar_line)
+        if analysis.state != "in_game" or self._letPlayRoomEnded(analysis, check_exp_bar):
+            return analysis
+        return None
+
+    def _runPatrol(self, steps: list, check_exp_bar: bool, experience_bar_line):
+        """
+        Plays patrol steps as macros (split at dead checks), checking the screen while they run whenever the
+        poll scheduler says so.
+        Returns the analysis that stopped the patrol (room ended or not in game anymore), None if completed.
+        """
+        def check():
+            return self._patrolCheck(check_exp_bar, experience_bar_line)
+        macro = []
+        for step in steps:
+            if step[0] != "dead_check":
+                macro.append(step)
+                continue
+            if len(macro) > 0:
+                analysis = self.play_macro(macro, check)
+                if analysis is not None:
+                    return analysis
+                macro = []
+            self.checkIfDead()
+            analysis = check()
+            if analysis is not None:
+                return analysis
+        if len(macro) > 0:
+            return self.play_macro(macro, check)
+        return None
+
+    def reportDoorToExit(self):
+        """
+        Reports time from doors open (or exp gained) to room exit, call it once the exit moves are done
+        """
+        if self.door_open_time is None:
+            return
+        self.door_exit_times.append(time.time() - self.door_open_time)
+        self.door_open_time = None
+        mean = sum(self.door_exit_times) / len(self.door_exit_times)
+        print("Door open to exit: %.1fs (mean %.1fs on %d rooms)" % (self.door_exit_times[-1], mean,
+                                                                    len(self.door_exit_times)))
+
     def letPlay(self, _time: int, is_boss = False):
         check_exp_bar = not is_boss
         experience_bar_line = self.screen_connector.getLineExpBar()
@@ -636,203 +890,43 @@ class CaveEngine(QObject):
         self.log("Searching Dungeon")
         if self.deadcheck or self.battle_pass_advanced:
             self.checkIfDead()
+        self.poll_scheduler.startRoom()
+        self.door_open_time = None
+        self._last_play_analysis = None
+        self._previous_poll_time = None
+        # analysis of a check done during last patrol, handled at next loop
+        pending = None
         for i in range(_time, 0, -1):
             if i % self.check_seconds == 0 or recheck:
-                recheck = False                
-                frame = self.screen_connector.getFrame()
-                state = self.screen_connector.getFrameState(frame)
+                recheck = False
+                analysis = pending if pending is not None else self._letPlayPoll(check_exp_bar, experience_bar_line)
+                pending = None
+                state = analysis.state
                 if self.debug: print("Loop Countdown / Kill Timer")
                 if self.debug: print(i)
                 if self.debug: print("Let Play. Checking screen...")
                 if self.debug: print("state: %s" % state)                   
                 if state == "in_game":
-                    # added movement to increase kill enemy efficency for 10 level chapters
-                    if self.currentDungeon == 7 or self.currentDungeon == 14:
-                        if self.debug: print("Avoiding Boss")
-                        self.log("Avoiding Boss")
-                        self.disableLogs = True
-                        if self.deadcheck or self.battle_pass_advanced:
-                            if self.currentLevel > 3:
-                                self.checkIfDead()
-                                self.swipe('sw', 1.5)
-                                self.checkIfDead()
-                                self.swipe('se', 1)
-                                self.checkIfDead()
-                                self.swipe('e', 0.6)
-                                self.checkIfDead()
-                                self.swipe('n', 0.5)
-                                self.checkIfDead()
-                                self.swipe('ne', 1.2)
-                                self.checkIfDead()
-                                self.swipe('w', 0.4)
-                                self.checkIfDead()
-                                self.swipe('ne', 1)
-                                self.checkIfDead()
-                                self.swipe('w', 0.7)
-                                self.checkIfDead()
-                            else:
-                                self.wait(1)
-                                self.swipe('sw', 1.5)
-                                self.wait(1)
-                                self.swipe('se', 1)
-                                self.wait(1)
-                                self.swipe('e', 0.6)
-                                self.swipe('n', 0.5)
-                                self.wait(1)
-                                self.swipe('ne', 1.2)
-                                self.wait(1)
-                                self.swipe('w', 0.4)
-                                self.swipe('ne', 1)
-                                self.wait(1)
-                                self.swipe('w', 0.7)
-                                self.wait(1)  
-                        else:
-                            self.wait(1)
-                            self.swipe('sw', 1.5)
-                            self.wait(1)
-                            self.swipe('se', 1)
-                            self.wait(1)
-                            self.swipe('e', 0.6)
-                            self.swipe('n', 0.5)
-                            self.wait(1)
-                            self.swipe('ne', 1.2)
-                            self.wait(1)
-                            self.swipe('w', 0.4)
-                            self.swipe('ne', 1)
-                            self.wait(1)
-                            self.swipe('w', 0.7)
-                            self.wait(1)
-                        self.disableLogs = False
-                    # added movement to increase kill enemy efficency for 20 level chapters
-                    elif self.currentDungeon == 3 or self.currentDungeon == 6 or self.currentDungeon == 10 or self.currentDungeon == 16 or self.currentDungeon == 18 or self.currentDungeon == 20:
-                        if self.debug: print("Doing patrol")
-                        self.log("Doing Patrol")
-                        self.disableLogs = True
-                        if self.deadcheck or self.battle_pass_advanced:
-                            if self.currentLevel > 4:
-                                self.checkIfDead()
-                                self.swipe('w', 0.35) 
-                                self.checkIfDead()
-                                self.swipe('e', 0.7)
-                                self.checkIfDead()
-                                self.swipe('w', 0.7)
-                                self.checkIfDead()
-                                self.swipe('e', 0.7)
-                                self.checkIfDead()
-                                self.swipe('w', 0.37)
-                                self.checkIfDead()
-                            else:
-                                self.wait(2)
-                                self.swipe('w', 0.35)
-                                self.wait(2)
-                                self.swipe('e', 0.7)
-                                self.wait(2)
-                                self.swipe('w', 0.7)
-                                self.wait(2)
-                                self.swipe('e', 0.7)
-                                self.wait(2)
-                                self.swipe('w', 0.37)
-                        else:
-                            self.wait(2)
-                            self.swipe('w', 0.35)
-                            self.wait(2)
-                            self.swipe('e', 0.7)
-                            self.wait(2)
-                            self.swipe('w', 0.7)
-                            self.wait(2)
-                            self.swipe('e', 0.7)
-                            self.wait(2)
-                            self.swipe('w', 0.37)
-                        self.disableLogs = False
-                    # added random escape methods for 30, 50 level chapters
-                    else:
-                        if i > _time * .8:
-                                if self.debug: print("Let-Play. Time < 100%")
-                                self.log("Escape route #1")
-                                self.disableLogs = True
-                                self.swipe('s', 0.6)
-                                self.swipe('w', 0.4)
-                                self.swipe('nw', 2)
-                                self.swipe('ne', 3)
-                                self.swipe('s', 0.6)
-                                self.swipe('e', 0.4)
-                                self.swipe('ne', 2)
-                                self.swipe('nw', 3)
-                                self.disableLogs = False
-                        if _time * .6 < i <= _time * .8:
-                                if self.debug: print("Let-Play. Time < 80%")
-                                self.log("Escape route #2")
-                                self.disableLogs = True
-                                self.swipe('s', .5)
-                                self.swipe('sw', 2)
-                                self.swipe('n', 1)
-                                self.swipe('nw', 2)
-                                self.swipe('ne', 2)
-                                self.swipe('s', .5)
-                                self.swipe('se', 2)
-                                self.swipe('n', 1)
-                                self.swipe('ne', 2)
-                                self.swipe('nw', 2)
-                                self.disableLogs = False
-                        if _time * .4 < i <= _time * .6:
-                                if self.debug: print("Let-Play. Time < 60%")
-                                self.log("Escape route #3")
-                                self.disableLogs = True
-                                self.swipe('s', .3)
-                                self.swipe('ne', 1)
-                                self.swipe('nw', 2)
-                                self.swipe('s', .3)
-                                self.swipe('nw', 1)
-                                self.swipe('ne', 2)
-                                self.disableLogs = False
-                        if _time * .2 < i <= _time * .4:
-                                if self.debug: print("Let-Play. Time < 40%")
-                                self.log("Escape route #4")
-                                self.disableLogs = True
-                                self.swipe('sw', 2)
-                                self.swipe('n', 1)
-                                self.swipe('ne', 2)
-                                self.swipe('se', 2)
-                                self.swipe('w', 1)
-                                self.swipe('nw', 2)
-                                self.swipe('ne', 2)
-                                self.disableLogs = False
-                        if i <= _time * .2:
-                                if self.debug: print("Let-Play. Time < 20%")
-                                self.log("Escape route #4")
-                                self.disableLogs = True
-                                self.swipe('se', 2)
-                                self.swipe('n', 1)
-                                self.swipe('nw', 2)
-                                self.swipe('sw', 2)
-                                self.swipe('n', 2)
-                                self.swipe('ne', 2)
-                                self.swipe('nw', 2)
-                                self.disableLogs = False
                     if self.debug: print("Start. Exp & Door Checks")
-                    if check_exp_bar and self.screen_connector.checkExpBarHasChanged(experience_bar_line, frame):
-                        if self.debug: print("Level ended. Experience gained!")
-                        self.log("Gained Experience")
-                        return
-                    elif self.screen_connector.checkDoorsOpen(frame):
-                        if self.debug: print("Door is OPEN #1 <---------######")
-                        self.log("Door 1 is Open")
+                    if self._letPlayRoomEnded(analysis, check_exp_bar):
                         return
-                    elif self.screen_connector.checkDoorsOpen1(frame):
-                        if self.debug: print("Door is OPEN #2 <---------######")
-                        self.log("Door 2 is Open")
-                        return
-                    elif self.screen_connector.checkDoorsOpen2(frame):
-                        if self.debug: print("Door is OPEN #3 <---------######")
-                        self.log("Door 3 is Open")
-                        return
-                    else:
-                        if i <= _time * .75:
-                            self.disableLogs = True
-                            if self.debug: print("Moving closer to door")
-                            self.swipe('n', .1)
-                            self.disableLogs = False
-                        if self.debug: print("Still playing but level not ended")
+                    patrol_name, steps = self._getPatrolSteps(i, _time)
+                    if self.debug: print(patrol_name)
+                    self.log(patrol_name)
+                    self.disableLogs = True
+                    pending = self._runPatrol(steps, check_exp_bar, experience_bar_line)
+                    self.disableLogs = False
+                    if pending is not None:
+                        if pending.state == "in_game":
+                            return # room ended during patrol
+                        recheck = True
+                        continue
+                    if i <= _time * .75:
+                        self.disableLogs = True
+                        if self.debug: print("Moving closer to door")
+                        self.swipe('n', .1)
+                        self.disableLogs = False
+                    if self.debug: print("Still playing but level not ended")
                     if self.debug: print("End. Exp & Door Checks")
                 else:
                     if self.debug: print("State Checks Start")                    
@@ -1027,6 +1121,7 @@ class CaveEngine(QObject):
             self.wait(2)
             self.restartStatus = False
 
+    @timed
     def intro_lvl(self):
         if self.debug: print("Getting Start Items")
         self.wait(10) # inital wait for ability wheel to load
@@ -1044,6 +1139,7 @@ class CaveEngine(QObject):
         self.log("Entering Dungeon!")
         self.wait(0.5) # for GUI log to load
 
+    @timed
     def normal_lvl(self):
         if self.debug: print("normal_lvl")
         self.crash_level_restart()
@@ -1051,7 +1147,9 @@ class CaveEngine(QObject):
         self.letPlay(self.playtime)
         self.reactGamePopups()
         self.exit_dungeon_uncentered()
+        self.reportDoorToExit()
 
+    @timed
     def heal_lvl(self):
         if self.debug: print("heal_lvl")
         if self.healingStrategy == HealingStrategy.SmartHeal:
@@ -1085,6 +1183,7 @@ class CaveEngine(QObject):
         self.log("Left Dungeon")
         self.wait(0.5) # for GUI log to load
 
+    @timed
     def boss_lvl(self):
         if self.debug: print("boss_lvl")
         self.crash_level_restart()
@@ -1141,6 +1240,7 @@ class CaveEngine(QObject):
                 self.swipe('nw', 0.6)
         self.disableLogs = False
         self.exit_dungeon_uncentered()
+        self.reportDoorToExit()
 
     def checkIfDead(self):
         if self.debug: print("Started Dead Check")
@@ -1158,6 +1258,7 @@ class CaveEngine(QObject):
             print("You revived with Gems.")
             self.wait(.5)
 
+    @timed
     def boss_final(self):
         if self.debug: print("boss_final")
         self.crash_level_restart()
@@ -1244,7 +1345,7 @@ class CaveEngine(QObject):
             self.disableLogs = False
             self.log("Left Dungeon!")
         i = 0
-        self.wait(8) # wait for endgame loot screen to load
+        self.wait_for_state(["endgame", "repeat_endgame_question"], 8) # wait for endgame loot screen to load
         state = self.screen_connector.getFrameState()
         if state == "in_game":
             print("Exception. Still in_game; let's try to escape")
@@ -1374,32 +1475,32 @@ class CaveEngine(QObject):
             if state == "game_not_responding":
                 print("Closing Game to Restart")
                 self.tap("game_not_respond_ok")
-                self.wait(10)            
+                self.wait_for_state(["crash_desktop_open"], 10)
             if state == "menu_talents" or state == "menu_events":
                 print("Changing to World Menu")
                 self.tap("menu_world_left")
-                self.wait(2)
+                self.wait_for_state(["menu_home"], 2)
             elif state == "menu_equip" or state == "menu_shop":
                 print("Changing to World Menu")
                 self.tap("menu_world_right")
-                self.wait(2)
+                self.wait_for_state(["menu_home"], 2)
             elif state == "monster_farm_home":
                 print("Change to World Menu")
                 self.tap("farm_back")
-                self.wait(6)
+                self.wait_for_state(["menu_home"], 6)
             elif state == "menu_expedition":
                 print("Change to World Menu")
                 self.tap("farm_back")
-                self.wait(6)
+                self.wait_for_state(["menu_home"], 6)
             elif state == "crash_desktop_open":
                 self.changeStartStatus(self.startStatus + 1) # Crash-Desktop
                 self.restartStatus = True
                 print("Opening Game Now")
                 self.tap("open_game")
-                self.wait(90)
+                self.wait_for_state(self.loaded_game_states, 90)
             if state == "crash_load_screen_1" or state == "crash_load_screen_2":
-                print("Not Loaded Yet, waiting 60 more")
-                self.wait(60)
+                print("Not Loaded Yet, waiting up to 60 more")
+                self.wait_for_state(self.loaded_game_states, 60)
             if self.currentLevel > 0:
                 if self.screen_connector.checkFrame('menu_home'):
                     if self.debug: print("Home Menu detected... setting to lvl 0 now.")
@@ -1417,6 +1518,7 @@ class CaveEngine(QObject):
             print("New game. Starting from level %d" % self.currentLevel)
             try:
                 self.start_date = datetime.now()
+                self.timings.startGame()
                 self.screen_connector.stopRequested = False
                 if self.currentLevel == 0:
                     if state == 'in_game':
@@ -1434,6 +1536,7 @@ class CaveEngine(QObject):
                 elif exc.args[0] == "crashdesktop":
                     self.changeEndStatus(self.endStatus + 2) # Crash-Desktop
                     self.runStatiscticsSave()
+                    self.saveSessionSnapshot("crashdesktop")
                     print("Exception. Crash Desktop, restarting now.")
                     self.log("Preparing to rest game")
                 elif exc.args[0] == "altendgame":
@@ -1442,6 +1545,7 @@ class CaveEngine(QObject):
                 elif exc.args[0] == "unknown_screen_state":
                     self.changeEndStatus(self.endStatus + 3) # Screen-Unknown
                     self.runStatiscticsSave()
+                    self.saveSessionSnapshot("unknown_screen_state")
                     state = self.screen_connector.getFrameState()
                     print("state: %s" % state)
                     print("Exception. Unknown State, restarting now.")
@@ -1451,6 +1555,7 @@ class CaveEngine(QObject):
                 else:
                     self.changeEndStatus(self.endStatus + 4) # Exception-Unknown
                     self.runStatiscticsSave()
+                    self.saveSessionSnapshot("exception")
                     print("Exception. Unknown problem: %s" % exc)
                     self.log("Unknown Problem... halp!")
                     self.exitEngine()
@@ -1465,6 +1570,8 @@ class CaveEngine(QObject):
     def runStatiscticsSave(self):
         if self.debug: print("*** Saving Game Statistics ***")
         self.statisctics_manager.saveOneGame(self.start_date, self.stat_lvl_start, self.currentLevel, self.currentDungeon, self.startStatus, self.endStatus)
+        if self.timings.enabled:
+            self.statisctics_manager.saveGameTimings(self.start_date, self.timings.dumpGame())
 
     def checkForEnergy(self):
         energy_check = True
@@ -1510,10 +1617,10 @@ class CaveEngine(QObject):
                     self.disableLogs = True
                     self.tap('farm_open')
                     self.wait(6) # wait for farm open
-                    frame = self.screen_connector.getFrame()
-                    if self.screen_connector.checkFrame("monster_farm_visit", frame) or self.screen_connector.checkFrame("monster_farm_visit_free", frame):
+                    farm = self.screen_connector.analyze(checks=["monster_farm_visit", "monster_farm_visit_free"])
+                    if farm["monster_farm_visit"] or farm["monster_farm_visit_free"]:
                         print("xxxxxxxxxxxxxxx Monster Farm Energy xxxxxxxxxxxxxx")
-                        if self.screen_connector.checkFrame("monster_farm_visit_free", frame):
+                        if farm["monster_farm_visit_free"]:
                             self.tap('farm_visit')
                             self.wait(4) # wait for farm load
                         self.tap('farm_visit')
@@ -1536,7 +1643,7 @@ class CaveEngine(QObject):
                         self.wait(2) # wait for energy close
                         i = 1
                         while i < 3:
-                            frame = self.screen_connector.getFrame()
+                            frame = self.screen_connector.getRoiFrame()
                             if self.screen_connector.checkFrame("monster_farm_visit_again", frame):
                                 print("xxxxxxxxxxxx Monster Farm Energy Again xxxxxxxxxxx")
                                 self.tap('farm_visit_again')
@@ -1611,55 +1718,57 @@ class CaveEngine(QObject):
         self.log("Please wait")
         self.log("Checks are running")
         if self.debug: print("Start-Game. Checking screen...")
-        state = self.screen_connector.getFrameState()
-        print("Ads state: %s" % state)
+        ads_checks = ["game_announcement", "legendary_challenge", "popup_new_season", "popup_home_patrol",
+                      "btn_home_time_reward", "popup_vip_rewards", "popup_need_this", "popup_need_this_1",
+                      "popup_need_this_2", "popup_welcome_back", "time_prize", "crash_continue_yes"]
+        ads = self.screen_connector.analyze(checks=["state"] + ads_checks)
+        print("Ads state: %s" % ads.state)
         ui_changed = False
-        frame = self.screen_connector.getFrame()
         print("Checking for Announcement")
-        if self.screen_connector.checkFrame("game_announcement", frame):
+        if ads["game_announcement"]:
             print("Closing Announcement")
             self.tap("close_announcement")
-            self.wait(4)
+            self.wait_for_state(["menu_home"], 4)
             ui_changed = True
-        frame = self.screen_connector.getFrame() if ui_changed else frame
+        ads = self.screen_connector.analyze(checks=ads_checks) if ui_changed else ads
         ui_changed = False
         print("Checking for Legendary_Challenge")
-        if self.screen_connector.checkFrame("legendary_challenge", frame):
+        if ads["legendary_challenge"]:
             print("Okay to new Legendary Challenge")
             self.tap("close_legendary_challenge")
-            self.wait(4)
+            self.wait_for_state(["menu_home"], 4)
             ui_changed = True
-        frame = self.screen_connector.getFrame() if ui_changed else frame
+        ads = self.screen_connector.analyze(checks=ads_checks) if ui_changed else ads
         ui_changed = False
         print("Checking for New_Season")
-        if self.screen_connector.checkFrame("popup_new_season", frame):
+        if ads["popup_new_season"]:
             print("Okay to New Season. Update BPAdv dropdown in GUI to False")
             self.tap("close_new_season")
             self.battle_pass_advanced = False # only works once manully set dropdown in GUI to False
-            self.wait(4)
+            self.wait_for_state(["menu_home"], 4)
             ui_changed = True
-        frame = self.screen_connector.getFrame() if ui_changed else frame
+        ads = self.screen_connector.analyze(checks=ads_checks) if ui_changed else ads
         ui_changed = False
         print("Checking for patrol_reward")
-        if self.screen_connector.checkFrame("popup_home_patrol", frame):
+        if ads["popup_home_patrol"]:
             print("Collecting time patrol")
             self.tap("collect_hero_patrol")
             self.wait(6)
             self.tap("collect_hero_patrol")# click again somewhere to close popup with token things
             ui_changed = True
-        frame = self.screen_connector.getFrame() if ui_changed else frame
+        ads = self.screen_connector.analyze(checks=ads_checks) if ui_changed else ads
         ui_changed = False
         print("Checking for patrol_close")
-        if self.screen_connector.checkFrame("btn_home_time_reward", frame):
+        if ads["btn_home_time_reward"]:
             print("Closing patrol_close")
             self.tap("close_hero_patrol")
-            self.wait(4)
+            self.wait_for_state(["menu_home"], 4)
             ui_changed = True
         if self.vip_priv_rewards:
-            frame = self.screen_connector.getFrame() if ui_changed else frame
+            ads = self.screen_connector.analyze(checks=ads_checks) if ui_changed else ads
             ui_changed = False
             print("Checking for vip_reward_1")
-            if self.screen_connector.checkFrame("popup_vip_rewards", frame):
+            if ads["popup_vip_rewards"]:
                 print("Reset Energy Count") # Reset Energy Count Every 24 Hours
                 self.energy_count = 1
                 print("Collecting VIP-Privilege Rewards 1")
@@ -1667,75 +1776,75 @@ class CaveEngine(QObject):
                 self.tap("collect_vip_rewards")
                 self.wait(6)
                 self.tap("close_vip_rewards")
-                self.wait(4)
+                self.wait_for_state(["menu_home"], 4)
                 ui_changed = True
-            frame = self.screen_connector.getFrame() if ui_changed else frame
+            ads = self.screen_connector.analyze(checks=ads_checks) if ui_changed else ads
             ui_changed = False
             print("Checking for vip_reward_2")
-            if self.screen_connector.checkFrame("popup_vip_rewards", frame):
+            if ads["popup_vip_rewards"]:
                 print("Collecting VIP-Privilege Rewards 2")
                 self.log("VIP-Privilege Rewards 2")
                 self.tap("collect_vip_rewards")
                 self.wait(6)
                 self.tap("close_vip_rewards")
-                self.wait(4)
+                self.wait_for_state(["menu_home"], 4)
                 ui_changed = True
-        frame = self.screen_connector.getFrame() if ui_changed else frame
+        ads = self.screen_connector.analyze(checks=ads_checks) if ui_changed else ads
         ui_changed = False
         print("Checking for need_this")
-        if self.screen_connector.checkFrame("popup_need_this", frame):
+        if ads["popup_need_this"]:
             print("Rejecting Must Need Ad 0")
             self.tap("close_need_this")
-            self.wait(4)
+            self.wait_for_state(["menu_home"], 4)
             ui_changed = True
-        frame = self.screen_connector.getFrame() if ui_changed else frame
+        ads = self.screen_connector.analyze(checks=ads_checks) if ui_changed else ads
         ui_changed = False
         print("Checking for need_this_1")
-        if self.screen_connector.checkFrame("popup_need_this_1", frame):
+        if ads["popup_need_this_1"]:
             print("Rejecting Must Need Ad 1")
             self.tap("close_need_this")
-            self.wait(4)
+            self.wait_for_state(["menu_home"], 4)
             ui_changed = True
-        frame = self.screen_connector.getFrame() if ui_changed else frame
+        ads = self.screen_connector.analyze(checks=ads_checks) if ui_changed else ads
         ui_changed = False
         print("Checking for need_this_2")
-        if self.screen_connector.checkFrame("popup_need_this_2", frame):
+        if ads["popup_need_this_2"]:
             print("Rejecting Must Need Ad 2")
             self.tap("close_need_this_2")
-            self.wait(4)
+            self.wait_for_state(["menu_home"], 4)
             ui_changed = True
-        frame = self.screen_connector.getFrame() if ui_changed else frame
+        ads = self.screen_connector.analyze(checks=ads_checks) if ui_changed else ads
         ui_changed = False
         print("Checking for welcome_back")
-        if self.screen_connector.checkFrame("popup_welcome_back", frame):
+        if ads["popup_welcome_back"]:
             print("Rejecting Welcome Back Ad")
             self.tap("close_need_this")
-            self.wait(4)
+            self.wait_for_state(["menu_home"], 4)
             ui_changed = True
-        frame = self.screen_connector.getFrame() if ui_changed else frame
+        ads = self.screen_connector.analyze(checks=ads_checks) if ui_changed else ads
         ui_changed = False
         print("Checking for time_prize")
-        if self.screen_connector.checkFrame("time_prize", frame):
+        if ads["time_prize"]:
             print("Collecting time prize")
             self.tap("collect_time_prize")
             self.wait(5)
             self.tap("resume")
             self.wait(2)
             ui_changed = True
-        frame = self.screen_connector.getFrame() if ui_changed else frame
+        ads = self.screen_connector.analyze(checks=ads_checks) if ui_changed else ads
         ui_changed = False
         print("Checking for Contine Game")
-        if self.screen_connector.checkFrame("crash_continue_yes", frame):
+        if ads["crash_continue_yes"]:
             print("Resuming Previous Game")
             self.tap("continue_yes")
-            self.wait(10)
+            self.wait_for_state(["in_game"], 10)
             ui_changed = True
 
     def chooseCave(self):
         if self.debug: print("Choosing Cave Start")
         self.log("Main Menu")
         self.tap('start')
-        self.wait(6) # wait for no_raid button to load
+        self.wait_for_state(["quick_raid_option", "start_with_raid", "start_with_raid_empty"], 6) # wait for no_raid button to load
         if self.debug: print("Checking for raid options")
         if not self.screen_connector.checkFrame("quick_raid_option"):
             if self.debug: print("No Quick Raid Option, win 5 times first")
@@ -1760,6 +1869,7 @@ class CaveEngine(QObject):
                 if self.debug: print("***********************************")
                 print("Level %d: %s" % (self.currentLevel, str(levels_type[self.currentLevel].name)))
                 if self.debug: print("***********************************")
+                self.timings.startLevel(self.currentLevel)
                 if levels_type[self.currentLevel] == DungeonLevelType.Intro:
                     self.intro_lvl()
                 elif levels_type[self.currentLevel] == DungeonLevelType.Normal:
@@ -1771,6 +1881,7 @@ class CaveEngine(QObject):
                 elif levels_type[self.currentLevel] == DungeonLevelType.Boss:
                     self.boss_lvl()
                 self.changeCurrentLevel(self.currentLevel + 1)
+            self.timings.startLevel(None)
             self._manage_exit_from_endgame()
             
     def _manage_exit_from_endgame(self):
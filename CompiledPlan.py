@@ -0,0 +1,216 @@
+import os
+import json
+import hashlib
+import threading
+import numpy as np
+
+from Frame import Frame
+from StaticCoordsChecker import StaticCoordsChecker
+from Utils import loadJsonData, buildDataFolder, getCoordFilePath
+
+"""
+Everything GameScreenConnector needs for a screen size, built once from datas/ files:
+coordinates dictionaries, compiled static coords checkers, horizontal lines slices and templates arrays.
+It is cached in memory and on disk (datas/<WxH>/cache) and rebuilt only when a source file changes.
+"""
+
+abilities_fns_path = os.path.join("datas", "abilities", "abilities_templates_fns.json")
+abilities_folder = os.path.join("datas", "abilities", "abilities_templates")
+general_templates_path = os.path.join("datas", "general", "general_templates.json")
+general_folder = os.path.join("datas", "general", "general_templates")
+
+# size folder -> CompiledPlan already loaded by this process
+_loaded_plans = {}
+# engines of several devices can load plans at the same time: each plan is built once
+_loaded_plans_lock = threading.Lock()
+
+
+def load_abilities_templates() -> dict:
+    with open(abilities_fns_path) as file_in:
+        abs_json = json.load(file_in)
+    abilities = {}
+    for ab, fn in abs_json.items():
+        abilities[ab] = Frame.fromFile(os.path.join(abilities_folder, fn)).pixels
+    return abilities
+
+
+def load_general_templates() -> dict:
+    with open(general_templates_path) as file_in:
+        gen_json = json.load(file_in)
+    templates = {}
+    for ab, v in gen_json.items():
+        templates[ab] = v
+        templates[ab]["template"] = Frame.fromFile(os.path.join(general_folder, v["fn"])).pixels
+    return templates
+
+
+def abilityFingerprint(pixels: np.ndarray, block: int = 8) -> np.ndarray:
+    """
+    Downsamples (..., H, W, 4) images to the means of block x block squares (borders not filling a block are
+    dropped) and flattens them. Sum of absolute differences between two fingerprints, times block*block,
+    is a lower bound of the full resolution sum of absolute differences.
+    """
+    h, w = pixels.shape[-3] // block, pixels.shape[-2] // block
+    covered = pixels[..., :h * block, :w * block, :]
+    blocks = covered.reshape(covered.shape[:-3] + (h, block, w, block, 4))
+    means = blocks.mean(axis=(-4, -2), dtype=np.float64)
+    return means.reshape(means.shape[:-3] + (-1,))
+
+
+def getLineSlice(line, width: int, height: int) -> tuple:
+    """
+    Returns (start, size) of a [x1, y1, x2, y2] normalized horizontal line inside a flat frame
+    """
+    x1, y1, x2 = line[0] * width, line[1] * height, line[2] * width
+    return int(y1 * width + x1), int(x2 - x1)
+
+
+class CompiledPlan(object):
+    def __init__(self, width: int, height: int):
+        self.width, self.height = width, height
+        self.signature = ""
+        self.static_coords = {}
+        self.specific_checks_coords = {}
+        self.hor_lines = {}
+        self.states_checker: StaticCoordsChecker = None
+        self.specific_checker: StaticCoordsChecker = None
+        # line name -> (start, size) in flat frame
+        self.line_slices = {}
+        # One (239, 239, 4) uint8 image for each different template file, stacked in one contiguous tensor.
+        # abilities_names[i] is the first ability name using image i
+        self.abilities_fns = {}
+        self.abilities_files = []
+        self.abilities_names = []
+        self.abilities_stack = np.zeros((0, 0, 0, 4), dtype=np.uint8)
+        # ability name -> view of its image in abilities_stack
+        self.abilities_templates = {}
+        # (templates, features) downsampled images, for a fast shortlist before the full comparison
+        self.abilities_fingerprint_block = 8
+        self.abilities_fingerprints = np.zeros((0, 0))
+        self.general_templates = {}
+
+    @staticmethod
+    def cachePath(width: int, height: int) -> str:
+        return os.path.join("datas", buildDataFolder(width, height), "cache", "compiled_plan.npz")
+
+    @staticmethod
+    def sourceFiles(width: int, height: int) -> list:
+        files = [getCoordFilePath(name, size=(width, height)) for name in
+                 ["static_coords.json", "static_specific_coords.json", "hor_lines.json"]]
+        files += [abilities_fns_path, general_templates_path]
+        files += [os.path.join(abilities_folder, fn) for fn in sorted(os.listdir(abilities_folder))]
+        files += [os.path.join(general_folder, fn) for fn in sorted(os.listdir(general_folder))]
+        return files
+
+    @staticmethod
+    def computeSignature(width: int, height: int) -> str:
+        """
+        Hash of path, size and modification time of every source file
+        """
+        sha = hashlib.sha1()
+        for path in CompiledPlan.sourceFiles(width, height):
+            st = os.stat(path)
+            sha.update(("%s|%d|%d;" % (path, st.st_size, st.st_mtime_ns)).encode('utf-8'))
+        return sha.hexdigest()
+
+    @staticmethod
+    def build(width: int, height: int):
+        plan = CompiledPlan(width, height)
+        plan.signature = CompiledPlan.computeSignature(width, height)
+        plan.static_coords = loadJsonData(getCoordFilePath("static_coords.json", size=(width, height)))
+        plan.specific_checks_coords = loadJsonData(getCoordFilePath("static_specific_coords.json", size=(width, height)))
+        plan.hor_lines = loadJsonData(getCoordFilePath("hor_lines.json", size=(width, height)))
+        plan.states_checker = StaticCoordsChecker(plan.static_coords, width, height)
+        plan.specific_checker = StaticCoordsChecker(plan.specific_checks_coords, width, height)
+        plan.line_slices = {k: getLineSlice(v, width, height) for k, v in plan.hor_lines.items()}
+        abilities_fns = loadJsonData(abilities_fns_path)
+        files = list(dict.fromkeys(abilities_fns.values()))
+        stack = np.stack([Frame.fromFile(os.path.join(abilities_folder, fn)).pixels for fn in files])
+        plan._setAbilities(abilities_fns, files, stack)
+        plan.general_templates = load_general_templates()
+        return plan
+
+    def _setAbilities(self, abilities_fns: dict, files: list, stack: np.ndarray):
+        self.abilities_fns = abilities_fns
+        self.abilities_files = files
+        self.abilities_stack = np.ascontiguousarray(stack)
+        file_ids = {fn: i for i, fn in enumerate(files)}
+        self.abilities_names = [None for _ in files]
+        for name, fn in abilities_fns.items():
+            if self.abilities_names[file_ids[fn]] is None:
+                self.abilities_names[file_ids[fn]] = name
+        self.abilities_templates = {name: self.abilities_stack[file_ids[fn]] for name, fn in abilities_fns.items()}
+        self.abilities_fingerprints = abilityFingerprint(self.abilities_stack, self.abilities_fingerprint_block)
+
+    def save(self, path: str):
+        folder = os.path.dirname(path)
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+        arrays = {}
+        arrays.update(self.states_checker.toArrays("states_"))
+        arrays.update(self.specific_checker.toArrays("specific_"))
+        general_meta = {}
+        for name, v in self.general_templates.items():
+            general_meta[name] = {k: val for k, val in v.items() if k != "template"}
+            arrays["general_" + name] = v["template"]
+        meta = {"signature": self.signature, "size": [self.width, self.height],
+                "static_coords": self.static_coords, "specific_checks_coords": self.specific_checks_coords,
+                "hor_lines": self.hor_lines, "line_slices": self.line_slices,
+                "abilities_fns": self.abilities_fns, "abilities_files": self.abilities_files,
+                "general_templates": general_meta}
+        arrays["meta"] = np.array(json.dumps(meta))
+        arrays["abilities_stack"] = self.abilities_stack
+        # write and rename, so a crash never leaves a half written cache
+        tmp_path = path + ".tmp.npz"
+        np.savez(tmp_path, **arrays)
+        os.replace(tmp_path, path)
+
+    @staticmethod
+    def load(path: str):
+        with np.load(path, allow_pickle=False) as arrays:
+            meta = json.loads(str(arrays["meta"]))
+            plan = CompiledPlan(meta["size"][0], meta["size"][1])
+            plan.signature = meta["signature"]
+            plan.static_coords = meta["static_coords"]
+            plan.specific_checks_coords = meta["specific_checks_coords"]
+            plan.hor_lines = meta["hor_lines"]
+            plan.line_slices = {k: tuple(v) for k, v in meta["line_slices"].items()}
+            plan.states_checker = StaticCoordsChecker.fromArrays(arrays, "states_")
+            plan.specific_checker = StaticCoordsChecker.fromArrays(arrays, "specific_")
+            plan._setAbilities(meta["abilities_fns"], meta["abilities_files"], arrays["abilities_stack"])
+            for name, v in meta["general_templates"].items():
+                plan.general_templates[name] = v
+                plan.general_templates[name]["template"] = arrays["general_" + name]
+        return plan
+
+
+def loadCompiledPlan(width: int, height: int) -> CompiledPlan:
+    """
+    Returns the compiled plan of given screen size: from memory if this process already loaded it,
+    otherwise from disk cache. It is built (and cached) again if any source file changed.
+    Plans are shared by all GameScreenConnector of the process (read only).
+    """
+    with _loaded_plans_lock:
+        folder = buildDataFolder(width, height)
+        signature = CompiledPlan.computeSignature(width, height)
+        plan = _loaded_plans.get(folder)
+        if plan is not None and plan.signature == signature:
+            return plan
+        path = CompiledPlan.cachePath(width, height)
+        plan = None
+        if os.path.exists(path):
+            try:
+                plan = CompiledPlan.load(path)
+            except Exception as e:
+                print("Unable to load compiled plan %s: %s. Building it again" % (path, str(e)))
+                plan = None
+            if plan is not None and plan.signature != signature:
+                plan = None
+        if plan is None:
+            plan = CompiledPlan.build(width, height)
+            try:
+                plan.save(path)
+            except Exception as e:
+                print("Unable to save compiled plan %s: %s" % (path, str(e)))
+        _loaded_plans[folder] = plan
+        return plan
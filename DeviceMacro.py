@@ -0,0 +1,99 @@
+import socket
+import threading
+import time
+
+from WorkerThread import WorkerThread
+
+
+class DeviceMacro(object):
+    """
+    A list of shell commands (input swipes, sleeps...) run on device as a single script over one adb connection,
+    so there is no round trip nor timing jitter between them. It can be aborted while running.
+    """
+    done_marker = b"__archero_bot_macro_done__"
+
+    def __init__(self, device_connector, commands: list):
+        self.device_connector = device_connector
+        self.commands = commands
+        # script pid first, so the script can be killed. Commands contain no quotes
+        self.script = "echo $$; %s; echo %s" % ("; ".join(commands), self.done_marker.decode())
+        self.pid = None
+        self.completed = False
+        self.aborted = False
+        self.start_time = None
+        self.end_time = None
+        self.abort_timeout = 5.0 # seconds abort waits for the running command to end before closing the connection
+        self._pid_read = threading.Event()
+        self._done = threading.Event()
+        self._conn = None
+        self._thread = None
+
+    def start(self):
+        conn = self.device_connector.my_device.create_connection()
+        conn.send("exec:sh -c '%s'" % self.script)
+        self._conn = conn
+        self.start_time = time.time()
+        self._thread = WorkerThread()
+        self._thread.daemon = True
+        self._thread.function = self._read
+        self._thread.start()
+
+    def isDone(self) -> bool:
+        return self._done.is_set()
+
+    def wait(self, timeout: float = None) -> bool:
+        return self._done.wait(timeout)
+
+    def abort(self):
+        """
+        Kills the script shell on device, so no further command starts. The running command ends normally (a
+        killed swipe would leave its touch held): abort returns once it ended, at most abort_timeout seconds later.
+        """
+        if self._done.is_set():
+            return
+        self.aborted = True
+        # the pid is the first output of the script, a just started macro may not have sent it yet
+        self._pid_read.wait(1.0)
+        if self.pid is not None:
+            try:
+                self.device_connector.adb_shell("kill %d" % self.pid)
+            except Exception as e:
+                print("Unable to kill macro on device: %s" % str(e))
+            # the running command holds the script output: the connection ends with it
+            if self._done.wait(self.abort_timeout):
+                return
+        conn = self._conn
+        if conn is not None:
+            # unlocks the blocking read of the macro thread (close alone does not)
+            try:
+                conn.socket.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+        self._done.wait(5)
+
+    def _read(self):
+        data = b""
+        try:
+            while True:
+                chunk = self._conn.socket.recv(4096)
+                if not chunk:
+                    break
+                data += chunk
+                if self.pid is None and b"\n" in data:
+                    self.pid = int(data.split(b"\n", 1)[0].strip())
+                    self._pid_read.set()
+                if self.done_marker in data:
+                    self.completed = True
+                    break
+        except Exception as e:
+            if not self.aborted:
+                print("Macro stopped: %s" % str(e))
+        finally:
+            try:
+                self._conn.close()
+            except Exception:
+                pass
+            self._pid_read.set()
+            self.end_time = time.time()
+            self.device_connector.last_input_time = self.end_time
+            self._done.set()
@@ -0,0 +1,171 @@
+import time
+
+from AnalysisPool import AnalysisPool
+from CaveDungeonEngine import CaveEngine
+from DeviceTracker import DeviceTracker
+from WorkerThread import WorkerThread
+
+
+class DeviceManager(object):
+    """
+    Farms several devices from one process: each serial listed by adb gets its own CaveEngine (with its own
+    UsbConnector bound to that serial) played in its own worker thread. A single DeviceTracker follows the devices
+    for the manager and all the engines connectors.
+    Read only data (compiled coords, templates, abilities tier list) is loaded once and shared by all engines.
+    Screens of all devices are decoded and analyzed in a shared AnalysisPool of processes.
+    """
+
+    def __init__(self, analysis_processes: int = None):
+        self.debug = True # set False to stop print debug messages in console
+        # analysis_processes None uses one process for each core, 0 analyzes screens in each engine thread
+        self.analysis_pool = None if analysis_processes == 0 else AnalysisPool(analysis_processes)
+        self.engines = {} # serial -> CaveEngine
+        self.workers = {} # serial -> WorkerThread playing that engine
+        self.starts = {} # serial -> times farming was started by this manager
+        self.device_tracker = DeviceTracker()
+        self.device_tracker.start()
+
+    def refreshDevices(self) -> list:
+        """
+        Adds an engine for each new device serial and removes (after stopping it) the engine of each serial no more
+        listed by adb. Returns serials of added devices.
+        """
+        # offline or unauthorized devices keep their engine: they often come back soon
+        tracked = self.device_tracker.devices
+        for serial in self.getSerials():
+            if serial not in tracked:
+                if self.debug: print("Device %s detached" % serial)
+                self.removeDevice(serial)
+        added = []
+        for serial in self.device_tracker.getDevices():
+            if serial not in self.engines:
+                self.addDevice(serial)
+                added.append(serial)
+        return added
+
+    def addDevice(self, serial: str) -> CaveEngine:
+        if serial in self.engines:
+            return self.engines[serial]
+        if self.debug: print("Adding device %s" % serial)
+        engine = CaveEngine(serial=serial, device_tracker=self.device_tracker)
+        if self.analysis_pool is not None:
+            self.analysis_pool.start()
+            engine.screen_connector.analysis_pool = self.analysis_pool
+        self.engines[serial] = engine
+        self.starts[serial] = 0
+        return engine
+
+    def removeDevice(self, serial: str):
+        if serial not in self.engines:
+            return
+        self.stop(serial)
+        engine = self.engines.pop(serial)
+        self.workers.pop(serial, None)
+        self.starts.pop(serial, None)
+        engine.device_connector.stopConnectionCheck()
+        engine.device_connector.disconnect()
+
+    def getSerials(self) -> list:
+        return list(self.engines.keys())
+
+    def isPlaying(self, serial: str) -> bool:
+        worker = self.workers.get(serial)
+        return worker is not None and worker.is_alive()
+
+    def start(self, serial: str) -> bool:
+        """
+        Starts farming on the device. Returns False if it is not connected or already playing.
+        """
+        engine = self.engines[serial]
+        if self.isPlaying(serial):
+            if self.debug: print("Device %s is already playing" % serial)
+            return False
+        if not engine.device_connector.connected:
+            if self.debug: print("Device %s is not connected" % serial)
+            return False
+        engine.setStartRequested()
+        worker = WorkerThread()
+        worker.daemon = True
+        worker.function = engine.start_infinite_play
+        self.workers[serial] = worker
+        self.starts[serial] += 1
+        worker.start()
+        if self.debug: print("Device %s started" % serial)
+        return True
+
+    def pause(self, serial: str):
+        self._end(serial, self.engines[serial].setPauseRequested)
+
+    def stop(self, serial: str):
+        self._end(serial, self.engines[serial].setStopRequested)
+        self.engines[serial].changeCurrentLevel(0)
+
+    def _end(self, serial: str, request):
+        if not self.isPlaying(serial):
+            return
+        request()
+        self.workers[serial].join()
+        self.workers[serial] = None
+        self.engines[serial].setStartRequested()
+        if self.debug: print("Device %s ended" % serial)
+
+    def startAll(self) -> list:
+        """
+        Starts every connected device not playing yet. Returns serials started.
+        """
+        return [serial for serial in self.getSerials() if self.start(serial)]
+
+    def pauseAll(self):
+        for serial in self.getSerials():
+            self.pause(serial)
+
+    def stopAll(self):
+        for serial in self.getSerials():
+            self.stop(serial)
+
+    def getStatistics(self, serial: str) -> dict:
+        engine = self.engines[serial]
+        door_exit_times = engine.door_exit_times
+        return {
+            "connected": engine.device_connector.connected,
+            "playing": self.isPlaying(serial),
+            "starts": self.starts[serial],
+            "dungeon": engine.currentDungeon,
+            "level": engine.currentLevel,
+            "state": engine.screen_connector.last_state,
+            "end_status": engine.endStatus,
+            "rooms_exited": len(door_exit_times),
+            "mean_door_to_exit": sum(door_exit_times) / len(door_exit_times) if len(door_exit_times) > 0 else None,
+            "frame_diff": engine.screen_connector.getFrameDiffStatistics(),
+            "statistics_file": engine.statisctics_manager.file_path,
+            "timings_file": engine.statisctics_manager.timings_file_path,
+        }
+
+    def getAllStatistics(self) -> dict:
+        return {serial: self.getStatistics(serial) for serial in self.getSerials()}
+
+    def close(self):
+        for serial in self.getSerials():
+            self.removeDevice(serial)
+        self.device_tracker.stop()
+        if self.analysis_pool is not None:
+            self.analysis_pool.stop()
+
+
+if __name__ == "__main__":
+    manager = DeviceManager()
+    # first devices list from adb server
+    manager.device_tracker.waitChange(0, 5)
+    manager.refreshDevices()
+    print("Devices: %s" % ", ".join(manager.getSerials()))
+    try:
+        while True:
+            # engines connect from their own connection check threads: start them once connected
+            manager.refreshDevices()
+            manager.startAll()
+            for serial, stats in manager.getAllStatistics().items():
+                print("%s: %s" % (serial, stats))
+            time.sleep(30)
+    except KeyboardInterrupt:
+        print("Stopping all devices")
+        manager.close()
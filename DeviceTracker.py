@@ -0,0 +1,140 @@
+import os
+import socket
+import threading
+import time
+
+from ppadb.connection import Connection
+
+from WorkerThread import WorkerThread
+
+
+class DeviceTracker(object):
+    """
+    Follows devices attached to the adb server through its host:track-devices stream: the server pushes the
+    whole devices list each time it changes, so nothing is polled and no adb process is spawned.
+    If the server can not be reached, devices list is empty and the server is started again.
+    """
+
+    def __init__(self, host: str = '127.0.0.1', port: int = 5037, retry_interval: float = 5.0):
+        self.host = host
+        self.port = port
+        self.retry_interval = retry_interval # seconds between attempts to reach the adb server
+        self.devices = {} # serial -> state ("device", "offline", "unauthorized", ...)
+        self.changes = 0 # devices lists received
+        self.devicesChangedFunctions = []
+        self._stopRequired = False
+        self._thread = None
+        self._conn = None
+        self._changed = threading.Condition()
+
+    def setFunctionToCallOnDevicesChanged(self, function):
+        """
+        function(devices) is called from the tracker thread with the new devices dictionary
+        """
+        if function not in self.devicesChangedFunctions:
+            self.devicesChangedFunctions.append(function)
+
+    def start(self):
+        if self.isRunning():
+            return
+        self._stopRequired = False
+        self._thread = WorkerThread()
+        self._thread.daemon = True
+        self._thread.function = self._loop
+        self._thread.start()
+
+    def stop(self):
+        self._stopRequired = True
+        conn = self._conn
+        if conn is not None:
+            # unlocks the blocking read of the tracker thread (close alone does not)
+            try:
+                conn.socket.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+        self.wakeUp()
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join(5)
+        self._thread = None
+
+    def isRunning(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def getDevices(self, state: str = "device") -> list:
+        """
+        Serials of tracked devices in given state (ready ones by default)
+        """
+        return [serial for serial, s in self.devices.items() if s == state]
+
+    def waitChange(self, changes: int, timeout: float = None, until=None) -> bool:
+        """
+        Waits until more than changes devices lists were received, or until until() is True (checked again when
+        woken up, see wakeUp). Returns False on timeout.
+        """
+        with self._changed:
+            return self._changed.wait_for(lambda: self.changes > changes or self._stopRequired or
+                                          (until is not None and until()), timeout)
+
+    def wakeUp(self):
+        """
+        Wakes up the threads in waitChange, so they check their until condition
+        """
+        with self._changed:
+            self._changed.notify_all()
+
+    def _loop(self):
+        while not self._stopRequired:
+            try:
+                self._track()
+            except Exception as e:
+                if self._stopRequired:
+                    break
+                print("Device tracking interrupted: %s" % str(e))
+            if len(self.devices) > 0:
+                self._setDevices({})
+            if self._stopRequired:
+                break
+            # only reached when the adb server is not running (or went down)
+            os.system("adb start-server")
+            time.sleep(self.retry_interval)
+
+    def _track(self):
+        conn = Connection(self.host, self.port)
+        conn.connect()
+        self._conn = conn
+        try:
+            conn.send("host:track-devices")
+            while not self._stopRequired:
+                length = int(self._read(conn, 4).decode('utf-8'), 16)
+                payload = self._read(conn, length).decode('utf-8') if length > 0 else ""
+                self._setDevices(self._parse(payload))
+        finally:
+            self._conn = None
+            conn.close()
+
+    @staticmethod
+    def _read(conn: Connection, length: int) -> bytes:
+        data = b""
+        while len(data) < length:
+            chunk = conn.socket.recv(length - len(data))
+            if not chunk:
+                raise socket.error("adb server closed device tracking")
+            data += chunk
+        return data
+
+    @staticmethod
+    def _parse(payload: str) -> dict:
+        devices = {}
+        for line in payload.split('\n'):
+            fields = line.split()
+            if len(fields) == 2:
+                devices[fields[0]] = fields[1]
+        return devices
+
+    def _setDevices(self, devices: dict):
+        with self._changed:
+            self.devices = devices
+            self.changes += 1
+            self._changed.notify_all()
+        for f in self.devicesChangedFunctions:
+            f(devices)
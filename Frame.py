@@ -0,0 +1,79 @@
+import time
+import numpy as np
+from PIL import Image
+
+
+class Frame(object):
+    """
+    A screen frame stored as one uint8 (H, W, 4) RGBA buffer.
+    Flat pixel views, 2d crops and the PIL image all share that same memory: nothing is copied.
+    """
+
+    def __init__(self, pixels: np.ndarray, timestamp: float = None):
+        # Contiguous buffer is needed for zero-copy flat view and PIL image
+        self.pixels = np.ascontiguousarray(pixels, dtype=np.uint8)
+        self.height, self.width = self.pixels.shape[0], self.pixels.shape[1]
+        self.flat = self.pixels.reshape(self.height * self.width, 4)
+        self.timestamp = time.time() if timestamp is None else timestamp
+        # Rows bands [(y1, y2), ...] actually captured. None means the complete screen
+        self.rows = None
+        self._pil = None
+
+    @staticmethod
+    def fromBuffer(buffer, width: int, height: int, offset: int = 0, timestamp: float = None):
+        """
+        Wraps a raw RGBA buffer (e.g. bytes read from screencap) without copying it.
+        """
+        pixels = np.frombuffer(buffer, dtype=np.uint8, count=width * height * 4, offset=offset)
+        return Frame(pixels.reshape(height, width, 4), timestamp)
+
+    @staticmethod
+    def fromImage(im: Image.Image, timestamp: float = None):
+        if im.mode != 'RGBA':
+            im = im.convert('RGBA')
+        return Frame(np.asarray(im), timestamp)
+
+    @staticmethod
+    def fromFile(path: str):
+        with Image.open(path, 'r') as im:
+            frame = Frame.fromImage(im)
+        return frame
+
+    @staticmethod
+    def fromFlat(flat: np.ndarray, width: int, height: int):
+        """
+        Builds a frame from old style flattened (W*H, 3 or 4) pixel arrays.
+        """
+        pixels = flat.reshape(height, width, flat.shape[-1])
+        if pixels.shape[2] == 3:
+            alpha = np.full((height, width, 1), 255, dtype=np.uint8)
+            pixels = np.concatenate([pixels.astype(np.uint8), alpha], axis=2)
+        return Frame(pixels)
+
+    @property
+    def size(self) -> tuple:
+        return self.width, self.height
+
+    def __len__(self):
+        return self.flat.shape[0]
+
+    def __getitem__(self, item):
+        """
+        Flat indexing (y * width + x) as the old flattened arrays, returns views.
+        """
+        return self.flat[item]
+
+    def crop(self, bbox) -> np.ndarray:
+        """
+        Returns a (y2-y1, x2-x1, 4) view given a [x1, y1, x2, y2] bounding box.
+        """
+        x1, y1, x2, y2 = bbox
+        return self.pixels[y1:y2, x1:x2]
+
+    def pil(self) -> Image.Image:
+        """
+        PIL image sharing the frame buffer. Built only once, when first needed.
+        """
+        if self._pil is None:
+            self._pil = Image.frombuffer('RGBA', (self.width, self.height), self.pixels, 'raw', 'RGBA', 0, 1)
+        return self._pil
@@ -0,0 +1,29 @@
+from Frame import Frame
+
+
+class FrameAnalysis(object):
+    """
+    Results of GameScreenConnector.analyze on one frame.
+    Boolean checks are read with analysis["name"], horizontal lines with analysis.lines["name"].
+    frame is None when the analysis ran in an AnalysisPool worker: only its capture time is kept.
+    """
+
+    def __init__(self, frame: Frame, timestamp: float = None):
+        self.frame = frame
+        self.timestamp = frame.timestamp if timestamp is None else timestamp
+        self.state = None
+        # check name -> bool (coords, templates, "doors", "exp_changed")
+        self.checks = {}
+        # line name -> pixels (hor_lines names and "exp_bar")
+        self.lines = {}
+        # first open doors check (1, 2 or 3), 0 if doors are closed or not checked
+        self.doors_variant = 0
+
+    def __getitem__(self, name: str) -> bool:
+        return self.checks[name]
+
+    def __contains__(self, name: str) -> bool:
+        return name in self.checks
+
+    def get(self, name: str, default: bool = False) -> bool:
+        return self.checks.get(name, default)
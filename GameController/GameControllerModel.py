@@ -71,6 +71,16 @@ class GameControllerModel(QObject):
         levels_type = self.engine.levels_info[lvl_TXX.type]
         return levels_type
 
+    def getTimingsText(self) -> str:
+        """
+        Timing spans of current game, and of current level while playing one
+        """
+        timings = self.engine.timings
+        text = timings.toText()
+        if timings.current_level is not None:
+            text += "\n\n" + timings.toText(timings.current_level)
+        return text
+
     def load_icons(self):
         icons_dts = {}
         icons_dts['prev'] = "Start.png"
@@ -4,7 +4,7 @@ from CaveDungeonEngine import HealingStrategy, EnergyStrategy, VIPSub, Battlepas
 from GameController.GameControllerModel import GameControllerModel, EngineState
 from PyQt5 import QtGui, QtWidgets
 from PyQt5.QtCore import Qt
-from PyQt5.QtWidgets import QHBoxLayout, QVBoxLayout, QPushButton, QScrollArea, QLabel, QFormLayout, QMainWindow, QInputDialog, QGridLayout, QWidget, QSpacerItem, QComboBox
+from PyQt5.QtWidgets import QHBoxLayout, QVBoxLayout, QPushButton, QScrollArea, QLabel, QFormLayout, QMainWindow, QInputDialog, QGridLayout, QWidget, QSpacerItem, QComboBox, QMessageBox
 import os
 from GameController.QToolboxActions import QToolboxActions
 from GameController.QToolboxRun import QToolboxRun
@@ -64,6 +64,7 @@ class GameControllerWindow(QWidget):
         self.cBoxreviveIfDead.blockSignals(False)
         self.lblInfoReviveIfDead = QLabel()
         self.updateReviveIfDeadChange(self.model.engine.reviveIfDead)
+        self.btnTimings = QPushButton("Timings")
         self.initConnectors()
 
     def initConnectors(self):
@@ -88,6 +89,7 @@ class GameControllerWindow(QWidget):
         self.model.engine.reviveIfDeadChanged.connect(self.updateReviveIfDeadChange)
         self.cBoxreviveIfDead.currentIndexChanged.connect(self.onChangeReviveIfDead)
         self.model.updatesAvailableEvent.connect(self.on_UpdatesAreAvailable)
+        self.btnTimings.clicked.connect(self.onShowTimings)
 
     def on_UpdatesAreAvailable(self, mess:str):
         self.lblUpdates.setStyleSheet("background-color: #6e6e6e; color: yellow")
@@ -164,6 +166,9 @@ class GameControllerWindow(QWidget):
         strat4 = ReviveIfDead.TrueRevive if new_index4 == 1 else ReviveIfDead.FalseRevive
         self.model.engine.changeReviveIfDead(strat4)
 
+    def onShowTimings(self):
+        QMessageBox.information(self, "Timings", self.model.getTimingsText())
+
     def onLevelChanged(self, newLevel):
         self.currentLevelWidget.changeLevel(newLevel)
 
@@ -245,6 +250,7 @@ class GameControllerWindow(QWidget):
         self.toolbarOptions.addWidget(self.lblInfoReviveIfDead)
         self.toolbarOptions.addWidget(self.cBoxreviveIfDead)
         self.toolbarOptions.addWidget(self.lblUpdates)
+        self.toolbarOptions.addWidget(self.btnTimings)
         lay_content.addWidget(self.controlWidget)
         lay_content.addWidget(self.infoLabel)
         self.lblInfoHealStrategy.setStyleSheet("background-color: #6e6e6e; color: white")
@@ -257,6 +263,7 @@ class GameControllerWindow(QWidget):
         self.cBoxbpadvSub.setStyleSheet("background-color: #6e6e6e; color: white")
         self.lblInfoReviveIfDead.setStyleSheet("background-color: #6e6e6e; color: white")
         self.cBoxreviveIfDead.setStyleSheet("background-color: #6e6e6e; color: white")
+        self.btnTimings.setStyleSheet("background-color: #6e6e6e; color: white")
         self.controlWidget.setStyleSheet("background-color: #6e6e6e")
         upd_str = "All updated."
         if self.model.updates_available:
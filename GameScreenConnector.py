@@ -1,9 +1,13 @@
-import json
 import numpy as np
 from PIL import Image
 from UsbConnector import UsbConnector
+from Frame import Frame
+from FrameAnalysis import FrameAnalysis
+from StaticCoordsChecker import StaticCoordsChecker
+from TimingStats import timed
+import CompiledPlan
 import os
-from Utils import loadJsonData, saveJsonData_oneIndent, saveJsonData_twoIndent, buildDataFolder
+from Utils import saveJsonData_oneIndent, saveJsonData_twoIndent, buildDataFolder
 
 class GameScreenConnector:
     def __init__(self, device_connector=None):
@@ -17,6 +21,14 @@ class GameScreenConnector:
         self.hor_lines_path = ''
         self.specific_checks_coords = {}
         self.static_coords = {}
+        # compiled versions of static_coords and specific_checks_coords, see changeScreenSize
+        self.states_checker: StaticCoordsChecker = None
+        self.specific_checker: StaticCoordsChecker = None
+        self.plan: CompiledPlan.CompiledPlan = None
+        # States detection statistics, for reports: hits of each state and states following each state
+        self.states_hits = {}
+        self.states_transitions = {}
+        self.last_state = "unknown"
         self.door_width = 180.0 / 1080.0
         self.yellow_experience = [255, 170, 16, 255]
         self.green_hp = [70, 158, 47, 255]
@@ -26,33 +38,37 @@ class GameScreenConnector:
         self.hor_lines = {}
         self.stopRequested = False
         self.abilities_treshold = 5
+        self.abilities_block_size = 16 # templates compared together in getAbilitiesDistances
+        self.abilities_shortlist_size = 4 # templates compared at full resolution at a time, nearest fingerprints first
         self.abilities_templates = {}
         self.abilities_unknown_fld = "abilities_unknown"
         if not os.path.exists(self.abilities_unknown_fld): os.mkdir(self.abilities_unknown_fld)
         self.general_templates = {}
+        self.roi_capture = False # set True to transfer only the rows needed by checks (raw capture mode only)
+        self.roi_band_cost = 16 # each rows band costs a command on device, as much as transferring about these rows
+        self._roi_bands_cache = {}
+        # (frame, result) of last _checkDoorsLights
+        self._doors_lights_cache = (None, False)
+        # Frame-diff gating: checks results of last frame are reused while the sampled pixels don't change
+        self.frame_diff_gating = True
+        self.frame_diff_grid_step = 16 # one pixel every these, in both directions, is sampled besides checks pixels
+        self.frames_compared = 0
+        self.frames_unchanged = 0 # times last results were reused
+        self._signature_indexes = None
+        self._last_signature = None
+        self._last_results = {}
+        # Optional AnalysisPool: analyze then decodes and checks screens in worker processes
+        self.analysis_pool = None
+        # Optional SessionRecorder: screens taken and states found are recorded
+        self.session_recorder = None
+        # Optional TimingStats: screens and checks are timed
+        self.timings = None
 
     def load_abilities_templates(self):
-        file = os.path.join("datas", "abilities", "abilities_templates_fns.json")
-        abilities_folder = os.path.join("datas", "abilities", "abilities_templates")
-        with open(file) as file_in:
-            abs_json = json.load(file_in)
-        abilities = {}
-        for ab, fn in abs_json.items():
-            with Image.open(os.path.join(abilities_folder, fn)) as im:
-                abilities[ab] = np.array(im.getdata())
-        return abilities
+        return CompiledPlan.load_abilities_templates()
 
     def load_general_templates(self):
-        file = os.path.join("datas", "general", "general_templates.json")
-        general_folder = os.path.join("datas", "general", "general_templates")
-        with open(file) as file_in:
-            gen_json = json.load(file_in)
-        templates = {}
-        for ab, v in gen_json.items():
-            templates[ab] = v
-            with Image.open(os.path.join(general_folder, v["fn"])) as im:
-                templates[ab]["template"] = np.array(im.getdata())
-        return templates
+        return CompiledPlan.load_general_templates()
 
     def changeDeviceConnector(self, new_dev):
         self.device_connector = new_dev
@@ -66,31 +82,58 @@ class GameScreenConnector:
         self.hor_lines_path = os.path.join("datas", buildDataFolder(self.width, self.height), "coords",
                                            "hor_lines.json")
 
-        self.specific_checks_coords = loadJsonData(self.specific_checks_path)
-        self.static_coords = loadJsonData(self.coords_path)
-        self.hor_lines = loadJsonData(self.hor_lines_path)
-
-        self.abilities_templates = self.load_abilities_templates()
-        self.general_templates = self.load_general_templates()
+        # Parsed coordinates and decoded templates are cached for each size folder, see CompiledPlan
+        self.plan = CompiledPlan.loadCompiledPlan(self.width, self.height)
+        self.specific_checks_coords = self.plan.specific_checks_coords
+        self.static_coords = self.plan.static_coords
+        self.hor_lines = self.plan.hor_lines
+        self.states_checker = self.plan.states_checker
+        self.specific_checker = self.plan.specific_checker
+
+        self.abilities_templates = self.plan.abilities_templates
+        self.general_templates = self.plan.general_templates
+        self._roi_bands_cache = {}
+        self._doors_lights_cache = (None, False)
+        self._signature_indexes = None
+        self._last_signature = None
+        self._last_results = {}
 
     def pixel_equals(self, px_readed, px_expected, around=5):
-        arr = [5, 5, 5]
-        if isinstance(around, int):
-            arr = [around, around, around]
-        elif isinstance(around, list):
-            arr = [around[0], around[1], around[2]]
-        # checking only RGB from RGBA
-        return px_expected[0] - arr[0] <= px_readed[0] <= px_expected[0] + arr[0] \
-               and px_expected[1] - arr[1] <= px_readed[1] <= px_expected[1] + arr[1] \
-               and px_expected[2] - arr[2] <= px_readed[2] <= px_expected[2] + arr[2]
+        arr = StaticCoordsChecker.aroundToArray(around)
+        # checking only RGB from RGBA. Cast to int: raw frames are uint8 and would overflow
+        r, g, b = int(px_readed[0]), int(px_readed[1]), int(px_readed[2])
+        er, eg, eb = int(px_expected[0]), int(px_expected[1]), int(px_expected[2])
+        return er - arr[0] <= r <= er + arr[0] \
+               and eg - arr[1] <= g <= eg + arr[1] \
+               and eb - arr[2] <= b <= eb + arr[2]
+
+    def lineEquals(self, line, px_expected, around=5) -> np.ndarray:
+        """
+        Vectorized pixel_equals: returns a boolean array telling which pixels of line are equal to px_expected
+        """
+        line = np.asarray(line)
+        if len(line) == 0:
+            return np.zeros(0, dtype=bool)
+        rgb = line[:, :3].astype(np.int16)
+        diff = np.abs(rgb - np.asarray(px_expected[:3], dtype=np.int16))
+        return np.all(diff <= np.asarray(StaticCoordsChecker.aroundToArray(around), dtype=np.int16), axis=1)
+
+    def toFrame(self, frame) -> Frame:
+        """
+        Returns given frame as a Frame. Accepts PIL images and old style flattened (W*H)x4 arrays too.
+        """
+        if isinstance(frame, Frame):
+            return frame
+        if isinstance(frame, Image.Image):
+            return Frame.fromImage(frame)
+        if frame.ndim == 3:
+            return Frame(frame)
+        return Frame.fromFlat(frame, self.width, self.height)
 
     def getFrameAttr(self, frame, attributes):
-        attr_data = []
-        for attr in attributes:
-            x = int(attr[0] * self.width)
-            y = int(attr[1] * self.height)
-            attr_data.append(frame[int(y * self.width + x)])
-        return attr_data
+        frame = self.toFrame(frame)
+        indexes = [int(int(attr[1] * self.height) * self.width + int(attr[0] * self.width)) for attr in attributes]
+        return frame.flat[indexes]
 
     def _check_screen_points_equal(self, frame, points_list, points_value, around=2):
         """
@@ -119,128 +162,70 @@ class GameScreenConnector:
         return equal
 
     def checkBoss6Died(self, frame=None):
-        if frame is None:
-            frame = self.getFrame(return_pillow=True)
+        frame = self.getFrame() if frame is None else self.toFrame(frame)
         # check up field empty (no boss inside)
         res = self._check_general_template("final_boss_empty_up_field", frame)
         return res
 
     def checkBoss10Died(self, frame=None):
-        if frame is None:
-            frame = self.getFrame(return_pillow=True)
+        frame = self.getFrame() if frame is None else self.toFrame(frame)
         # check up field empty (no boss inside)
         res = self._check_general_template("final_boss_empty_up_field2", frame)
         return res
 
     def checkBoss3Died(self, frame=None):
-        if frame is None:
-            frame = self.getFrame(return_pillow=True)
+        frame = self.getFrame() if frame is None else self.toFrame(frame)
         # check up field empty (no boss inside)
         res = self._check_general_template("final_boss_empty_up_field1", frame)
         return res
 
-    def checkDoorsOpen(self, frame=None):
-        if frame is None:
-            frame = self.getFrame()
-        # Check white light horizontal line inside door
-        #490x630 to 600x630 hor line
-        sizes = self.hor_lines['hor_door_light']
-        line_door = self._getHorLine(sizes, frame)
-        white_yellow = True
-        for px in line_door:
-            # check if pixels are 250-255, 250-255, 190-255
-            if px[0] <= 250 or px[1] <= 250 or px[2] <= 190:
-                white_yellow = False
-                break
-        if white_yellow:
-            return True
-        #check hp bar height....
+    def _getDoorsHpLines(self):
+        """
+        Returns the 3 lines [x1, y1, x2, y2] above the HP bar where the door light is checked
+        """
         px_up = 50
         h_bar = self.hor_lines['hor_hp_bar'][1]  # HP bar height
-        for i in range(1, 4, 1):
-            line = self._getHorLine(
-                [480 / 1080.0, h_bar - ((px_up * i) / self.height), 600 / 1080.0, h_bar - ((px_up * i) / self.height)],
-                frame)
-            white = True
-            for px in line:
-                if px[0] != 255 or px[1] != 255 or px[2] != 255:
-                    white = False
-                    break
-            if white:
-                return True
-        #check template
-        res = self._check_general_template("doors_open", frame)
-        if res: return True
-        return False
+        return [[480 / 1080.0, h_bar - ((px_up * i) / self.height), 600 / 1080.0, h_bar - ((px_up * i) / self.height)]
+                for i in range(1, 4, 1)]
 
-    def checkDoorsOpen1(self, frame=None):
-        if frame is None:
-            frame = self.getFrame()
+    def _checkDoorsLights(self, frame: Frame) -> bool:
+        """
+        Common part of checkDoorsOpen checks: white-yellow light inside door or white lines above HP bar.
+        The result is kept for the last frame, so the 3 door checks on the same frame compute it once.
+        """
+        if self._doors_lights_cache[0] is frame:
+            return self._doors_lights_cache[1]
         # Check white light horizontal line inside door
         #490x630 to 600x630 hor line
-        sizes = self.hor_lines['hor_door_light']
-        line_door = self._getHorLine(sizes, frame)
-        white_yellow = True
-        for px in line_door:
-            # check if pixels are 250-255, 250-255, 190-255
-            if px[0] <= 250 or px[1] <= 250 or px[2] <= 190:
-                white_yellow = False
-                break
-        if white_yellow:
-            return True
-        #check hp bar height....
-        px_up = 50
-        h_bar = self.hor_lines['hor_hp_bar'][1]  # HP bar height
-        for i in range(1, 4, 1):
-            line = self._getHorLine(
-                [480 / 1080.0, h_bar - ((px_up * i) / self.height), 600 / 1080.0, h_bar - ((px_up * i) / self.height)],
-                frame)
-            white = True
-            for px in line:
-                if px[0] != 255 or px[1] != 255 or px[2] != 255:
-                    white = False
+        line_door = self._getHorLine(self.hor_lines['hor_door_light'], frame)
+        # check if pixels are 250-255, 250-255, 190-255
+        lights_on = bool(np.all((line_door[:, 0] > 250) & (line_door[:, 1] > 250) & (line_door[:, 2] > 190)))
+        if not lights_on:
+            #check hp bar height....
+            for door_line in self._getDoorsHpLines():
+                line = self._getHorLine(door_line, frame)
+                if np.all(line[:, :3] == 255):
+                    lights_on = True
                     break
-            if white:
-                return True
-        #check template
-        res = self._check_general_template("doors_open1", frame)
-        if res: return True
-        return False
+        self._doors_lights_cache = (frame, lights_on)
+        return lights_on
+
+    @timed
+    def checkDoorsOpen(self, frame=None):
+        frame = self.getRoiFrame(["doors"]) if frame is None else self.toFrame(frame)
+        return self._checkDoorsLights(frame) or self._check_general_template("doors_open", frame)
+
+    @timed
+    def checkDoorsOpen1(self, frame=None):
+        frame = self.getRoiFrame(["doors"]) if frame is None else self.toFrame(frame)
+        return self._checkDoorsLights(frame) or self._check_general_template("doors_open1", frame)
 
+    @timed
     def checkDoorsOpen2(self, frame=None):
-        if frame is None:
-            frame = self.getFrame()
-        # Check white light horizontal line inside door
-        #490x630 to 600x630 hor line
-        sizes = self.hor_lines['hor_door_light']
-        line_door = self._getHorLine(sizes, frame)
-        white_yellow = True
-        for px in line_door:
-            # check if pixels are 250-255, 250-255, 190-255
-            if px[0] <= 250 or px[1] <= 250 or px[2] <= 190:
-                white_yellow = False
-                break
-        if white_yellow:
-            return True
-        #check hp bar height....
-        px_up = 50
-        h_bar = self.hor_lines['hor_hp_bar'][1]  # HP bar height
-        for i in range(1, 4, 1):
-            line = self._getHorLine(
-                [480 / 1080.0, h_bar - ((px_up * i) / self.height), 600 / 1080.0, h_bar - ((px_up * i) / self.height)],
-                frame)
-            white = True
-            for px in line:
-                if px[0] != 255 or px[1] != 255 or px[2] != 255:
-                    white = False
-                    break
-            if white:
-                return True
-        #check template
-        res = self._check_general_template("doors_open2", frame)
-        if res: return True
-        return False
-    
+        frame = self.getRoiFrame(["doors"]) if frame is None else self.toFrame(frame)
+        return self._checkDoorsLights(frame) or self._check_general_template("doors_open2", frame)
+
+    @timed
     def checkFrame(self, coords_name: str, frame=None):
         """
         Given a coordinates name it checkes if the Frame has those pixels.
@@ -250,24 +235,109 @@ class GameScreenConnector:
         dict_to_take = []
         if coords_name in self.static_coords.keys():
             dict_to_take = self.static_coords
+            checker = self.states_checker
         elif coords_name in self.specific_checks_coords.keys():
             dict_to_take = self.specific_checks_coords
+            checker = self.specific_checker
         else:
             print("No coordinates called %s is saved in memory! Returning false." % coords_name)
             return False
         if self.debug: print("Checking %s" % (coords_name))
-        if frame is None:
-            frame = self.getFrame()
+        frame = self.getRoiFrame([coords_name]) if frame is None else self.toFrame(frame)
+        if not self.debug:
+            return checker.check(frame, coords_name)
         around = 2 if "around" not in dict_to_take[coords_name].keys() else dict_to_take[coords_name]["around"]
         is_equal = self._check_screen_points_equal(frame, dict_to_take[coords_name]["coordinates"],
                                                    dict_to_take[coords_name]["values"], around=around)
         return is_equal
 
-    def getFrame(self, return_pillow:bool=False):
+    @timed
+    def getFrame(self, return_pillow: bool = False):
+        """
+        Takes a screen from device. Returns a Frame, or its PIL view if return_pillow.
+        If device is streaming, the newest frame is returned as long as it was captured after last input.
+        """
+        if self.stopRequested:
+            exit()
+        if self.device_connector.isStreaming():
+            latest = self.device_connector.screen_streamer.latest()
+            if latest is None or latest.timestamp <= self.device_connector.last_input_time:
+                return self.getFrameAfter(self.device_connector.last_input_time, return_pillow)
+        return self._recordFrame(self.device_connector.adb_screen_getpixels(), return_pillow)
+
+    def _recordFrame(self, frame: Frame, return_pillow: bool = False):
+        if self.session_recorder is not None:
+            self.session_recorder.recordFrame(frame)
+        return frame.pil() if return_pillow else frame
+
+    def getRoiRows(self, names: list = None) -> list:
+        """
+        Returns the rows bands [(y1, y2), ...] (y2 excluded) read by given checks. Names can be static coords,
+        specific coords, horizontal lines, general templates or "doors" (all checkDoorsOpen lines and templates).
+        If no names given, all of them are used. Bands closer than roi_band_cost rows are merged.
+        """
+        key = None if names is None else tuple(names)
+        if key in self._roi_bands_cache:
+            return self._roi_bands_cache[key]
+        if names is None:
+            names = list(self.static_coords.keys()) + list(self.specific_checks_coords.keys()) + \
+                    list(self.hor_lines.keys()) + list(self.general_templates.keys()) + ["doors"]
+        rows = set()
+
+        def add_line(line):
+            x1, y1, x2 = line[0] * self.width, line[1] * self.height, line[2] * self.width
+            start = int(y1 * self.width + x1)
+            rows.update(range(start // self.width, (start + max(int(x2 - x1), 1) - 1) // self.width + 1))
+
+        for name in names:
+            if name in self.static_coords or name in self.specific_checks_coords:
+                coords = self.static_coords[name] if name in self.static_coords else self.specific_checks_coords[name]
+                rows.update(int(c[1] * self.height) for c in coords["coordinates"])
+            elif name in self.hor_lines:
+                add_line(self.hor_lines[name])
+            elif name in self.general_templates:
+                bbox = self.general_templates[name]["bbox"]
+                rows.update(range(bbox[1], bbox[3]))
+            elif name == "doors":
+                add_line(self.hor_lines['hor_door_light'])
+                for line in self._getDoorsHpLines():
+                    add_line(line)
+                for t in ["doors_open", "doors_open1", "doors_open2"]:
+                    rows.update(range(self.general_templates[t]["bbox"][1], self.general_templates[t]["bbox"][3]))
+        bands = []
+        for y in sorted(r for r in rows if 0 <= r < self.height):
+            # Transferring the gap is cheaper than running one more command on device
+            if len(bands) > 0 and y - bands[-1][1] < self.roi_band_cost:
+                bands[-1][1] = y + 1
+            else:
+                bands.append([y, y + 1])
+        bands = [(b[0], b[1]) for b in bands]
+        self._roi_bands_cache[key] = bands
+        return bands
+
+    def getRoiFrame(self, names: list = None):
+        """
+        Takes a screen with only the rows needed by given checks (see getRoiRows).
+        Returns a complete frame if roi_capture is disabled or device is streaming.
+        """
+        if not self.roi_capture or self.device_connector.isStreaming():
+            return self.getFrame()
+        if self.stopRequested:
+            exit()
+        return self._recordFrame(self.device_connector.captureFrameRows(self.getRoiRows(names)))
+
+    @timed
+    def getFrameAfter(self, t: float = None, return_pillow: bool = False):
+        """
+        Returns a frame captured after time t (as in time.time()). Default t is the end of last input.
+        """
         if self.stopRequested:
             exit()
-        return self.device_connector.adb_screen_getpixels(return_pillow)
+        if t is None:
+            t = self.device_connector.last_input_time
+        return self._recordFrame(self.device_connector.adb_screen_getpixels(after=t), return_pillow)
 
+    @timed
     def getFrameStateComplete(self, frame=None) -> dict:
         """
         Computes a complete check on given frame (takes a screen if none passed.
@@ -275,15 +345,16 @@ class GameScreenConnector:
         :return:
         """
         result = {}
-        if frame is None:
-            frame = self.getFrame()
+        frame = self.getRoiFrame(list(self.static_coords.keys())) if frame is None else self.toFrame(frame)
+        if not self.debug:
+            return {k: bool(v) for k, v in zip(self.states_checker.names, self.states_checker.checkAll(frame))}
         for k, v in self.static_coords.items():
             around = 2 if "around" not in self.static_coords[k].keys() else self.static_coords[k]["around"]
             if self.debug: print("Checking %s, around = %d" % (k, around))
             result[k] = self._check_screen_points_equal(frame, v["coordinates"], v["values"], around=around)
         return result
 
-    def _extract_abilities_3(self, frame):
+    def _extract_abilities_3(self, frame: Frame):
         #TODO: get thoose from json file in coords
         w, h = 1080, 1920
 
@@ -295,60 +366,115 @@ class GameScreenConnector:
         c2 = (x2, y1, x2 + sw, y1 + sh)
         c3 = (x3, y1, x3 + sw, y1 + sh)
 
+        # 2d views of the frame buffer, no copies
         cr1, cr2, cr3 = frame.crop(c1), frame.crop(c2), frame.crop(c3)
         return cr1, cr2, cr3
 
 
+    def getAbilitiesDistances(self, crop: np.ndarray, ids=None) -> np.ndarray:
+        """
+        Computes mean absolute distance of crop from templates ids (all if None) of the stacked abilities tensor.
+        Templates are processed in blocks to keep temporary memory low.
+        """
+        stack = self.plan.abilities_stack
+        ids = np.arange(stack.shape[0]) if ids is None else np.asarray(ids)
+        dists = np.full(len(ids), np.inf)
+        if crop.shape != stack.shape[1:]:
+            return dists
+        crop = np.ascontiguousarray(crop)
+        block = self.abilities_block_size
+        for start in range(0, len(ids), block):
+            templates = stack[ids[start:start + block]]
+            # |a - b| on uint8 without overflow, summed in uint32 (max 255*239*239*4 fits)
+            diff = np.maximum(templates, crop) - np.minimum(templates, crop)
+            dists[start:start + block] = diff.sum(axis=(1, 2, 3), dtype=np.uint32) / crop.size
+        return dists
+
+    def getAbilitiesLowerBounds(self, crop: np.ndarray) -> np.ndarray:
+        """
+        Lower bounds of getAbilitiesDistances for all templates, from downsampled fingerprints.
+        """
+        plan = self.plan
+        if crop.shape != plan.abilities_stack.shape[1:]:
+            return np.full(plan.abilities_stack.shape[0], np.inf)
+        block = plan.abilities_fingerprint_block
+        fingerprint = CompiledPlan.abilityFingerprint(crop, block)
+        lower = np.abs(plan.abilities_fingerprints - fingerprint).sum(axis=1) * (block * block) / crop.size
+        # keep the bound safe from float rounding
+        return lower * (1 - 1e-6)
+
+    def _matchAbility(self, crop: np.ndarray) -> tuple:
+        """
+        Coarse to fine search of the 2 templates nearest to crop.
+        Templates are compared at full resolution in order of fingerprint lower bound, a shortlist at a time,
+        stopping as soon as no remaining template can be nearer than the second best found.
+        Returns (best id, best distance, second best distance, templates compared)
+        """
+        lower = self.getAbilitiesLowerBounds(crop)
+        order = np.argsort(lower, kind='stable')
+        best, best_d, second_d = -1, np.inf, np.inf
+        compared = 0
+        while compared < len(order) and lower[order[compared]] < second_d:
+            ids = order[compared:compared + self.abilities_shortlist_size]
+            for i, d in zip(ids, self.getAbilitiesDistances(crop, ids)):
+                if d < best_d:
+                    best, best_d, second_d = i, d, best_d
+                elif d < second_d:
+                    second_d = d
+            compared += len(ids)
+        return best, best_d, second_d, compared
+
+    def getAbilityMatches(self, frame=None) -> dict:
+        """
+        Finds the template nearest to each of the 3 abilities crops.
+        Returns, for "l", "c" and "r", a dictionary with best ability "name" ("unknown" if best distance is not
+        under threshold), its "distance" and the "margin" from the second best template (higher is more certain).
+        """
+        frame = self.getFrame() if frame is None else self.toFrame(frame)
+        crops = self._extract_abilities_3(frame)
+        matches = {}
+        for k, crop in zip(["l", "c", "r"], crops):
+            best, best_d, second_d, compared = self._matchAbility(crop)
+            margin = second_d - best_d
+            name = self.plan.abilities_names[best] if best_d < self.abilities_treshold else "unknown"
+            matches[k] = {"name": name, "distance": float(best_d), "margin": float(margin)}
+            if self.debug:
+                print("Ability %s: %s (distance %.2f, margin %.2f, %d templates compared)" % (
+                    k, name, best_d, margin, compared))
+            if name == "unknown": self.save_unknown_ability(crop)
+        return matches
+
+    @timed
     def getAbilityType(self, frame=None) -> dict:
         """
         Computes the ability extraction by simil-template matching
         Args:
             frame:
 
-        Returns:
+        Returns: dictionary with ability name (or "unknown") for "l", "c" and "r"
 
         """
-        if frame is None:
-            frame = self.getFrame(return_pillow=True)
-        cr1, cr2, cr3 = self._extract_abilities_3(frame)
-        a1, a2, a3 = np.array(cr1.getdata()), np.array(cr2.getdata()), np.array(cr3.getdata())
-        states = {"l":"unknown", "c":"unknown", "r":"unknown"}
-        for ab_image, k in zip([a1, a2, a3], states.keys()):
-            for ab_name, ab_template in self.abilities_templates.items():
-                dist = np.mean(np.abs(ab_image - ab_template))
-                if dist < self.abilities_treshold:
-                    states[k] = ab_name
-                    break
-        if states["l"] == "unknown": self.save_unknown_ability(cr1)
-        if states["c"] == "unknown": self.save_unknown_ability(cr2)
-        if states["r"] == "unknown": self.save_unknown_ability(cr3)
-        return states
+        return {k: v["name"] for k, v in self.getAbilityMatches(frame).items()}
 
+    @timed
     def _check_general_template(self, name_of_template, frame=None):
         """
         Computes a frame check based on saved data and returns true if thery are similar.
         :param name_of_template:
-        :param frame: Either flattern ZZZx4 np.ndarray or PIL full image
+        :param frame: a Frame (PIL image or flattened ZZZx4 np.ndarray are converted)
         :return:
         """
-        if frame is None:
-            frame = self.getFrame(return_pillow=True)
+        frame = self.getFrame() if frame is None else self.toFrame(frame)
         v = self.general_templates[name_of_template]
-        if type(frame) == np.ndarray:
-            x1,y1,x2,y2 = v["bbox"]
-            frame2 = frame.reshape(self.height, self.width, 4)
-            fram2_crp = frame2[y1:y2, x1:x2]
-            crp_np = fram2_crp.reshape(fram2_crp.shape[0]*fram2_crp.shape[1], 4)
-        else: #PIL
-            crp = frame.crop(v["bbox"])
-            crp_np = np.array(crp.getdata())
-        if crp_np.shape[0] != v["template"].shape[0] or crp_np.shape[1] != v["template"].shape[1]:
+        crp_np = frame.crop(v["bbox"])
+        if crp_np.shape != v["template"].shape:
             print("Error during templates check: wrong shape")
             return False
-        dist = np.mean(np.abs(crp_np - v["template"]))
+        dist = np.mean(np.abs(crp_np.astype(np.int16) - v["template"]))
         return dist < v["th"]
 
-    def save_unknown_ability(self, ability_pil):
+    def save_unknown_ability(self, ability_np):
+        ability_pil = Image.fromarray(ability_np, 'RGBA')
         num = 0
         path = os.path.join(self.abilities_unknown_fld, "unknown_ability_{}.png".format(num))
         while os.path.exists(path):
@@ -357,6 +483,7 @@ class GameScreenConnector:
         ability_pil.save(path)
         print("Unknown ability {} saved in {}".format(num, path))
 
+    @timed
     def getFrameState(self, frame=None) -> str:
         """
         Computes a complete check on given frame (takes a screen if none passed.
@@ -364,8 +491,17 @@ class GameScreenConnector:
         :return:
         """
         state = "unknown"
-        if frame is None:
-            frame = self.getFrame()
+        frame = self.getRoiFrame(list(self.static_coords.keys())) if frame is None else self.toFrame(frame)
+        if not self.debug:
+            # Debug keeps the point by point print below
+            results = self._getResultsCache(frame)
+            if "state" not in results:
+                # all states checked at once on compiled coordinates
+                found = self.states_checker.first(frame)
+                results["state"] = state if found is None else found
+            state = results["state"]
+            self._updateStatesStatistics(state)
+            return state
         for k, v in self.static_coords.items():
             around = 2 if "around" not in self.static_coords[k].keys() else self.static_coords[k]["around"]
             if self.debug: print("Checking %s, around = %d" % (k, around))
@@ -374,6 +510,208 @@ class GameScreenConnector:
                 break
         return state
 
+    def resetStatesStatistics(self):
+        self.states_hits = {}
+        self.states_transitions = {}
+        self.last_state = "unknown"
+
+    def _updateStatesStatistics(self, state: str):
+        self.states_hits[state] = self.states_hits.get(state, 0) + 1
+        transitions = self.states_transitions.setdefault(self.last_state, {})
+        transitions[state] = transitions.get(state, 0) + 1
+        self.last_state = state
+        if self.session_recorder is not None:
+            self.session_recorder.recordState(state)
+
+    def getSignatureIndexes(self) -> np.ndarray:
+        """
+        Flat indexes of pixels compared to tell if screen changed: a sparse grid plus every pixel read by the
+        checks whose results are reused (see analyze): static and specific coords points, horizontal lines,
+        door lines above HP bar and general templates bounding boxes.
+        """
+        if self._signature_indexes is None:
+            step = self.frame_diff_grid_step
+            ys, xs = np.mgrid[step // 2:self.height:step, step // 2:self.width:step]
+            indexes = [(ys * self.width + xs).ravel(), self.states_checker.indexes, self.specific_checker.indexes]
+            for start, size in self.plan.line_slices.values():
+                indexes.append(np.arange(start, start + size))
+            for door_line in self._getDoorsHpLines():
+                start, size = CompiledPlan.getLineSlice(door_line, self.width, self.height)
+                indexes.append(np.arange(start, start + size))
+            for v in self.general_templates.values():
+                x1, y1, x2, y2 = v["bbox"]
+                ys, xs = np.mgrid[y1:min(y2, self.height), x1:min(x2, self.width)]
+                indexes.append((ys * self.width + xs).ravel())
+            indexes = np.unique(np.concatenate(indexes).astype(np.int64))
+            self._signature_indexes = indexes[(indexes >= 0) & (indexes < self.width * self.height)]
+        return self._signature_indexes
+
+    def getFrameSignature(self, frame: Frame) -> bytes:
+        rows = b"" if frame.rows is None else repr(frame.rows).encode()
+        # one uint32 for each RGBA pixel: a much faster gather than the (N, 4) flat view
+        words = frame.pixels.view(np.uint32).reshape(-1)
+        return rows + words.take(self.getSignatureIndexes()).tobytes()
+
+    def _getResultsCache(self, frame: Frame) -> dict:
+        """
+        Returns the checks results of last frame (check name -> result) if frame looks unchanged from it,
+        otherwise a new empty dictionary that becomes the last results.
+        """
+        if not self.frame_diff_gating:
+            return {}
+        signature = self.getFrameSignature(frame)
+        self.frames_compared += 1
+        if signature == self._last_signature:
+            self.frames_unchanged += 1
+            return self._last_results
+        self._last_signature = signature
+        self._last_results = {}
+        return self._last_results
+
+    def resetCaches(self):
+        """
+        Forgets the results kept for the last frame: next checks compute from scratch, as on a new screen
+        """
+        self._doors_lights_cache = (None, False)
+        self._last_signature = None
+        self._last_results = {}
+
+    def getFrameDiffStatistics(self) -> dict:
+        """
+        How often checks were skipped because the screen was unchanged
+        """
+        ratio = self.frames_unchanged / self.frames_compared if self.frames_compared > 0 else 0.0
+        return {"compared": self.frames_compared, "unchanged": self.frames_unchanged, "unchanged_ratio": ratio}
+
+    def _analysisRoiNames(self, checks: list) -> list:
+        names = []
+        for name in checks:
+            if name == "state":
+                names += list(self.static_coords.keys())
+            elif name in ["exp_bar", "exp_changed"]:
+                names.append("hor_exp_bar")
+            else:
+                names.append(name)
+        return names
+
+    @timed
+    def analyze(self, frame=None, checks: list = None, old_exp_bar=None) -> FrameAnalysis:
+        """
+        Computes many checks on the same frame (takes a screen with only the needed rows if none passed).
+        Check names can be:
+         - "state": as getFrameState, in analysis.state
+         - static or specific coords names: as checkFrame. Each group is computed with a single gather
+         - general templates names: as _check_general_template
+         - "doors": True if any checkDoorsOpen variant is open (analysis.doors_variant tells which one)
+         - horizontal lines names and "exp_bar" (as getLineExpBar): pixels in analysis.lines
+         - "exp_changed": as checkExpBarHasChanged(old_exp_bar)
+        """
+        checks = [] if checks is None else checks
+        if frame is None and self.analysis_pool is not None and self.analysis_pool.isRunning():
+            analysis = self._analyzeInPool(checks, old_exp_bar)
+            if analysis is not None:
+                return analysis
+        frame = self.getRoiFrame(self._analysisRoiNames(checks)) if frame is None else self.toFrame(frame)
+        analysis = FrameAnalysis(frame)
+        # results of unchanged frames are reused, see _getResultsCache
+        results = self._getResultsCache(frame)
+        states_equal, specific_equal = None, None
+        for name in checks:
+            if name == "state":
+                if self.debug:
+                    analysis.state = self.getFrameState(frame)
+                    continue
+                if name not in results:
+                    if states_equal is None:
+                        states_equal = self.states_checker.checkAll(frame)
+                    # first equal state in dictionary order, as getFrameState
+                    found = np.flatnonzero(states_equal)
+                    results[name] = self.states_checker.names[found[0]] if len(found) > 0 else "unknown"
+                analysis.state = results[name]
+                self._updateStatesStatistics(analysis.state)
+            elif name == "exp_changed":
+                if "exp_bar" not in results:
+                    results["exp_bar"] = self.getLineExpBar(frame)
+                analysis.lines["exp_bar"] = results["exp_bar"]
+                analysis.checks[name] = old_exp_bar is not None and \
+                                        self._checkBarHasChanged(old_exp_bar, results["exp_bar"], around=2)
+            elif name in results:
+                self._setAnalysisResult(analysis, name, results[name])
+            elif name in self.static_coords and not self.debug:
+                if states_equal is None:
+                    states_equal = self.states_checker.checkAll(frame)
+                results[name] = bool(states_equal[self.states_checker.name_to_id[name]])
+                analysis.checks[name] = results[name]
+            elif name in self.specific_checks_coords and not self.debug:
+                if specific_equal is None:
+                    specific_equal = self.specific_checker.checkAll(frame)
+                results[name] = bool(specific_equal[self.specific_checker.name_to_id[name]])
+                analysis.checks[name] = results[name]
+            elif name in self.static_coords or name in self.specific_checks_coords:
+                results[name] = self.checkFrame(name, frame)
+                analysis.checks[name] = results[name]
+            elif name in self.general_templates:
+                results[name] = self._check_general_template(name, frame)
+                analysis.checks[name] = results[name]
+            elif name == "doors":
+                lights = self._checkDoorsLights(frame)
+                variant = 0
+                for i, template in enumerate(["doors_open", "doors_open1", "doors_open2"], 1):
+                    if lights or self._check_general_template(template, frame):
+                        variant = i
+                        break
+                results[name] = variant
+                self._setAnalysisResult(analysis, name, variant)
+            elif name in self.hor_lines:
+                results[name] = self._getHorLine(self.hor_lines[name], frame)
+                analysis.lines[name] = results[name]
+            elif name == "exp_bar":
+                results[name] = self.getLineExpBar(frame)
+                analysis.lines[name] = results[name]
+            else:
+                print("No check called %s is known! Returning false." % name)
+                analysis.checks[name] = False
+        return analysis
+
+    def _analyzeInPool(self, checks: list, old_exp_bar=None) -> FrameAnalysis:
+        """
+        Takes a screen and analyzes it in analysis_pool. Analysis has no frame (only its timestamp).
+        Returns None if the pool failed.
+        """
+        if self.stopRequested:
+            exit()
+        if self.roi_capture or self.device_connector.isStreaming():
+            # already decoded here, only checks go to the pool
+            frame = self.getRoiFrame(self._analysisRoiNames(checks))
+            captured = ("rgba", frame.pixels, frame.timestamp)
+        else:
+            captured = self.device_connector.captureEncoded()
+            if captured is None:
+                return None
+        encoding, data, timestamp = captured
+        try:
+            result = self.analysis_pool.analyze(encoding, data, self.width, self.height, checks, old_exp_bar)
+        except Exception as e:
+            print("Analysis pool failed: %s. Analyzing here" % str(e))
+            return None
+        analysis = FrameAnalysis(None, timestamp)
+        analysis.state = result["state"]
+        analysis.checks = result["checks"]
+        analysis.lines = result["lines"]
+        analysis.doors_variant = result["doors_variant"]
+        if analysis.state is not None:
+            self._updateStatesStatistics(analysis.state)
+        return analysis
+
+    def _setAnalysisResult(self, analysis: FrameAnalysis, name: str, result):
+        if name == "doors":
+            analysis.doors_variant = result
+            analysis.checks[name] = result > 0
+        elif name in self.hor_lines or name == "exp_bar":
+            analysis.lines[name] = result
+        else:
+            analysis.checks[name] = result
+
     def _getHorLine(self, hor_line, frame):
         """
         Returns a horizontal line (list of colors) given hor_line [x1, y1, x2, y2] coordinates. If no frame given, it takes a screen.
@@ -381,14 +719,9 @@ class GameScreenConnector:
         :param frame:
         :return:
         """
-        x1, y1, x2, y2 = hor_line[0] * self.width, hor_line[1] * self.height, hor_line[2] * self.width, hor_line[
-            3] * self.height
-        if frame is None:
-            frame = self.getFrame()
-        start = int(y1 * self.width + x1)
-        size = int(x2 - x1)
-        line = frame[start:start + size]
-        return line
+        frame = self.getFrame() if frame is None else self.toFrame(frame)
+        start, size = CompiledPlan.getLineSlice(hor_line, self.width, self.height)
+        return frame.flat[start:start + size]
 
     def getLineExpBar(self, frame=None):
         """
@@ -397,13 +730,7 @@ class GameScreenConnector:
         :return:
         """
         line = self._getHorLine(self.hor_lines["hor_exp_bar"], frame)
-        masked_yellow = []
-        for px in line:
-            if self.pixel_equals(px, self.yellow_experience, 3):
-                masked_yellow.append(px)
-            else:
-                masked_yellow.append([0, 0, 0, 0])
-        return masked_yellow
+        return np.where(self.lineEquals(line, self.yellow_experience, 3)[:, None], line, 0).astype(np.uint8)
 
     def filterRawHpLine_window(self, line):
         """
@@ -421,17 +748,9 @@ class GameScreenConnector:
         return line
 
     def filterLineByColor(self, line):
-        masked_green = []
-        i = 0
-        for px in line:
-            i += 1
-            if i == 452:
-                a = 0
-            if self.pixel_equals(px, self.green_hp, [8, 12, 8]) or self.pixel_equals(px, self.green_hp_high,
-                                                                                     [8, 12, 8]):
-                masked_green.append(self.green_hp)
-            else:
-                masked_green.append([0, 0, 0, 0])
+        green = self.lineEquals(line, self.green_hp, [8, 12, 8]) | self.lineEquals(line, self.green_hp_high, [8, 12, 8])
+        masked_green = np.zeros((len(green), 4), dtype=np.uint8)
+        masked_green[green] = self.green_hp
         return masked_green
 
     def getPlayerDecenteringByStartStop(self, line):
@@ -488,26 +807,22 @@ class GameScreenConnector:
         return line
 
     def removeOutlayersInLine(self, masked_green, high_pixel_color):
-        line = masked_green.copy()
-        n = len(line)
-        i = 0
+        """
+        Splits the line in consecutive windows (pixels 1-15, 16-30, ...) and sets each window completely to
+        high_pixel_color if it has enough high_pixel_color pixels, black otherwise.
+        First pixel and last window_width pixels are always black.
+        """
+        masked_green = np.asarray(masked_green)
+        n = len(masked_green)
         window_width = 15
         min_greens_pixels = 9
-        while i < n:
-            if i in range(window_width):  # First 4 take black. no problem losing them
-                line[i] = [0, 0, 0, 0]
-            else:
-                if i > 370:
-                    a = 3
-                sum = 0
-                for j in range(window_width):
-                    sum += 1 if masked_green[i - j][0] == high_pixel_color[0] else 0
-                for j in range(window_width):
-                    line[i - j] = [0, 0, 0, 0] if sum < min_greens_pixels else high_pixel_color
-                i += window_width - 1  # Skip() and go to next window
-            i += 1
-        for i in range(window_width):  # Last 4 take black. no problem losing them
-            line[n - i - 1] = [0, 0, 0, 0]
+        line = np.zeros((n, len(high_pixel_color)), dtype=np.uint8)
+        windows = (n - 1) // window_width
+        if windows > 0:
+            greens = masked_green[1:1 + windows * window_width, 0] == high_pixel_color[0]
+            green_windows = greens.reshape(windows, window_width).sum(axis=1) >= min_greens_pixels
+            line[1:1 + windows * window_width][np.repeat(green_windows, window_width)] = high_pixel_color
+        line[max(n - window_width, 0):] = 0  # Last ones take black. no problem losing them
         return line
 
     def getHorLine(self, line_name: str, frame=None):
@@ -523,16 +838,13 @@ class GameScreenConnector:
         return self._getHorLine(self.hor_lines[line_name], frame)
 
     def _checkBarHasChanged(self, old_line_hor_bar, current_exp_bar, around=0):
-        if len(old_line_hor_bar) != len(current_exp_bar):
-            min_len = min(len(old_line_hor_bar), len(current_exp_bar))
-            old_line_hor_bar = old_line_hor_bar[:min_len]
-            current_exp_bar = current_exp_bar[:min_len]
-        changed = False
-        for i in range(len(old_line_hor_bar)):
-            if not self.pixel_equals(old_line_hor_bar[i], current_exp_bar[i], around=around):
-                changed = True
-                break
-        return changed
+        min_len = min(len(old_line_hor_bar), len(current_exp_bar))
+        if min_len == 0:
+            return False
+        old_line = np.asarray(old_line_hor_bar[:min_len])
+        current_line = np.asarray(current_exp_bar[:min_len])
+        diff = np.abs(old_line[:, :3].astype(np.int16) - current_line[:, :3].astype(np.int16))
+        return bool(np.any(diff > np.asarray(StaticCoordsChecker.aroundToArray(around), dtype=np.int16)))
 
     def checkExpBarHasChanged(self, old_line_hor_bar, frame=None):
         """
@@ -545,6 +857,12 @@ class GameScreenConnector:
         new_line = self.getLineExpBar(frame)
         return self._checkBarHasChanged(old_line_hor_bar, new_line, around=2)
 
+    def checkExpBarLinesChanged(self, old_line_hor_bar, new_line_hor_bar) -> bool:
+        """
+        As checkExpBarHasChanged, given the new experience bar line (e.g. analysis.lines["exp_bar"])
+        """
+        return self._checkBarHasChanged(old_line_hor_bar, new_line_hor_bar, around=2)
+
     def checkUpperLineHasChanged(self, old_line, frame=None):
         """
         Checks if old upper line is different that this one. If no frame given, it takes a screen.
@@ -0,0 +1,138 @@
+import queue
+import threading
+import time
+
+from WorkerThread import WorkerThread
+
+
+class InputCommand(object):
+    """
+    A tap, swipe or key queued in InputDispatcher, with queued, start and end times (as in time.time())
+    """
+
+    def __init__(self, kind: str, args: tuple):
+        self.kind = kind
+        self.args = args
+        self.queued_time = time.time()
+        self.start_time = None
+        self.end_time = None
+        self.result = None
+        self.cancelled = False
+        self._done = threading.Event()
+
+    def isDone(self) -> bool:
+        return self._done.is_set()
+
+    def wait(self, timeout: float = None) -> bool:
+        return self._done.wait(timeout)
+
+    def _finish(self, result):
+        self.result = result
+        self.end_time = time.time()
+        self._done.set()
+
+
+class InputDispatcher(object):
+    """
+    Sends taps, swipes and keys to the device from its own thread, one after the other in queue order.
+    Callers get an InputCommand back immediately, so they can keep capturing and checking screens while a
+    long swipe is running on device.
+    """
+
+    def __init__(self, device_connector):
+        self.device_connector = device_connector
+        self.commands_sent = 0
+        self._queue = queue.Queue()
+        self._stopRequired = False
+        self._thread = None
+
+    def start(self):
+        if self.isRunning():
+            return
+        self._stopRequired = False
+        self._thread = WorkerThread()
+        self._thread.daemon = True
+        self._thread.function = self._loop
+        self._thread.start()
+
+    def stop(self):
+        self._stopRequired = True
+        self.clear()
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join(5)
+        self._thread = None
+
+    def isRunning(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def tap(self, coord) -> InputCommand:
+        return self._put(InputCommand("tap", (coord,)))
+
+    def swipe(self, locations, s) -> InputCommand:
+        return self._put(InputCommand("swipe", (locations, s)))
+
+    def key(self, keycode: str) -> InputCommand:
+        return self._put(InputCommand("key", (keycode,)))
+
+    def _put(self, command: InputCommand) -> InputCommand:
+        self._queue.put(command)
+        return command
+
+    def pending(self) -> int:
+        """
+        Commands queued or running
+        """
+        return self._queue.unfinished_tasks
+
+    def isIdle(self) -> bool:
+        return self.pending() == 0
+
+    def waitIdle(self, timeout: float = None) -> bool:
+        """
+        Waits for all queued commands to end. Returns False on timeout.
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        with self._queue.all_tasks_done:
+            while self._queue.unfinished_tasks > 0:
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._queue.all_tasks_done.wait(remaining)
+        return True
+
+    def clear(self):
+        """
+        Drops commands not started yet. The running one ends normally.
+        """
+        while True:
+            try:
+                command = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            command.cancelled = True
+            command._finish(False)
+            self._queue.task_done()
+
+    def _run(self, command: InputCommand) -> bool:
+        if command.kind == "tap":
+            return self.device_connector.adb_tap(*command.args)
+        if command.kind == "swipe":
+            return self.device_connector.adb_swipe(*command.args)
+        return self.device_connector.adb_tap_key(*command.args)
+
+    def _loop(self):
+        while not self._stopRequired:
+            try:
+                command = self._queue.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            command.start_time = time.time()
+            result = False
+            try:
+                result = self._run(command)
+            except Exception as e:
+                print("Input %s failed: %s" % (command.kind, str(e)))
+            finally:
+                command._finish(result)
+                self.commands_sent += 1
+                self._queue.task_done()
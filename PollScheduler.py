@@ -0,0 +1,57 @@
+import time
+
+
+class PollScheduler(object):
+    """
+    Decides when the in-room loop checks the screen.
+    The interval drops to min_interval when something changed since last poll (state or exp bar) and grows by
+    backoff up to max_interval while the screen stays stable. Near the expected room clear time (learned from
+    previous rooms) it always polls at min_interval.
+    """
+
+    def __init__(self, min_interval: float = 0.5, max_interval: float = 4.0, backoff: float = 1.5,
+                 near_clear: float = 0.7, clear_smoothing: float = 0.3):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.near_clear = near_clear # fraction of expected clear time after which polling is fast
+        self.clear_smoothing = clear_smoothing # weight of last room in expected clear time
+        self.expected_clear = None # seconds from room start to room cleared, None until a room is cleared
+        self.interval = min_interval
+        self.room_start = time.time()
+        self.last_poll = 0.0
+        self.polls = 0
+
+    def startRoom(self):
+        self.room_start = time.time()
+        self.interval = self.min_interval
+        self.last_poll = 0.0
+        self.polls = 0
+
+    def elapsed(self) -> float:
+        return time.time() - self.room_start
+
+    def currentInterval(self) -> float:
+        if self.expected_clear is not None and self.elapsed() >= self.near_clear * self.expected_clear:
+            return self.min_interval
+        return self.interval
+
+    def timeToPoll(self) -> float:
+        """
+        Seconds until next poll is due (0 if already due)
+        """
+        return max(0.0, self.last_poll + self.currentInterval() - time.time())
+
+    def isDue(self) -> bool:
+        return self.timeToPoll() == 0.0
+
+    def polled(self, changed: bool):
+        self.last_poll = time.time()
+        self.polls += 1
+        self.interval = self.min_interval if changed else min(self.interval * self.backoff, self.max_interval)
+
+    def roomCleared(self, clear_time: float):
+        if self.expected_clear is None:
+            self.expected_clear = clear_time
+        else:
+            self.expected_clear += self.clear_smoothing * (clear_time - self.expected_clear)
@@ -0,0 +1,249 @@
+import json
+import os
+import threading
+import time
+
+from Frame import Frame
+from SessionRecorder import SessionRecorder
+from TimingStats import timed
+from Utils import loadJsonData, buildDataFolder, getCoordFilePath
+
+
+class ReplayConnector(object):
+    """
+    Stand-in for UsbConnector with no device behind: screens come from a script (a state graph over screenshots)
+    and every tap, swipe and key is logged with its time. CaveEngine runs on it unchanged, so engine loops can be
+    profiled end to end on any machine.
+
+    Script (json) format:
+    {
+      "size": [1080, 1920],
+      "screens": "datas/1080x1920/screens",
+      "start": "room",
+      "states": {
+        "room": {"screen": "play_ingame.png", "after_frames": [6, "doors"]},
+        "doors": {"screen": "play_center_door.png", "swipe": "room"},
+        "popup": {"screen": "play_met_devil.png", "taps": {"daemon_reject": "room"}, "after_seconds": [10, "room"]}
+      }
+    }
+    A state shows its screen until a transition fires: "taps" (buttons.json names, "*" for any tap), "swipe" (any
+    swipe), "keys" (keycodes), "after_frames" (screens served in the state) or "after_seconds". A state without
+    transitions ends the replay: screens stay the same.
+
+    With session_path (a SessionRecorder folder or segment) the recorded screens are served in order instead,
+    whatever the inputs, and the last one is repeated once they are over. Downsampled recordings are scaled back
+    to the size given (nearest pixel), record with downsample 1 for exact screens.
+    """
+
+    def __init__(self, script_path: str = None, script: dict = None, session_path: str = None,
+                 size: tuple = (1080, 1920)):
+        self.debug = False
+        self.connected = False
+        self.serial = "replay"
+        self.my_device = None
+        self.screen_streamer = None
+        self.last_input_time = 0.0
+        self.timings = None
+        self.connectionChangedFunctions = []
+        self.checkingConnectionFunctions = []
+        self.input_time_scale = 0.0 # swipes last this fraction of their duration (0: they return at once)
+        self.tap_tolerance = 5 # pixels between a tap and a button to match it
+        self._session_frames = None
+        self._session_frame = None
+        if session_path is not None:
+            self._session_frames = SessionRecorder.readFrames(session_path, size[0], size[1])
+            script = {"size": list(size), "start": "session", "states": {"session": {"screen": None}}}
+        self.script = loadJsonData(script_path) if script is None else script
+        self.width, self.height = self.script["size"]
+        self.screens_path = self.script.get("screens", os.path.join("datas", buildDataFolder(self.width, self.height),
+                                                                     "screens"))
+        self.states = self.script["states"]
+        self.buttons = loadJsonData(getCoordFilePath("buttons.json", sizePath=buildDataFolder(self.width,
+                                                                                             self.height)))
+        # (time, kind, args, state before, state after) of every input
+        self.inputs = []
+        # (time, state) of every state change
+        self.transitions = []
+        self.frames_served = 0
+        self.state = None
+        self._state_frames = 0
+        self._state_start = 0.0
+        self._frames = {}
+        self._lock = threading.Lock()
+        self._setState(self.script["start"])
+
+    def _changeConnectedState(self, c):
+        if self.connected != c:
+            self.connected = c
+            for f in self.connectionChangedFunctions:
+                f(self.connected)
+
+    def setFunctionToCallOnConnectionStateChanged(self, function):
+        if function not in self.connectionChangedFunctions:
+            self.connectionChangedFunctions.append(function)
+
+    def setFunctionToCallOnCheckingConnectionStateChanged(self, function):
+        if function not in self.checkingConnectionFunctions:
+            self.checkingConnectionFunctions.append(function)
+
+    def connect(self) -> bool:
+        self._changeConnectedState(True)
+        return True
+
+    def tryConnect(self) -> bool:
+        return self.connect()
+
+    def disconnect(self) -> bool:
+        self._changeConnectedState(False)
+        return True
+
+    def stopConnectionCheck(self):
+        pass
+
+    def isConnected(self):
+        return self.connected
+
+    def setCaptureMode(self, mode, serial: str = None):
+        pass
+
+    def getCaptureMode(self, serial: str = None):
+        return None
+
+    def isStreaming(self) -> bool:
+        return False
+
+    def startScreenStream(self, fps: float = 5.0, buffer_size: int = 3):
+        return False
+
+    def stopScreenStream(self):
+        pass
+
+    def getRawScreenLayout(self):
+        return None
+
+    def adb_get_size(self) -> tuple:
+        return self.width, self.height
+
+    def _loadFrame(self, screen: str) -> Frame:
+        frame = self._frames.get(screen)
+        if frame is None:
+            frame = Frame.fromFile(os.path.join(self.screens_path, screen))
+            if frame.size != (self.width, self.height):
+                raise Exception("Replay screen %s is %dx%d, script size is %dx%d" % (
+                    screen, frame.width, frame.height, self.width, self.height))
+            self._frames[screen] = frame
+        return frame
+
+    def _setState(self, state: str):
+        if state not in self.states:
+            raise Exception("Replay state %s is not in script" % state)
+        if self.debug: print("Replay state: %s -> %s" % (self.state, state))
+        self.state = state
+        self._state_frames = 0
+        self._state_start = time.time()
+        self.transitions.append((self._state_start, state))
+
+    @timed
+    def captureFrame(self) -> Frame:
+        with self._lock:
+            t = time.time()
+            current = self.states[self.state]
+            after = current.get("after_seconds")
+            if after is not None and t - self._state_start >= after[0]:
+                self._setState(after[1])
+            after = self.states[self.state].get("after_frames")
+            if after is not None and self._state_frames >= after[0]:
+                self._setState(after[1])
+            self._state_frames += 1
+            self.frames_served += 1
+            if self._session_frames is not None:
+                return Frame(self._nextSessionFrame().pixels, t)
+            # frames of the same screen share pixels, only the timestamp changes
+            return Frame(self._loadFrame(self.states[self.state]["screen"]).pixels, t)
+
+    def _nextSessionFrame(self) -> Frame:
+        frame = next(self._session_frames, None)
+        if frame is not None:
+            self._session_frame = frame
+        elif self._session_frame is None:
+            raise Exception("Replay session has no frames")
+        return self._session_frame
+
+    def adb_screen_getpixels(self, return_pillow: bool = False, after: float = None):
+        frame = self.captureFrame()
+        return frame.pil() if return_pillow else frame
+
+    def captureFrameRows(self, bands: list) -> Frame:
+        return self.captureFrame()
+
+    def captureEncoded(self):
+        frame = self.captureFrame()
+        return "rgba", frame.pixels, frame.timestamp
+
+    def adb_screen(self, name: str = "screen.png") -> bool:
+        self.captureFrame().pil().save(name)
+        return True
+
+    def _input(self, kind: str, args: tuple, transition: str):
+        with self._lock:
+            before = self.state
+            if transition is not None:
+                self._setState(transition)
+            self.inputs.append((time.time(), kind, args, before, self.state))
+        if self.debug: print("Replay %s %s in %s" % (kind, str(args), before))
+
+    def _tapTransition(self, x: int, y: int) -> str:
+        taps = self.states[self.state].get("taps", {})
+        for name, state in taps.items():
+            if name == "*":
+                continue
+            bx, by = self.buttons[name][0] * self.width, self.buttons[name][1] * self.height
+            if abs(bx - x) <= self.tap_tolerance and abs(by - y) <= self.tap_tolerance:
+                return state
+        return taps.get("*")
+
+    @timed
+    def adb_tap(self, coord) -> bool:
+        if not self.connected:
+            return False
+        x, y = int(coord[0]), int(coord[1])
+        self._input("tap", (x, y), self._tapTransition(x, y))
+        self.last_input_time = time.time()
+        return True
+
+    @timed
+    def adb_swipe(self, locations, s) -> bool:
+        if not self.connected:
+            return False
+        if self.input_time_scale > 0:
+            time.sleep(s * self.input_time_scale)
+        self._input("swipe", tuple(int(v) for v in locations) + (s,), self.states[self.state].get("swipe"))
+        self.last_input_time = time.time()
+        return True
+
+    @timed
+    def adb_tap_key(self, keycode: str) -> bool:
+        if not self.connected:
+            return False
+        self._input("key", (keycode,), self.states[self.state].get("keys", {}).get(keycode))
+        self.last_input_time = time.time()
+        return True
+
+    def adb_shell(self, command: str) -> str:
+        self._input("shell", (command,), None)
+        return ""
+
+    def startMacro(self, commands: list):
+        # moves are sent one by one, see CaveEngine.play_macro
+        return None
+
+    def saveInputs(self, path: str):
+        """
+        Writes inputs and state changes log as json
+        """
+        with open(path, 'w') as json_file:
+            json.dump({
+                "inputs": [{"time": t, "kind": kind, "args": list(args), "state": before, "next_state": after}
+                           for t, kind, args, before, after in self.inputs],
+                "transitions": [{"time": t, "state": state} for t, state in self.transitions],
+            }, json_file, indent=1)
@@ -0,0 +1,128 @@
+import collections
+import threading
+import time
+
+from Frame import Frame
+from WorkerThread import WorkerThread
+
+
+class ScreenStreamer(object):
+    """
+    Captures frames continuously in a background thread and keeps the newest ones in a small ring buffer.
+    With raw capture a single adb connection is kept open: the device runs a screencap loop and
+    frames are read back to back from the same stream. With png capture, frames are polled one by one.
+    """
+
+    def __init__(self, device_connector, fps: float = 5.0, buffer_size: int = 3):
+        self.device_connector = device_connector
+        self.fps = fps
+        self.buffer_size = buffer_size
+        self.frames = collections.deque(maxlen=buffer_size)
+        self.framesCaptured = 0
+        self._condition = threading.Condition()
+        self._stopRequired = False
+        self._running = False
+        self._conn = None
+        self._thread = None
+
+    def start(self):
+        if self._running:
+            return
+        self._stopRequired = False
+        self._running = True
+        self._thread = WorkerThread()
+        self._thread.daemon = True
+        self._thread.function = self._loop
+        self._thread.start()
+
+    def stop(self):
+        self._stopRequired = True
+        conn = self._conn
+        if conn is not None:
+            # unlocks the blocking read of the stream thread
+            conn.close()
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join(5)
+        self._thread = None
+
+    def isRunning(self) -> bool:
+        return self._running
+
+    def _push(self, frame: Frame):
+        with self._condition:
+            self.frames.append(frame)
+            self.framesCaptured += 1
+            self._condition.notify_all()
+
+    def latest(self) -> Frame:
+        """
+        Returns newest captured frame without waiting (None if nothing captured yet)
+        """
+        with self._condition:
+            return self.frames[-1] if len(self.frames) > 0 else None
+
+    def waitFrameAfter(self, t: float, timeout: float = 5.0) -> Frame:
+        """
+        Returns first frame captured after time t (as in time.time()). Waits for it up to timeout seconds.
+        Returns None on timeout or if the stream is not running.
+        """
+        deadline = time.time() + timeout
+        with self._condition:
+            while True:
+                if len(self.frames) > 0 and self.frames[-1].timestamp > t:
+                    for frame in self.frames:
+                        if frame.timestamp > t:
+                            return frame
+                remaining = deadline - time.time()
+                if remaining <= 0 or not self._running:
+                    return None
+                self._condition.wait(remaining)
+
+    def _loop(self):
+        try:
+            raw_layout = self.device_connector.getRawScreenLayout()
+            if raw_layout is not None:
+                self._loopRaw(*raw_layout)
+            else:
+                self._loopPolling()
+        except Exception as e:
+            if not self._stopRequired:
+                print("Screen stream stopped: %s" % str(e))
+        finally:
+            self._running = False
+            self._conn = None
+            with self._condition:
+                self._condition.notify_all()
+
+    def _loopPolling(self):
+        period = 1.0 / self.fps if self.fps > 0 else 0
+        while not self._stopRequired and self.device_connector.connected:
+            t_start = time.time()
+            self._push(self.device_connector.captureFrame())
+            elapsed = time.time() - t_start
+            if elapsed < period:
+                time.sleep(period - elapsed)
+
+    def _loopRaw(self, width: int, height: int, header_size: int):
+        frame_size = header_size + width * height * 4
+        sleep = "sleep %.3f; " % (1.0 / self.fps) if self.fps > 0 else ""
+        conn = self.device_connector.my_device.create_connection()
+        self._conn = conn
+        # A frame must not look taken after an input sent during its screencap: frames are stamped with a time the
+        # screencap had not started yet. Next screencap starts once the device wrote a whole frame, and a frame is
+        # much bigger than the socket buffers: it can not start before the host read (almost) all previous frame.
+        t_start = time.time()
+        conn.send("exec:sh -c 'while true; do /system/bin/screencap; %sdone'" % sleep)
+        with conn:
+            while not self._stopRequired:
+                buffer = bytearray(frame_size)
+                view = memoryview(buffer)
+                received = 0
+                while received < frame_size:
+                    n = conn.socket.recv_into(view[received:], frame_size - received)
+                    if n == 0:
+                        raise Exception("screen stream closed by device")
+                    received += n
+                t_read = time.time()
+                self._push(Frame.fromBuffer(buffer, width, height, offset=header_size, timestamp=t_start))
+                t_start = t_read
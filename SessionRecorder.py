@@ -0,0 +1,316 @@
+import json
+import os
+import queue
+import shutil
+import struct
+import threading
+import time
+import zlib
+from datetime import datetime
+
+import numpy as np
+
+from Frame import Frame
+from WorkerThread import WorkerThread
+
+
+class SessionRecorder(object):
+    """
+    Rolling recording of a session: screens (downsampled, stored as difference with the previous one), classified
+    states, inputs and waits, each with its wall-clock time. Callers only queue records: a background thread
+    encodes and writes them in zlib compressed chunks of segment files. Only the newest max_segments segments are
+    kept, so disk usage is bounded and recording can stay on: saveSnapshot keeps the last minutes before a crash
+    or an unknown screen state.
+
+    Segment file: chunks of <II> (compressed size, records count) + zlib data, the first record is a header.
+    Record: <BdI> (kind, time, payload size) + payload. Frame payload is <HHB> (width, height, keyframe) + RGB
+    pixels, xor of previous frame ones unless keyframe. Other payloads are json.
+    """
+    kinds = ["header", "frame", "state", "input", "wait", "mark"]
+    version = 1
+    _chunk_header = struct.Struct("<II")
+    _record_header = struct.Struct("<BdI")
+    _frame_header = struct.Struct("<HHB")
+
+    def __init__(self, folder: str = "recordings"):
+        self.debug = False
+        self.folder = folder
+        self.segment_seconds = 60.0 # a new segment file is started every these seconds
+        self.max_segments = 10 # older segments are deleted: about max_segments * segment_seconds of history
+        self.downsample = 2 # one pixel every these in both directions is kept (1 keeps whole frames for replays)
+        self.keyframe_interval = 50 # frames stored whole every these, others as difference with previous one
+        self.min_frame_interval = 0.0 # seconds between recorded frames (0 records every frame taken)
+        self.chunk_records = 64 # records compressed together
+        self.flush_interval = 1.0 # seconds a chunk can stay in memory: at most this is lost on a hard crash
+        self.compression_level = 1
+        self.max_pending_frames = 8 # frames waiting for the writer, newer ones are dropped (not counted as lost)
+        self.records_written = 0
+        self.frames_written = 0
+        self.frames_dropped = 0
+        self.bytes_written = 0
+        self.segments = [] # segment files on disk, oldest first
+        self._queue = queue.Queue()
+        self._pending_frames = 0
+        self._last_frame_time = None
+        self._thread = None
+        self._stopRequired = False
+        self._lock = threading.Lock()
+        # writer thread state
+        self._file = None
+        self._segment_start = None
+        self._compressor = None
+        self._chunk_parts = []
+        self._chunk_count = 0
+        self._chunk_time = None
+        self._previous_frame = None
+        self._frames_since_key = 0
+
+    def start(self):
+        if self.isRunning():
+            return
+        if not os.path.exists(self.folder):
+            os.makedirs(self.folder)
+        # segments of previous runs count in disk usage too
+        self.segments = sorted(os.path.join(self.folder, f) for f in os.listdir(self.folder)
+                               if f.startswith("segment_") and f.endswith(".rec"))
+        self._stopRequired = False
+        self._thread = WorkerThread()
+        self._thread.daemon = True
+        self._thread.function = self._writeLoop
+        self._thread.start()
+
+    def stop(self):
+        if not self.isRunning():
+            return
+        self._stopRequired = True
+        self._queue.put(None)
+        self._thread.join()
+        self._thread = None
+
+    def isRunning(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def recordFrame(self, frame: Frame):
+        if not self.isRunning() or frame is None or frame.timestamp == self._last_frame_time:
+            return
+        if self._last_frame_time is not None and frame.timestamp - self._last_frame_time < self.min_frame_interval:
+            return
+        with self._lock:
+            if self._pending_frames >= self.max_pending_frames:
+                self.frames_dropped += 1
+                return
+            self._pending_frames += 1
+        self._last_frame_time = frame.timestamp
+        # frames are not modified once taken: pixels are encoded later by the writer thread
+        self._queue.put((1, frame.timestamp, frame))
+
+    def recordState(self, state: str):
+        self._record(2, state)
+
+    def recordInput(self, kind: str, args):
+        self._record(3, [kind, args])
+
+    def recordWait(self, s: float):
+        self._record(4, s)
+
+    def mark(self, text: str):
+        self._record(5, text)
+
+    def _record(self, kind: int, value):
+        if self.isRunning():
+            self._queue.put((kind, time.time(), value))
+
+    def flush(self, timeout: float = 5.0) -> bool:
+        """
+        Waits until records queued so far are on disk
+        """
+        if not self.isRunning():
+            return False
+        written = threading.Event()
+        self._queue.put((-1, time.time(), written))
+        return written.wait(timeout)
+
+    def saveSnapshot(self, reason: str) -> str:
+        """
+        Copies the segments on disk (the last minutes recorded) to a snapshot folder kept out of the rotation.
+        Returns the snapshot folder.
+        """
+        self.mark(reason)
+        self.flush()
+        name = "snapshot_%s_%s" % (datetime.now().strftime("%Y%m%d_%H%M%S"),
+                                   "".join(c if c.isalnum() else "_" for c in reason))
+        path = os.path.join(self.folder, name)
+        os.makedirs(path, exist_ok=True)
+        with self._lock:
+            segments = list(self.segments)
+        for segment in segments:
+            try:
+                shutil.copy(segment, path)
+            except OSError as e:
+                print("Unable to copy %s to snapshot: %s" % (segment, str(e)))
+        print("Session snapshot saved in %s" % path)
+        return path
+
+    def _writeLoop(self):
+        try:
+            while True:
+                try:
+                    item = self._queue.get(timeout=self.flush_interval)
+                except queue.Empty:
+                    self._writeChunk()
+                    continue
+                if item is None:
+                    break
+                kind, t, value = item
+                if kind == -1:
+                    self._writeChunk()
+                    value.set()
+                    continue
+                try:
+                    self._writeRecord(kind, t, value)
+                except Exception as e:
+                    print("Session recording failed: %s" % str(e))
+                finally:
+                    if kind == 1:
+                        with self._lock:
+                            self._pending_frames -= 1
+                if self._chunk_count >= self.chunk_records or time.time() - self._chunk_time >= self.flush_interval:
+                    self._writeChunk()
+        finally:
+            self._closeSegment()
+
+    def _writeRecord(self, kind: int, t: float, value):
+        if self._file is None or t - self._segment_start >= self.segment_seconds:
+            self._openSegment(t)
+        if kind == 1:
+            payload = self._encodeFrame(value)
+            self.frames_written += 1
+        else:
+            payload = json.dumps(value).encode('utf-8')
+        self._addToChunk(kind, t, payload)
+
+    def _encodeFrame(self, frame: Frame) -> bytes:
+        pixels = np.ascontiguousarray(frame.pixels[::self.downsample, ::self.downsample, :3])
+        previous = self._previous_frame
+        keyframe = previous is None or previous.shape != pixels.shape or \
+                   self._frames_since_key >= self.keyframe_interval
+        self._previous_frame = pixels
+        if keyframe:
+            self._frames_since_key = 0
+            data = pixels.tobytes()
+        else:
+            self._frames_since_key += 1
+            # unchanged pixels become zeros, which compress to almost nothing
+            data = np.bitwise_xor(pixels, previous).tobytes()
+        return self._frame_header.pack(pixels.shape[1], pixels.shape[0], keyframe) + data
+
+    def _addToChunk(self, kind: int, t: float, payload: bytes):
+        if self._compressor is None:
+            self._compressor = zlib.compressobj(self.compression_level)
+            self._chunk_time = time.time()
+        self._chunk_parts.append(self._compressor.compress(self._record_header.pack(kind, t, len(payload))))
+        self._chunk_parts.append(self._compressor.compress(payload))
+        self._chunk_count += 1
+        self.records_written += 1
+
+    def _writeChunk(self):
+        if self._compressor is None:
+            return
+        self._chunk_parts.append(self._compressor.flush())
+        data = b"".join(self._chunk_parts)
+        self._file.write(self._chunk_header.pack(len(data), self._chunk_count))
+        self._file.write(data)
+        self._file.flush()
+        self.bytes_written += self._chunk_header.size + len(data)
+        self._compressor = None
+        self._chunk_parts = []
+        self._chunk_count = 0
+
+    def _openSegment(self, t: float):
+        self._closeSegment()
+        path = os.path.join(self.folder, "segment_%d.rec" % int(t * 1000))
+        if self.debug: print("Recording segment %s" % path)
+        self._file = open(path, 'wb')
+        self._segment_start = t
+        # each segment can be read alone: it starts with a header and a keyframe
+        self._previous_frame = None
+        self._addToChunk(0, t, json.dumps({"version": self.version, "downsample": self.downsample}).encode('utf-8'))
+        with self._lock:
+            self.segments.append(path)
+            old = self.segments[:-self.max_segments] if len(self.segments) > self.max_segments else []
+            self.segments = self.segments[len(old):]
+        for segment in old:
+            try:
+                os.remove(segment)
+            except OSError as e:
+                print("Unable to remove old segment %s: %s" % (segment, str(e)))
+
+    def _closeSegment(self):
+        if self._file is None:
+            return
+        self._writeChunk()
+        self._file.close()
+        self._file = None
+
+    @staticmethod
+    def readSession(path: str):
+        """
+        Yields (kind, time, value) of the records in a segment file or in the segments of a folder, oldest first.
+        Frames are Frame objects of the downsampled size. A chunk cut by a crash ends its segment.
+        """
+        if os.path.isdir(path):
+            files = sorted(os.path.join(path, f) for f in os.listdir(path)
+                           if f.startswith("segment_") and f.endswith(".rec"))
+        else:
+            files = [path]
+        for file in files:
+            yield from SessionRecorder._readSegment(file)
+
+    @staticmethod
+    def _readSegment(file: str):
+        previous = None
+        with open(file, 'rb') as f:
+            while True:
+                header = f.read(SessionRecorder._chunk_header.size)
+                if len(header) < SessionRecorder._chunk_header.size:
+                    return
+                size, count = SessionRecorder._chunk_header.unpack(header)
+                data = f.read(size)
+                if len(data) < size:
+                    return
+                data = zlib.decompress(data)
+                offset = 0
+                for _ in range(count):
+                    kind, t, length = SessionRecorder._record_header.unpack_from(data, offset)
+                    offset += SessionRecorder._record_header.size
+                    payload = data[offset:offset + length]
+                    offset += length
+                    if kind == 1:
+                        w, h, keyframe = SessionRecorder._frame_header.unpack_from(payload)
+                        pixels = np.frombuffer(payload, dtype=np.uint8,
+                                               offset=SessionRecorder._frame_header.size).reshape(h, w, 3)
+                        if not keyframe:
+                            pixels = np.bitwise_xor(pixels, previous)
+                        previous = pixels
+                        rgba = np.full((h, w, 4), 255, dtype=np.uint8)
+                        rgba[:, :, :3] = pixels
+                        yield "frame", t, Frame(rgba, t)
+                    else:
+                        yield SessionRecorder.kinds[kind], t, json.loads(payload.decode('utf-8'))
+
+    @staticmethod
+    def readFrames(path: str, width: int = None, height: int = None):
+        """
+        Yields the recorded frames scaled back to width x height (nearest pixel), as taken on device
+        """
+        downsample = 1
+        for kind, t, value in SessionRecorder.readSession(path):
+            if kind == "header":
+                downsample = value["downsample"]
+            elif kind == "frame":
+                pixels = value.pixels
+                if downsample > 1:
+                    pixels = pixels.repeat(downsample, axis=0).repeat(downsample, axis=1)
+                if width is not None and height is not None:
+                    pixels = pixels[:height, :width]
+                yield Frame(pixels, t)
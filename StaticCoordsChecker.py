@@ -0,0 +1,108 @@
+import numpy as np
+
+from Frame import Frame
+
+
+class StaticCoordsChecker(object):
+    """
+    Compiles a static coords dictionary (name -> coordinates, values, around) into flat numpy arrays:
+    absolute pixel indexes, lower and upper RGB bounds and the owner check of each point.
+    All checks are then evaluated on a frame with one gather and one broadcast comparison.
+    """
+
+    def __init__(self, coords: dict, width: int, height: int, default_around: int = 2):
+        self.width, self.height = width, height
+        self.names = list(coords.keys())
+        self.name_to_id = {name: i for i, name in enumerate(self.names)}
+        indexes, low, high, owners = [], [], [], []
+        # [start, end) of each check points inside the flat arrays
+        self.slices = []
+        # checks with different sizes of coordinates and values can never be equal
+        self.valid = np.ones(len(self.names), dtype=bool)
+        for i, name in enumerate(self.names):
+            v = coords[name]
+            around = self.aroundToArray(v["around"] if "around" in v else default_around)
+            start = len(indexes)
+            if len(v["coordinates"]) != len(v["values"]):
+                print("Wrong size between points and values for %s!" % name)
+                self.valid[i] = False
+            else:
+                for c, value in zip(v["coordinates"], v["values"]):
+                    x, y = int(c[0] * width), int(c[1] * height)
+                    indexes.append(int(y * width + x))
+                    low.append([value[k] - around[k] for k in range(3)])
+                    high.append([value[k] + around[k] for k in range(3)])
+                    owners.append(i)
+            self.slices.append((start, len(indexes)))
+        self.indexes = np.array(indexes, dtype=np.int64)
+        self.low = np.array(low, dtype=np.int16).reshape(-1, 3)
+        self.high = np.array(high, dtype=np.int16).reshape(-1, 3)
+        self.owners = np.array(owners, dtype=np.int64)
+
+    def toArrays(self, prefix: str) -> dict:
+        """
+        Returns compiled data as a dictionary of numpy arrays (keys starting with prefix), see fromArrays
+        """
+        return {prefix + "indexes": self.indexes, prefix + "low": self.low, prefix + "high": self.high,
+                prefix + "owners": self.owners, prefix + "valid": self.valid,
+                prefix + "slices": np.array(self.slices, dtype=np.int64).reshape(-1, 2),
+                prefix + "names": np.array(self.names, dtype=str),
+                prefix + "size": np.array([self.width, self.height], dtype=np.int64)}
+
+    @staticmethod
+    def fromArrays(arrays, prefix: str):
+        """
+        Builds a checker from arrays saved with toArrays, without compiling coordinates again
+        """
+        checker = StaticCoordsChecker({}, 0, 0)
+        checker.width, checker.height = [int(v) for v in arrays[prefix + "size"]]
+        checker.names = [str(n) for n in arrays[prefix + "names"]]
+        checker.name_to_id = {name: i for i, name in enumerate(checker.names)}
+        checker.indexes = arrays[prefix + "indexes"]
+        checker.low = arrays[prefix + "low"]
+        checker.high = arrays[prefix + "high"]
+        checker.owners = arrays[prefix + "owners"]
+        checker.valid = arrays[prefix + "valid"]
+        checker.slices = [(int(a), int(b)) for a, b in arrays[prefix + "slices"]]
+        return checker
+
+    @staticmethod
+    def aroundToArray(around) -> list:
+        """
+        Tolerance of each RGB channel from an "around" value: an int for all channels or a list, 5 otherwise
+        """
+        if isinstance(around, int):
+            return [around, around, around]
+        elif isinstance(around, list):
+            return [around[0], around[1], around[2]]
+        return [5, 5, 5]
+
+    def pointsEqual(self, frame: Frame) -> np.ndarray:
+        """
+        Returns a boolean array telling, for each compiled point, if the frame pixel is inside its bounds
+        """
+        px = frame.flat[self.indexes, :3]
+        return np.all((px >= self.low) & (px <= self.high), axis=1)
+
+    def checkAll(self, frame: Frame) -> np.ndarray:
+        """
+        Returns a boolean array (one for each name, same order) telling which checks are equal on frame
+        """
+        points_ok = self.pointsEqual(frame)
+        failed = np.bincount(self.owners, weights=~points_ok, minlength=len(self.names))
+        return (failed == 0) & self.valid
+
+    def check(self, frame: Frame, name: str) -> bool:
+        i = self.name_to_id[name]
+        if not self.valid[i]:
+            return False
+        start, end = self.slices[i]
+        px = frame.flat[self.indexes[start:end], :3]
+        return bool(np.all((px >= self.low[start:end]) & (px <= self.high[start:end])))
+
+    def first(self, frame: Frame) -> str:
+        """
+        Returns the first name (in dictionary order) equal on frame, None if no one is.
+        """
+        equal = np.flatnonzero(self.checkAll(frame))
+        return self.names[equal[0]] if len(equal) > 0 else None
@@ -1,17 +1,20 @@
 import os
 import csv
+import json
 from datetime import datetime
 import time
 
 
 class StatisticsManager(object):
 
-    def __init__(self):
+    def __init__(self, file_name: str = 'statistics.csv'):
         self.statistics_folder = 'datas'
         if not os.path.isdir(self.statistics_folder):
             print("info: creating statistics folder (this should already exist, something wrong is going on)")
             os.mkdir(self.statistics_folder)
-        self.file_path = os.path.join(self.statistics_folder, 'statistics.csv')
+        self.file_path = os.path.join(self.statistics_folder, file_name)
+        # one json line for each game: "Time Start" (as in file_path) and the game timing spans
+        self.timings_file_path = os.path.splitext(self.file_path)[0] + "_timings.jsonl"
         self.dateFormat = "%d%m%Y_%H%M%S"
         if not os.path.exists(self.file_path):
             self._write(self.getHeader())
@@ -24,6 +27,19 @@ class StatisticsManager(object):
         self._write([start_date.strftime(self.dateFormat), end_date.strftime(self.dateFormat), lvl_start, lvl_end,
                      (end_date - start_date).total_seconds(), dungeon, status_start, status_end])
 
+    def saveGameTimings(self, start_date, timings: dict):
+        """
+        Appends the timing spans of a game (see TimingStats.dumpGame) to timings_file_path
+        """
+        try:
+            with open(self.timings_file_path, 'a') as write_obj:
+                write_obj.write(json.dumps({"Time Start": start_date.strftime(self.dateFormat), "timings": timings},
+                                           separators=(',', ':')) + "\n")
+            return True
+        except Exception as e:
+            print("Errors writing timings: %s" % str(e))
+            return False
+
     def _write(self, data: list):
         try:
             with open(self.file_path, 'a+', newline='') as write_obj:
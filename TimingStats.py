@@ -0,0 +1,134 @@
+import bisect
+import functools
+import threading
+import time
+
+
+def timed(function):
+    """
+    Method decorator: each call is a timing span added to self.timings (a TimingStats, when set) under the method
+    name. Spans are inclusive: a method calling other timed methods counts their time too.
+    """
+    name = function.__name__
+
+    @functools.wraps(function)
+    def wrapper(self, *args, **kwargs):
+        timings = getattr(self, "timings", None)
+        if timings is None or not timings.enabled:
+            return function(self, *args, **kwargs)
+        start = time.perf_counter()
+        try:
+            return function(self, *args, **kwargs)
+        finally:
+            timings.add(name, time.perf_counter() - start)
+    return wrapper
+
+
+class TimingStats(object):
+    """
+    Aggregates timing spans (captures, checks, inputs, waits, level handlers...) into histograms for the current
+    game and for each of its levels, so the time of a slow cycle can be split by cause.
+    Spans can be added from any thread and summaries read meanwhile (e.g. from the GUI).
+    """
+    # histogram buckets upper bounds, in milliseconds (last bucket has no bound)
+    buckets_ms = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000, 30000]
+
+    def __init__(self):
+        self.enabled = True
+        self.current_level = None
+        self.game_start = time.time()
+        self.game = {} # span name -> [count, total seconds, max seconds, buckets counts]
+        self.levels = {} # level -> same as game, for spans added while the level was played
+        self.last_game = None # dump of the previous game
+        self._lock = threading.Lock()
+
+    def startGame(self):
+        with self._lock:
+            if len(self.game) > 0:
+                self.last_game = self._dump()
+            self.game = {}
+            self.levels = {}
+            self.current_level = None
+            self.game_start = time.time()
+
+    def startLevel(self, level: int):
+        self.current_level = level
+
+    def add(self, name: str, seconds: float):
+        if not self.enabled:
+            return
+        bucket = bisect.bisect_left(self.buckets_ms, seconds * 1000)
+        with self._lock:
+            self._addTo(self.game, name, seconds, bucket)
+            if self.current_level is not None:
+                self._addTo(self.levels.setdefault(self.current_level, {}), name, seconds, bucket)
+
+    def _addTo(self, spans: dict, name: str, seconds: float, bucket: int):
+        stat = spans.get(name)
+        if stat is None:
+            stat = [0, 0.0, 0.0, [0] * (len(self.buckets_ms) + 1)]
+            spans[name] = stat
+        stat[0] += 1
+        stat[1] += seconds
+        stat[2] = max(stat[2], seconds)
+        stat[3][bucket] += 1
+
+    def _percentile(self, buckets: list, count: int, q: float) -> float:
+        # upper bound of the bucket reaching q of the spans (summaries clamp it to the max span)
+        cumulative = 0
+        for i, n in enumerate(buckets):
+            cumulative += n
+            if cumulative >= q * count:
+                return float(self.buckets_ms[i]) if i < len(self.buckets_ms) else float("inf")
+        return float("inf")
+
+    def _summarize(self, spans: dict) -> dict:
+        summary = {}
+        for name, (count, total, max_s, buckets) in spans.items():
+            summary[name] = {
+                "count": count,
+                "total_s": total,
+                "mean_ms": total * 1000 / count,
+                "p50_ms": min(self._percentile(buckets, count, 0.5), max_s * 1000),
+                "p95_ms": min(self._percentile(buckets, count, 0.95), max_s * 1000),
+                "max_ms": max_s * 1000,
+                "histogram": list(buckets),
+            }
+        return summary
+
+    def getSummary(self, level: int = None) -> dict:
+        """
+        Span name -> count, total, mean, p50/p95 (bucket bounds, at most max), max and histogram of the game (or of a level)
+        """
+        with self._lock:
+            return self._summarize(self.game if level is None else self.levels.get(level, {}))
+
+    def getLevelsSummary(self) -> dict:
+        with self._lock:
+            return {level: self._summarize(spans) for level, spans in self.levels.items()}
+
+    def _dump(self) -> dict:
+        return {
+            "duration_s": round(time.time() - self.game_start, 3),
+            "game": {name: [count, round(total, 3), round(max_s * 1000, 1), buckets]
+                     for name, (count, total, max_s, buckets) in self.game.items()},
+            "levels": {str(level): {name: [stat[0], round(stat[1], 3)] for name, stat in spans.items()}
+                       for level, spans in self.levels.items()},
+        }
+
+    def dumpGame(self) -> dict:
+        """
+        Current game as json data: duration, span name -> [count, total s, max ms, histogram] and, for each level,
+        span name -> [count, total s]
+        """
+        with self._lock:
+            return self._dump()
+
+    def toText(self, level: int = None) -> str:
+        summary = self.getSummary(level)
+        lines = ["Game: %.0fs" % (time.time() - self.game_start) if level is None else "Level %d" % level]
+        for name, s in sorted(summary.items(), key=lambda item: -item[1]["total_s"]):
+            lines.append("%s: %d x %.1f ms = %.1fs (p95 <= %.0f ms, max %.0f ms)" % (
+                name, s["count"], s["mean_ms"], s["total_s"], s["p95_ms"], s["max_ms"]))
+        return "\n".join(lines)
+
@@ -5,8 +5,16 @@ from PIL import Image
 import numpy as np
 import io
 import time
+import enum
+import struct
 
 from WorkerThread import WorkerThread
+from Frame import Frame
+from ScreenStreamer import ScreenStreamer
+from AdbShellSession import AdbShellSession
+from DeviceMacro import DeviceMacro
+from DeviceTracker import DeviceTracker
+from TimingStats import timed
 
 """
 This is the library
@@ -14,10 +22,17 @@ https://pypi.org/project/pure-python-adb/
 """
 
 
+class CaptureMode(str, enum.Enum):
+    Png = "png"
+    Raw = "raw"
+
+
 class UsbConnector(object):
 
-    def __init__(self):
+    def __init__(self, serial: str = None, device_tracker: DeviceTracker = None):
         self.connected = False
+        # Device serial this connector is bound to. None to use the first device found
+        self.serial = serial
         self._client: AdbClient = None
         self.my_device: Device = None
         self._host = '127.0.0.1'
@@ -26,6 +41,29 @@ class UsbConnector(object):
         self.checkingConnectionFunctions = []
         self.connectionCheckThread = WorkerThread()
         self._continousCheckStopRequired = False
+        # Devices attached and detached are pushed by adb server, see _oneCheck. A given tracker can be shared
+        # with other connectors: it is started and stopped by its owner, not by this connector
+        self._own_tracker = device_tracker is None
+        self.device_tracker = DeviceTracker(self._host, self._port) if device_tracker is None else device_tracker
+        self.reconnect_interval = 5.0 # seconds between connection attempts while no device is connected
+        self.remote_ports = [5037, 62001] # emulators reached with adb connect while no device is attached (nox is 62001)
+        # Capture mode for each device serial. Devices not in here use default_capture_mode
+        self.default_capture_mode = CaptureMode.Png
+        self.capture_modes = {}
+        # Optional background capture. When running, frames are taken from its buffer
+        self.screen_streamer: ScreenStreamer = None
+        # Time of last tap/swipe/key end. Frames older than this do not show the input effects
+        self.last_input_time = 0.0
+        # Optional TimingStats: captures and inputs are timed
+        self.timings = None
+        # Raw screencap (width, height, header_size) of each device serial, see getRawScreenLayout
+        self._raw_layouts = {}
+        self.roi_tmp_file = "/data/local/tmp/archero_bot_roi.raw"
+        # Inputs are sent on one long lived shell instead of opening a shell for each of them
+        self.use_shell_session = True
+        self.shell_session_max_failures = 3 # consecutive failures before going back to one shell for each input
+        self._input_session: AdbShellSession = None
+        self._shell_session_failures = 0
         self._startConnectionCheck()
 
     def _changeConnectedState(self, c):
@@ -41,6 +79,10 @@ class UsbConnector(object):
     def stopConnectionCheck(self):
         print("Stopping continous device check")
         self._continousCheckStopRequired = True
+        if self._own_tracker:
+            self.device_tracker.stop()
+        else:
+            self.device_tracker.wakeUp()
 
     def setFunctionToCallOnConnectionStateChanged(self, function):
         if function not in self.connectionChangedFunctions:
@@ -50,53 +92,47 @@ class UsbConnector(object):
         if function not in self.checkingConnectionFunctions:
             self.checkingConnectionFunctions.append(function)
 
-    def getDeviceSerialNo(self):
-        try:
-            device = os.popen("adb devices").read().split('\n', 1)[1].split("device")[0].strip()
-            device = None if device == '' else device
-            return device
-        except:
-            return None
-
-    # def checkDeviceAvailable(self):
-    #     #     try:
-    #     #         device = os.popen("adb devices").read().split('\n', 1)[1].split("device")[0].strip()
-    #     #         device = None if device == '' else device
-    #     #         return device != '' and device != None
-    #     #     except:
-    #     #         return False
-
     def tryConnect(self) -> bool:
-        # Default is "127.0.0.1" and 5037, but nox is 62001
-        if self.connected and self.getDeviceSerialNo() is not None:
+        """
+        Connects to a ready device among the ones tracked by device_tracker (the bound serial if any).
+        A connected device still listed as ready is kept as it is.
+        """
+        ready = self.device_tracker.getDevices()
+        if self.connected and self.my_device is not None and self.my_device.serial in ready:
             return True
-        self._changeConnectedState(False)
-        self.checkingConnectionChange(True)
-        ports = [5037, 62001]
-        ok = False
-        os.system("adb disconnect")
-        dev = 'device'
-        for p in ports:
-            os.system("adb connect {}:{}".format(self._host, p))
-            dev = self.getDeviceSerialNo()
-            if dev is not None:
-                if 'offline' not in dev:
-                    self._port = 5037
-                    ok = True
-                    break
-            os.system("adb disconnect")
-        if ok:
-            self._client = AdbClient(host=self._host, port=self._port)
-            self.my_device = self._client.device(dev)
-            self._changeConnectedState(True)
+        if self.connected:
+            print("Device %s detached" % self.my_device.serial)
+            self.disconnect()
+        if self.serial is not None:
+            serial = self.serial if self.serial in ready else None
         else:
-            self._changeConnectedState(False)
+            serial = ready[0] if len(ready) > 0 else None
+        if serial is None:
+            return False
+        self.checkingConnectionChange(True)
+        self._client = AdbClient(host=self._host, port=self._port)
+        self.my_device = Device(self._client, serial)
+        self._changeConnectedState(True)
         self.checkingConnectionChange(False)
         return self.connected
 
+    def _connectRemote(self):
+        """
+        Asks adb server to connect emulators listening on remote_ports. New devices come as tracker events.
+        """
+        client = AdbClient(host=self._host, port=self._port)
+        for p in self.remote_ports:
+            try:
+                client.remote_connect(self._host, p)
+            except Exception:
+                pass
+
     def disconnect(self) -> bool:
         if not self.connected:
             return True
+        self.stopScreenStream()
+        self._raw_layouts = {}
+        self._closeInputSession()
         self.my_device = None
         self._client = None
         self._changeConnectedState(False)
@@ -107,9 +143,131 @@ class UsbConnector(object):
             return ''
         return self.my_device.get_serial_no()
 
+    def setCaptureMode(self, mode: CaptureMode, serial: str = None):
+        """
+        Sets the screen capture mode for a device. If no serial given, the current device is used
+        (or the default mode if no device is connected).
+        """
+        mode = CaptureMode(mode)
+        if serial is None and self.my_device is not None:
+            serial = self.my_device.serial
+        if serial is None:
+            self.default_capture_mode = mode
+        else:
+            self.capture_modes[serial] = mode
+
+    def getCaptureMode(self, serial: str = None) -> CaptureMode:
+        if serial is None and self.my_device is not None:
+            serial = self.my_device.serial
+        return self.capture_modes.get(serial, self.default_capture_mode)
+
+    def _screencap_raw_bytes(self):
+        """
+        Reads the uncompressed 'screencap' output (header + RGBA pixels) from device.
+        """
+        conn = self.my_device.create_connection()
+        with conn:
+            # exec: service is not a pty, so the binary stream is not altered by \n -> \r\n conversions
+            conn.send("exec:/system/bin/screencap")
+            data = conn.read_all()
+        return data
+
+    def _screencap_raw(self):
+        """
+        Returns (width, height, pixels) from raw screencap or None if the output can not be parsed.
+        """
+        return self._parse_raw_screencap(self._screencap_raw_bytes())
+
+    @staticmethod
+    def _parse_raw_screencap(data):
+        """
+        Parses raw screencap output: width, height and format as little endian uint32.
+        Android 9+ adds a fourth uint32 (colorspace) so the header is 12 or 16 bytes long.
+        """
+        header = UsbConnector._parse_raw_header(data)
+        if header is None:
+            return None
+        w, h, fmt, offset = header
+        pixels = np.frombuffer(data, dtype=np.uint8, count=w * h * 4, offset=offset).reshape(h, w, 4)
+        if fmt == 2:
+            pixels = pixels.copy()
+            pixels[:, :, 3] = 255
+        elif fmt == 5:
+            pixels = pixels[:, :, [2, 1, 0, 3]]
+        return w, h, pixels
+
+    @staticmethod
+    def _parse_raw_header(data):
+        """
+        Returns (width, height, format, pixels offset) of raw screencap output, None if not supported
+        """
+        if data is None or len(data) < 12:
+            return None
+        w, h, fmt = struct.unpack_from('<III', data, 0)
+        size = w * h * 4
+        if w == 0 or h == 0 or len(data) - size not in (12, 16):
+            return None
+        # 1: RGBA_8888, 2: RGBX_8888, 5: BGRA_8888. Others (e.g. RGB_565) go with png.
+        if fmt not in (1, 2, 5):
+            return None
+        return w, h, fmt, len(data) - size
+
+    def _screencap_raw_or_fallback(self, data=None):
+        """
+        Tries raw capture. If raw header is not parsable, current device is switched to png mode.
+        """
+        try:
+            raw = self._parse_raw_screencap(self._screencap_raw_bytes() if data is None else data)
+        except RuntimeError as e:
+            print("Raw screencap failed: %s" % str(e))
+            raw = None
+        if raw is None:
+            print("Unable to parse raw screencap. Using png capture mode for this device")
+            self.setCaptureMode(CaptureMode.Png)
+        return raw
+
+    def getRawScreenLayout(self):
+        """
+        Returns (width, height, header_size) of raw screencap output if it can be streamed
+        straight into frames (RGBA_8888 only), otherwise None.
+        """
+        if not self.connected or self.getCaptureMode() != CaptureMode.Raw:
+            return None
+        serial = self.my_device.serial
+        if serial not in self._raw_layouts:
+            data = self._screencap_raw_bytes()
+            if self._screencap_raw_or_fallback(data) is None:
+                return None
+            w, h, fmt = struct.unpack_from('<III', data, 0)
+            self._raw_layouts[serial] = (w, h, len(data) - w * h * 4) if fmt == 1 else None
+        return self._raw_layouts[serial]
+
+    def startScreenStream(self, fps: float = 5.0, buffer_size: int = 3):
+        """
+        Starts background frames capture. adb_screen_getpixels will then return buffered frames.
+        """
+        if not self.connected:
+            return False
+        self.stopScreenStream()
+        self.screen_streamer = ScreenStreamer(self, fps, buffer_size)
+        self.screen_streamer.start()
+        return True
+
+    def stopScreenStream(self):
+        if self.screen_streamer is not None:
+            self.screen_streamer.stop()
+            self.screen_streamer = None
+
+    def isStreaming(self) -> bool:
+        return self.screen_streamer is not None and self.screen_streamer.isRunning()
+
     def adb_get_size(self) -> tuple:
         if not self.connected:
             return 0, 0
+        if self.getCaptureMode() == CaptureMode.Raw:
+            raw = self._screencap_raw_or_fallback()
+            if raw is not None:
+                return raw[0], raw[1]
         bytes_screen = self.my_device.screencap()
         im = Image.open(io.BytesIO(bytes_screen))
         w, h = im.size
@@ -126,18 +284,138 @@ class UsbConnector(object):
         os.system("adb exec-out screencap -p > " + name)
         return True
 
-    def adb_screen_getpixels(self, return_pillow:bool):
+    @timed
+    def captureFrame(self) -> Frame:
+        """
+        Takes a screen from device (no streaming buffer). Frame timestamp is the capture start time.
+        """
+        t_start = time.time()
+        frame = None
+        if self.getCaptureMode() == CaptureMode.Raw:
+            raw = self._screencap_raw_or_fallback()
+            if raw is not None:
+                frame = Frame(raw[2], t_start)
+        if frame is None:
+            bytes_screen = self.my_device.screencap()
+            t_decode = time.perf_counter()
+            with Image.open(io.BytesIO(bytes_screen)) as im:
+                frame = Frame.fromImage(im, t_start)
+            if self.timings is not None: self.timings.add("decode_png", time.perf_counter() - t_decode)
+        return frame
+
+    @timed
+    def captureEncoded(self):
+        """
+        Takes a screen from device without decoding it, to decode it somewhere else (see AnalysisPool).
+        Returns (encoding, data, timestamp) with encoding "raw" or "png", None if not connected.
+        """
         if not self.connected:
-            return np.zeros((1080, 2220))
-        bytes_screen = self.my_device.screencap()
-        im = Image.open(io.BytesIO(bytes_screen))
-        if not return_pillow:
-            pixval = np.array(im.getdata())
-            im.close()
-            return pixval
-        else:
-            return im
+            return None
+        t_start = time.time()
+        if self.getCaptureMode() == CaptureMode.Raw:
+            try:
+                data = self._screencap_raw_bytes()
+            except RuntimeError as e:
+                print("Raw screencap failed: %s" % str(e))
+                data = None
+            if self._parse_raw_header(data) is not None:
+                return "raw", data, t_start
+            print("Unable to parse raw screencap. Using png capture mode for this device")
+            self.setCaptureMode(CaptureMode.Png)
+        return "png", self.my_device.screencap(), t_start
+
+    @timed
+    def captureFrameRows(self, bands: list) -> Frame:
+        """
+        Takes a screen transferring only given rows bands [(y1, y2), ...] (y2 excluded).
+        Screen is saved on device and only the bands are read back, so other rows of the frame are black.
+        Works with raw capture mode only: otherwise (or on errors) a complete frame is taken.
+        """
+        if not self.connected:
+            return self.adb_screen_getpixels()
+        layout = self.getRawScreenLayout()
+        if layout is None:
+            return self.captureFrame()
+        w, h, header = layout
+        row_bytes = w * 4
+        commands = ["/system/bin/screencap %s" % self.roi_tmp_file]
+        expected = 0
+        for y1, y2 in bands:
+            commands.append("tail -c +%d %s | head -c %d" % (header + y1 * row_bytes + 1, self.roi_tmp_file,
+                                                              (y2 - y1) * row_bytes))
+            expected += (y2 - y1) * row_bytes
+        t_start = time.time()
+        conn = self.my_device.create_connection()
+        with conn:
+            conn.send("exec:sh -c '%s'" % "; ".join(commands))
+            data = conn.read_all()
+        if len(data) != expected:
+            print("Wrong rows capture size (%d instead of %d). Taking complete screen" % (len(data), expected))
+            return self.captureFrame()
+        pixels = np.zeros((h, w, 4), dtype=np.uint8)
+        offset = 0
+        for y1, y2 in bands:
+            size = (y2 - y1) * row_bytes
+            pixels[y1:y2] = np.frombuffer(data, dtype=np.uint8, count=size, offset=offset).reshape(y2 - y1, w, 4)
+            offset += size
+        frame = Frame(pixels, t_start)
+        frame.rows = bands
+        return frame
+
+    def adb_screen_getpixels(self, return_pillow: bool = False, after: float = None):
+        """
+        Takes a screen of the device. Returns a Frame (or its PIL image if return_pillow)
+        When streaming, returns newest buffered frame, waiting for one captured after 'after' if given.
+        """
+        if not self.connected:
+            frame = Frame(np.zeros((1920, 1080, 4), dtype=np.uint8))
+            return frame.pil() if return_pillow else frame
+        frame = None
+        if self.isStreaming():
+            if after is None:
+                frame = self.screen_streamer.latest()
+            else:
+                frame = self.screen_streamer.waitFrameAfter(after)
+        if frame is None:
+            frame = self.captureFrame()
+        return frame.pil() if return_pillow else frame
+
+    def _closeInputSession(self):
+        if self._input_session is not None:
+            self._input_session.close()
+        self._input_session = None
+        self._shell_session_failures = 0
 
+    def adb_shell(self, command: str) -> str:
+        """
+        Runs a shell command on the persistent shell session and returns its output. Falls back to a new shell
+        for the command if the session fails, and for every command after shell_session_max_failures
+        consecutive failures.
+        """
+        if self.use_shell_session and self._shell_session_failures < self.shell_session_max_failures:
+            if self._input_session is None or self._input_session.device is not self.my_device:
+                self._closeInputSession()
+                self._input_session = AdbShellSession(self.my_device)
+            try:
+                output = self._input_session.run(command)
+                self._shell_session_failures = 0
+                return output
+            except Exception as e:
+                self._shell_session_failures += 1
+                print("Input shell session failed: %s. Using a new shell for this command" % str(e))
+        return self.my_device.shell(command)
+
+    def startMacro(self, commands: list) -> DeviceMacro:
+        """
+        Starts running shell commands on device as one script (see DeviceMacro). Returns None if not connected.
+        """
+        if not self.connected:
+            return None
+        macro = DeviceMacro(self, commands)
+        macro.start()
+        return macro
+
+    @timed
     def adb_swipe(self, locations, s) -> bool:
         if not self.connected:
             return False
@@ -150,9 +428,11 @@ class UsbConnector(object):
         """
         s = int(s * 1000)
         x1, y1, x2, y2 = locations[0], locations[1], locations[2], locations[3]
-        self.my_device.input_swipe(int(x1), int(y1), int(x2), int(y2), s)
+        self.adb_shell("input swipe %d %d %d %d %d" % (int(x1), int(y1), int(x2), int(y2), s))
+        self.last_input_time = time.time()
         return True
 
+    @timed
     def adb_tap(self, coord) -> bool:
         if not self.connected:
             return False
@@ -163,7 +443,8 @@ class UsbConnector(object):
         coord (tuple(x, y)): coordinate of tap
         """
         x, y = coord[0], coord[1]
-        self.my_device.input_tap(int(x), int(y))
+        self.adb_shell("input tap %d %d" % (int(x), int(y)))
+        self.last_input_time = time.time()
         return True
 
     keycodes = {
@@ -254,28 +535,32 @@ class UsbConnector(object):
         "KEYCODE_SEARCH": 84,
         "TAG_LAST_KEYCODE": 85, }
 
+    @timed
     def adb_tap_key(self, keycode: str) -> bool:
         if not self.connected:
             return False
         if keycode in self.keycodes:
-            self.my_device.input_keyevent(self.keycodes[keycode])
+            self.adb_shell("input keyevent %d" % self.keycodes[keycode])
+            self.last_input_time = time.time()
         else:
             return False
         return True
 
     def _oneCheck(self):
-        time.sleep(1)
-        while True:
-            if self._continousCheckStopRequired:
-                break
-            c = self.tryConnect()
-            if c != self.connected:
-                if self.connected:
-                    self.disconnect()
-                else:
-                    self._changeConnectedState(True)
-                    # self.connect() changed into tryConnect
-            time.sleep(5)
+        """
+        Follows device_tracker: connects when a device gets ready, disconnects when it is detached.
+        While connected it only waits for tracker events, so no adb command runs while playing.
+        """
+        if self._own_tracker:
+            self.device_tracker.start()
+        while not self._continousCheckStopRequired:
+            changes = self.device_tracker.changes
+            if not self.tryConnect() and self.serial is None and self.device_tracker.isRunning() and changes > 0:
+                self._connectRemote()
+            self.device_tracker.waitChange(changes, None if self.connected else self.reconnect_interval,
+                                           lambda: self._continousCheckStopRequired)
+        if self._own_tracker:
+            self.device_tracker.stop()
 
     def _startConnectionCheck(self):
         self._continousCheckStopRequired = False
@@ -0,0 +1,184 @@
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+import tracemalloc
+from datetime import datetime
+
+import numpy as np
+from PIL import Image
+
+from Frame import Frame
+from GameScreenConnector import GameScreenConnector
+from Utils import readAllSizesFolders
+
+"""
+Non interactive benchmark of GameScreenConnector detectors over the bundled screenshots (datas/<WxH>/screens),
+ability screenshots (abilities_sc) and ability crops (datas/abilities/abilities_templates).
+Each case is timed call by call (p50/p95/p99), then run again under tracemalloc for its allocations.
+Results are printed and written as json, to compare detectors speed across versions:
+    python benchmark_screen_connector.py --repeat 5 --output bench.json
+"""
+
+
+def listImages(folder: str) -> list:
+    if not os.path.isdir(folder):
+        return []
+    return [os.path.join(folder, f) for f in sorted(os.listdir(folder)) if f.lower().endswith(".png")]
+
+
+def loadFrames(paths: list, width: int, height: int) -> list:
+    frames = []
+    for path in paths:
+        frame = Frame.fromFile(path)
+        if frame.size != (width, height):
+            print("%s is %dx%d, skipped" % (path, frame.width, frame.height))
+            continue
+        frames.append(frame)
+    return frames
+
+
+def buildCases(connector: GameScreenConnector, folder: str) -> dict:
+    """
+    Returns case name -> list of calls without arguments (one for each input)
+    """
+    screens = listImages(os.path.join("datas", folder, "screens"))
+    abilities_screens = listImages(os.path.join("datas", folder, "abilities_sc"))
+    crops = listImages(os.path.join("datas", "abilities", "abilities_templates"))
+    # inputs are decoded once, outside of measures
+    frames = loadFrames(screens, connector.width, connector.height)
+    abilities_frames = loadFrames(abilities_screens, connector.width, connector.height)
+    crops_pixels = [np.array(Image.open(path).convert('RGBA')) for path in crops]
+    cases = {
+        "decode": [lambda p=path: Frame.fromFile(p) for path in screens + abilities_screens],
+        "getFrameState": [lambda f=frame: connector.getFrameState(f) for frame in frames],
+        "getFrameStateComplete": [lambda f=frame: connector.getFrameStateComplete(f) for frame in frames],
+        "getAbilityType": [lambda f=frame: connector.getAbilityType(f) for frame in abilities_frames],
+        "matchAbility": [lambda c=crop: connector._matchAbility(c) for crop in crops_pixels],
+    }
+    for check in ["checkDoorsOpen", "checkDoorsOpen1", "checkDoorsOpen2"]:
+        cases[check] = [lambda f=frame, c=getattr(connector, check): c(f) for frame in frames]
+    for name in connector.general_templates.keys():
+        cases["_check_general_template:%s" % name] = [
+            lambda f=frame, n=name: connector._check_general_template(n, f) for frame in frames]
+    return cases
+
+
+def timeCalls(connector: GameScreenConnector, calls: list, repeat: int) -> np.ndarray:
+    times = []
+    for _ in range(repeat):
+        for call in calls:
+            connector.resetCaches()
+            start = time.perf_counter()
+            call()
+            times.append(time.perf_counter() - start)
+    return np.array(times) * 1000
+
+
+def measureAllocations(connector: GameScreenConnector, calls: list) -> tuple:
+    """
+    Returns peak and net (still allocated once the call returned) bytes of each call
+    """
+    peaks, nets = [], []
+    tracemalloc.start()
+    try:
+        for call in calls:
+            connector.resetCaches()
+            before = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+            result = call()
+            current, peak = tracemalloc.get_traced_memory()
+            peaks.append(peak - before)
+            nets.append(current - before)
+            del result
+    finally:
+        tracemalloc.stop()
+    return np.array(peaks), np.array(nets)
+
+
+def runBenchmark(folder: str, width: int, height: int, repeat: int, warmup: int, allocations: bool,
+                 only: list = None) -> dict:
+    connector = GameScreenConnector()
+    connector.debug = False
+    connector.frame_diff_gating = False
+    connector.changeScreenSize(width, height)
+    # unknown abilities would be saved in abilities_unknown on every call
+    connector.save_unknown_ability = lambda ability_np: None
+    results = {}
+    for name, calls in buildCases(connector, folder).items():
+        if only is not None and not any(name.startswith(o) for o in only):
+            continue
+        if len(calls) == 0:
+            print("%s: no inputs, skipped" % name)
+            continue
+        timeCalls(connector, calls, warmup)
+        times = timeCalls(connector, calls, repeat)
+        result = {
+            "calls": int(times.size),
+            "mean_ms": float(times.mean()),
+            "p50_ms": float(np.percentile(times, 50)),
+            "p95_ms": float(np.percentile(times, 95)),
+            "p99_ms": float(np.percentile(times, 99)),
+            "max_ms": float(times.max()),
+        }
+        if allocations:
+            peaks, nets = measureAllocations(connector, calls)
+            result.update({
+                "alloc_peak_mean_kb": float(peaks.mean() / 1024),
+                "alloc_peak_max_kb": float(peaks.max() / 1024),
+                "alloc_net_mean_kb": float(nets.mean() / 1024),
+            })
+        results[name] = result
+        print("%-45s %6d calls  p50 %8.3f  p95 %8.3f  p99 %8.3f ms%s" % (
+            name, result["calls"], result["p50_ms"], result["p95_ms"], result["p99_ms"],
+            "  peak %9.1f KB" % result["alloc_peak_max_kb"] if allocations else ""))
+    return results
+
+
+def gitCommit() -> str:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], stderr=subprocess.DEVNULL).decode().strip()
+    except Exception:
+        return None
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Benchmark GameScreenConnector detectors on bundled screenshots")
+    parser.add_argument("--folders", nargs="*", help="sizes folders (as 1080x1920), all found by default")
+    parser.add_argument("--repeat", type=int, default=3, help="measured runs over all inputs")
+    parser.add_argument("--warmup", type=int, default=1, help="runs over all inputs before measuring")
+    parser.add_argument("--only", nargs="*", help="benchmark only cases starting with these names")
+    parser.add_argument("--no-allocations", action="store_true", help="skip tracemalloc measures")
+    parser.add_argument("--output", default="bench_screen_connector.json", help="json results file")
+    args = parser.parse_args()
+    sizes = readAllSizesFolders()
+    folders = list(sizes.keys()) if not args.folders else args.folders
+    report = {
+        "date": datetime.now().isoformat(),
+        "commit": gitCommit(),
+        "python": sys.version.split()[0],
+        "numpy": np.__version__,
+        "platform": platform.platform(),
+        "processor": platform.processor(),
+        "repeat": args.repeat,
+        "folders": {},
+    }
+    for folder in folders:
+        if folder not in sizes:
+            print("Unknown folder %s" % folder)
+            return 2
+        print("Benchmarking %s" % folder)
+        width, height = sizes[folder]
+        report["folders"][folder] = runBenchmark(folder, width, height, args.repeat, args.warmup,
+                                                 not args.no_allocations, args.only)
+    with open(args.output, 'w') as json_file:
+        json.dump(report, json_file, indent=1)
+    print("Results written in %s" % args.output)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,81 +1,190 @@
+import argparse
+import json
 import os
 import sys
-import json
-from PIL import Image
-# from pure_adb_connector import *
+from concurrent.futures import ProcessPoolExecutor
+
 import numpy as np
+
+from Frame import Frame
 from GameScreenConnector import GameScreenConnector
 from Utils import readAllSizesFolders
 
+"""
+Checks static coords on the screenshots of datas/<WxH>/screens: each screen must match exactly one state.
+All sizes folders (or the ones given) are checked in parallel processes. With --cache, decoded screenshots are
+kept compressed in datas/<WxH>/cache/screens: loading them is faster than decoding png, for about 1.4 times the
+screenshots size on disk.
+Results are compared to datas/<WxH>/static_coords_check.json (write it with --update-baseline): exit code is 1
+if a screen got worse than there (or, without baseline, if any screen failed).
+    python check_static_coords.py [--folders 1080x1920] [--processes 4] [--cache] [--update-baseline]
+"""
+
+baseline_file = "static_coords_check.json"
+
+# worker process globals: one GameScreenConnector for each sizes folder
+_connectors = {}
+
+
+def getConnector(width: int, height: int, debug: bool) -> GameScreenConnector:
+    connector = _connectors.get((width, height))
+    if connector is None:
+        connector = GameScreenConnector()
+        connector.changeScreenSize(width, height)
+        # every screenshot is a new screen
+        connector.frame_diff_gating = False
+        _connectors[(width, height)] = connector
+    connector.debug = debug
+    return connector
+
+
+def getImageFrame(path: str, use_cache: bool = False) -> Frame:
+    """
+    Decodes a screenshot, from the decoded copy in cache folder if it is newer than the screenshot
+    """
+    if not use_cache:
+        return Frame.fromFile(path)
+    screens_folder, file = os.path.split(path)
+    cache_folder = os.path.join(os.path.dirname(screens_folder), "cache", "screens")
+    cache_path = os.path.join(cache_folder, file + ".npz")
+    if os.path.exists(cache_path) and os.path.getmtime(cache_path) >= os.path.getmtime(path):
+        try:
+            with np.load(cache_path) as cached:
+                return Frame(cached["pixels"])
+        except Exception as e:
+            print("Unable to read cached %s: %s. Decoding it again" % (cache_path, str(e)))
+    frame = Frame.fromFile(path)
+    try:
+        os.makedirs(cache_folder, exist_ok=True)
+        np.savez_compressed(cache_path, pixels=frame.pixels)
+    except OSError as e:
+        print("Unable to cache %s: %s" % (path, str(e)))
+    return frame
 
-def getImageFrame(path: str):
-    with Image.open(path, 'r') as im:
-        pixval = np.array(im.getdata())
-    return pixval
-
-
-screens_data = readAllSizesFolders()
-keys = [k for k in screens_data.keys()]
-
-for i in range(len(keys)):
-    print("%d: %s" % (i, keys[i]))
-choosen = input("Select your number")
-folder = keys[int(choosen)]
-screens_path = os.path.join("datas", folder, "screens")
-print("Using %s" % screens_path)
-
-selected_debug = input(
-    "Do you wish to debug? (set yes only if you did it already once and found some rows with NO_DETECTION): (y/n):")
-debug = False
-if selected_debug != None:
-    if selected_debug == 'y' or selected_debug == 'yes':
-        debug = True
-width, heigth = screens_data[folder]
-excluded = []
-
-screen_conector = GameScreenConnector()
-screen_conector.changeScreenSize(width, heigth)
-screen_conector.debug = debug
-static_coords = screen_conector.static_coords
-
-files = os.listdir(screens_path)
-files.sort()
-all_ok = True
-for file in files:
+
+def checkScreen(task: tuple) -> dict:
+    """
+    Checks a screenshot. Returns file, status (OK, NO_DETECTION, MUL_DETECTIONS or WRONG_SIZE),
+    states detected and a printable message.
+    """
+    folder, width, height, file, debug, use_cache = task
+    connector = getConnector(width, height, debug)
     if debug:
-        print("\n\nChecking %s"%file)
-    if file not in excluded:
-        full_path = os.path.join(screens_path, file)
-        frame = getImageFrame(full_path)
-        complete_frame = screen_conector.getFrameStateComplete(frame)
-        computed = [k for k, v in complete_frame.items() if v]
-        sum = len(computed)
-        ok = False
-        exergy_print = '' if not screen_conector.checkFrame('least_5_energy', frame) else ' + least_5_energy'
-        open_door_print = '' if not screen_conector.checkDoorsOpen(frame) else ' + door_is_open'
-        if sum == 0:
-            print("NO_DETECTION - %s %s %s" % (file, exergy_print, open_door_print))
-        elif sum == 1:
-            print("OK - %s: %s %s %s" % (file, computed[0], exergy_print, open_door_print))
-            ok = True
-        else:
-            ones_name_purged_singular = [k for k in computed if
-                                         len(screen_conector.static_coords[k]["coordinates"]) > 1]
-            removed = [k for k in computed if k not in ones_name_purged_singular]
-            if len(ones_name_purged_singular) == 0:
-                print("MUL_DETECTIONS %s: %s %s %s" % (file, ", ".join(computed), exergy_print, open_door_print))
-            elif len(ones_name_purged_singular) == 1:
-                print("OK - %s: %s. Extra detected singulars: %s %s %s" % (
-                    file, ones_name_purged_singular[0], ", ".join(removed), exergy_print, open_door_print))
-                ok = True
-            else:
-                print("MUL_DETECTIONS %s: %s %s %s" % (file, ", ".join(ones_name_purged_singular), exergy_print, open_door_print))
-        all_ok = all_ok and ok
-
-if all_ok:
+        print("\n\nChecking %s" % file)
+    frame = getImageFrame(os.path.join("datas", folder, "screens", file), use_cache)
+    if frame.size != (width, height):
+        return {"file": file, "status": "WRONG_SIZE", "states": [],
+                "message": "WRONG_SIZE - %s: %dx%d" % (file, frame.width, frame.height)}
+    complete_frame = connector.getFrameStateComplete(frame)
+    computed = [k for k, v in complete_frame.items() if v]
+    exergy_print = '' if not connector.checkFrame('least_5_energy', frame) else ' + least_5_energy'
+    open_door_print = '' if not connector.checkDoorsOpen(frame) else ' + door_is_open'
+    extras = "%s %s" % (exergy_print, open_door_print)
+    if len(computed) == 0:
+        return {"file": file, "status": "NO_DETECTION", "states": [],
+                "message": "NO_DETECTION - %s %s" % (file, extras)}
+    states = computed
+    message = "OK - %s: %s %s" % (file, computed[0], extras)
+    if len(computed) > 1:
+        states = [k for k in computed if len(connector.static_coords[k]["coordinates"]) > 1]
+        removed = [k for k in computed if k not in states]
+        if len(states) != 1:
+            states = computed if len(states) == 0 else states
+            return {"file": file, "status": "MUL_DETECTIONS", "states": states,
+                    "message": "MUL_DETECTIONS %s: %s %s" % (file, ", ".join(states), extras)}
+        message = "OK - %s: %s. Extra detected singulars: %s %s" % (file, states[0], ", ".join(removed), extras)
+    return {"file": file, "status": "OK", "states": states, "message": message}
+
+
+def loadBaseline(folder: str):
+    path = os.path.join("datas", folder, baseline_file)
+    if not os.path.exists(path):
+        return None
+    with open(path) as json_file:
+        return json.load(json_file)
+
+
+def saveBaseline(folder: str, results: list):
+    path = os.path.join("datas", folder, baseline_file)
+    with open(path, 'w') as json_file:
+        json.dump({r["file"]: {"status": r["status"], "states": r["states"]} for r in results}, json_file,
+                  indent=1, sort_keys=True)
+    print("Baseline written in %s" % path)
+
+
+def compareToBaseline(result: dict, baseline) -> str:
+    """
+    Returns "regression", "fixed" or None (no change worth reporting)
+    """
+    expected = None if baseline is None else baseline.get(result["file"])
+    if expected is None:
+        return None if result["status"] == "OK" else "regression"
+    if result["status"] == "OK":
+        if expected["status"] != "OK":
+            return "fixed"
+        return None if result["states"] == expected["states"] else "regression"
+    # a known failure is a regression only if it changed
+    if result["status"] != expected["status"] or result["states"] != expected["states"]:
+        return "regression"
+    return None
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Checks static coords on the screenshots of sizes folders")
+    parser.add_argument("--folders", nargs="*", help="sizes folders (as 1080x1920), all found by default")
+    parser.add_argument("--processes", type=int, default=os.cpu_count(), help="checking processes")
+    parser.add_argument("--debug", action="store_true", help="print point by point checks (use --processes 1)")
+    parser.add_argument("--cache", action="store_true", help="keep decoded screenshots in cache folders between runs")
+    parser.add_argument("--update-baseline", action="store_true",
+                        help="save results as the expected ones of next runs")
+    parser.add_argument("--quiet", action="store_true", help="print only failed and changed screens")
+    args = parser.parse_args()
+    sizes = readAllSizesFolders()
+    folders = list(sizes.keys()) if not args.folders else args.folders
+    tasks = []
+    for folder in folders:
+        if folder not in sizes:
+            print("Unknown folder %s" % folder)
+            return 2
+        width, height = sizes[folder]
+        screens_path = os.path.join("datas", folder, "screens")
+        for file in sorted(os.listdir(screens_path)):
+            tasks.append((folder, width, height, file, args.debug, args.cache))
+    print("Checking %d screens of %s" % (len(tasks), ", ".join(folders)))
+    if args.processes > 1:
+        with ProcessPoolExecutor(args.processes) as executor:
+            results = list(executor.map(checkScreen, tasks, chunksize=max(1, len(tasks) // (args.processes * 4))))
+    else:
+        results = [checkScreen(task) for task in tasks]
+    regressions, fixed, failed = [], [], 0
+    for folder in folders:
+        folder_results = [r for task, r in zip(tasks, results) if task[0] == folder]
+        baseline = loadBaseline(folder)
+        print("\n%s (%s)" % (folder, "no baseline" if baseline is None else "compared to %s" % baseline_file))
+        for result in folder_results:
+            change = compareToBaseline(result, baseline)
+            if result["status"] != "OK":
+                failed += 1
+            if change == "regression":
+                regressions.append("%s/%s" % (folder, result["file"]))
+            elif change == "fixed":
+                fixed.append("%s/%s" % (folder, result["file"]))
+            if not args.quiet or result["status"] != "OK" or change is not None:
+                print(result["message"] + ("" if change is None else " [%s]" % change.upper()))
+        if args.update_baseline:
+            saveBaseline(folder, folder_results)
+    print("\n%d screens checked, %d failed, %d regressions, %d fixed" % (len(results), failed, len(regressions),
+                                                                         len(fixed)))
+    if len(fixed) > 0 and not args.update_baseline:
+        print("Fixed screens: run with --update-baseline to expect them OK from now on")
+    if len(regressions) > 0 and not args.update_baseline:
+        print("Regressions in: %s" % ", ".join(regressions))
+        print("Got some failed tests. It is advised not to use the bot. "
+              "Infinite loops and damage can be done by randomply clicking without knowledge.")
+        return 1
     print("All tests passed!")
-else:
-    print(
-        "Got some failed tests. It is advised not to use the bot. Infinite loops and damage can be done by randomply clicking without knowledge.")
+    return 0
+
 
-# a = input("Press ENTER to exit")
+if __name__ == "__main__":
+    sys.exit(main())
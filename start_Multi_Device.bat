@@ -0,0 +1,3 @@
+@echo off
+python.exe DeviceManager.py
+pause
\ No newline at end of file